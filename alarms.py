@@ -0,0 +1,246 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi with email alerts
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Table-driven alarms. Each rule watches one field reported by sensors (e.g. temperature)
+# and raises an alarm when the value goes below or above a threshold (or is true), and
+# clears it once the value is back past the threshold by the hysteresis. Rules are
+# compiled into a table of rules for each field, so a message only touches the rules
+# for the fields it contains. Thresholds may be overridden for individual sensors, and
+# the active alarms are a set of (sensor, rule name) pairs.
+
+import logging
+from datetime import datetime
+
+# Constants
+SECTION_PREFIX = 'alarm:'
+REQUIRED_KEYS = ('metric', 'condition')
+BELOW = 'below'
+ABOVE = 'above'
+TRUE = 'true'
+OFF = 'off'             # override value that disables a rule for a sensor
+LOW_TEMP_THRESHOLD = 10.0
+HIGH_HUMIDITY_THRESHOLD = 85.0
+
+# Default rules (the alarms of earlier versions); settings of [alarm:NAME] sections
+# replace the settings of the default rule with the same name or add new rules
+DEFAULT_RULES = {
+    'low_temp': {'metric': 'temperature', 'condition': BELOW, 'threshold': LOW_TEMP_THRESHOLD, 'hysteresis': 1.0,
+                 'subject': 'Home temperature warning!', 'message': 'The house temperature has fallen to: {value} degrees C! ({sensor})',
+                 'clear_subject': 'Home temperature update', 'clear_message': 'The house temperature is now risen to {value} degrees C. ({sensor})'},
+    'freezing': {'metric': 'temperature', 'condition': BELOW, 'threshold': 0.0, 'hysteresis': 1.0,
+                 'subject': 'Home temperature FREEZING!', 'message': 'The house temperature is freezing! Temperature={value} degrees C! ({sensor})',
+                 'clear_subject': 'Home temperature update', 'clear_message': 'The house temperature is now risen above freezing. Temperature={value} degrees C. ({sensor})'},
+    'high_humidity': {'metric': 'humidity', 'condition': ABOVE, 'threshold': HIGH_HUMIDITY_THRESHOLD, 'hysteresis': 2.0,
+                      'subject': 'Home humidity warning!', 'message': 'The house humidity has risen to: {value}! ({sensor})',
+                      'clear_subject': 'Home humidity update', 'clear_message': 'The house humidity has now fallen to: {value}. ({sensor})'},
+    'water_leak': {'metric': 'water_leak', 'condition': TRUE,
+                   'subject': 'Water leak alarm detected for {sensor}!', 'message': '{payload}',
+                   'clear_subject': 'Water leak alarm stopped for {sensor}', 'clear_message': '{payload}'},
+    'battery_low': {'metric': 'battery_low', 'condition': TRUE,
+                    'subject': 'Low battery detected for {sensor}!', 'message': '{payload}'},
+}
+
+class Rule:
+    ''' An alarm on one field of sensor messages. Per-sensor thresholds are in overrides
+        (None disables the rule for a sensor); clear_subject None sends no e-mail when cleared.
+    '''
+    __slots__ = ('name', 'metric', 'condition', 'threshold', 'hysteresis', 'overrides',
+                 'subject', 'message', 'clear_subject', 'clear_message')
+
+    def __init__(self, name, metric, condition, threshold=None, hysteresis=0.0, overrides=None,
+                 subject=None, message='{value}', clear_subject=None, clear_message='{value}'):
+        if condition not in (BELOW, ABOVE, TRUE):
+            raise ValueError(f'Unknown condition for alarm {name}: {condition}')
+        if condition != TRUE and threshold is None:
+            raise ValueError(f'Alarm {name} requires a threshold')
+        self.name = name
+        self.metric = metric
+        self.condition = condition
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.overrides = overrides or {}
+        self.subject = subject or f'{name} alarm for {{sensor}}!'
+        self.message = message
+        self.clear_subject = clear_subject
+        self.clear_message = clear_message
+
+    def triggered(self, value, threshold):
+        if self.condition == BELOW:
+            return value < threshold
+        if self.condition == ABOVE:
+            return value > threshold
+        return bool(value)
+
+    def cleared(self, value, threshold):
+        if self.condition == BELOW:
+            return value > threshold + self.hysteresis
+        if self.condition == ABOVE:
+            return value < threshold - self.hysteresis
+        return not value
+
+class AlarmEngine:
+    ''' Evaluates the rules for the fields of sensor messages and sends an e-mail
+        (through mail.send) when an alarm is raised or cleared
+    '''
+    def __init__(self, rules, mail):
+        ''' Constructor: rules is a list of Rule
+        '''
+        self.mail = mail
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.metric, []).append(rule)
+        self.rules = {metric: tuple(rules) for (metric, rules) in self.rules.items()}
+        self.active = set()     # (sensor, rule name)
+
+    def check(self, sensor, field, value, payload=b''):
+        ''' Evaluate the rules for one field of a message from a sensor
+        '''
+        rules = self.rules.get(field)
+        if rules is None:
+            return
+        for rule in rules:
+            threshold = rule.overrides.get(sensor, rule.threshold)
+            if threshold is None and sensor in rule.overrides:
+                continue        # disabled for this sensor
+            if rule.condition != TRUE:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+            key = (sensor, rule.name)
+            if key in self.active:
+                if rule.cleared(value, threshold):
+                    self.active.discard(key)
+                    self.notify(rule, sensor, value, threshold, payload, cleared=True)
+            elif rule.triggered(value, threshold):
+                self.active.add(key)
+                self.notify(rule, sensor, value, threshold, payload, cleared=False)
+
+    def notify(self, rule, sensor, value, threshold, payload, cleared):
+        ''' Log an alarm being raised or cleared and send its e-mail
+        '''
+        (subject, message) = (rule.clear_subject, rule.clear_message) if cleared else (rule.subject, rule.message)
+        fields = {'sensor': sensor, 'value': value, 'threshold': threshold, 'payload': payload.decode('utf-8', 'replace')}
+        logging.info(f'{datetime.now()}: alarm {rule.name} {"cleared" if cleared else "raised"} for {sensor} (value={value})')
+        if subject is not None:
+            self.mail.send(subject.format(**fields), message.format(**fields), key=f'{rule.name}:{sensor}')
+
+    def active_alarms(self):
+        ''' Return a sorted list of the active (sensor, rule name) alarms (safe to call from any thread)
+        '''
+        return sorted(self.active.copy())
+
+def parse_overrides(spec):
+    ''' Parse per-sensor thresholds, e.g. "garage: 2.0, attic: off" -> {'garage': 2.0, 'attic': None}
+    '''
+    overrides = {}
+    for entry in spec.split(','):
+        if ':' in entry:
+            (sensor, value) = (part.strip() for part in entry.split(':', 1))
+            overrides[sensor] = None if value.lower() == OFF else float(value)
+    return overrides
+
+def load_rules(conf):
+    ''' Return the alarm rules: the default rules (with the low_temp_threshold and
+        high_humidity_threshold of the [pi-home] section) updated by [alarm:NAME] sections
+    '''
+    settings = {name: dict(rule) for (name, rule) in DEFAULT_RULES.items()}
+    settings['low_temp']['threshold'] = conf.getfloat('pi-home', 'low_temp_threshold', fallback=LOW_TEMP_THRESHOLD)
+    settings['high_humidity']['threshold'] = conf.getfloat('pi-home', 'high_humidity_threshold', fallback=HIGH_HUMIDITY_THRESHOLD)
+    for section in conf.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):]
+        rule = settings.setdefault(name, {})
+        for key in ('metric', 'condition', 'subject', 'message', 'clear_subject', 'clear_message'):
+            if conf.has_option(section, key):
+                rule[key] = conf.get(section, key, raw=True)
+        for key in ('threshold', 'hysteresis'):
+            if conf.has_option(section, key):
+                rule[key] = conf.getfloat(section, key)
+        rule['overrides'] = parse_overrides(conf.get(section, 'overrides', fallback=''))
+        rule['enabled'] = conf.getboolean(section, 'enabled', fallback=True)
+    rules = []
+    for (name, rule) in settings.items():
+        if not rule.pop('enabled', True):
+            continue
+        missing = [key for key in REQUIRED_KEYS if key not in rule]
+        if missing:
+            raise ValueError(f'[{SECTION_PREFIX}{name}] is missing {", ".join(missing)}')
+        rules.append(Rule(name, **rule))
+    logging.info(f'Alarm rules: {", ".join(f"{rule.name} ({rule.metric} {rule.condition} {rule.threshold})" for rule in rules)}')
+    return rules
+
+# Self test code
+if __name__ == '__main__':
+    import configparser
+
+    class Mail:
+        def __init__(self):
+            self.sent = []
+        def send(self, subject, message, html=None, key=None):
+            self.sent.append((subject, key))
+
+    conf = configparser.ConfigParser()
+    conf.read_string('''
+[pi-home]
+low_temp_threshold = 12
+[alarm:low_temp]
+overrides = garage: 2, attic: off
+[alarm:battery_low]
+enabled = false
+[alarm:high_pressure]
+metric = pressure
+condition = above
+threshold = 1040
+hysteresis = 5
+subject = High pressure at {sensor}
+''')
+    rules = load_rules(conf)
+    assert sorted(rule.name for rule in rules) == ['freezing', 'high_humidity', 'high_pressure', 'low_temp', 'water_leak']
+    mail = Mail()
+    engine = AlarmEngine(rules, mail)
+
+    # Thresholds with hysteresis and per-sensor overrides
+    engine.check('kitchen', 'temperature', 11.5)
+    engine.check('garage', 'temperature', 11.5)
+    engine.check('attic', 'temperature', 5)
+    assert engine.active_alarms() == [('kitchen', 'low_temp')] and mail.sent == [('Home temperature warning!', 'low_temp:kitchen')]
+    engine.check('kitchen', 'temperature', 12.5)       # within the hysteresis: still active
+    assert ('kitchen', 'low_temp') in engine.active
+    engine.check('kitchen', 'temperature', 13.5)
+    assert not engine.active and mail.sent[-1] == ('Home temperature update', 'low_temp:kitchen')
+
+    # Boolean alarms, new rules and fields without rules
+    engine.check('leak1', 'water_leak', True, b'{"water_leak":true}')
+    engine.check('leak1', 'water_leak', True, b'{"water_leak":true}')
+    engine.check('leak1', 'battery_low', True)
+    engine.check('leak1', 'linkquality', 10)
+    engine.check('outside', 'pressure', 1050)
+    assert engine.active_alarms() == [('leak1', 'water_leak'), ('outside', 'high_pressure')]
+    assert mail.sent[-2:] == [('Water leak alarm detected for leak1!', 'water_leak:leak1'), ('High pressure at outside', 'high_pressure:outside')]
+    engine.check('leak1', 'water_leak', False, b'{"water_leak":false}')
+    assert mail.sent[-1] == ('Water leak alarm stopped for leak1', 'water_leak:leak1')
+
+    # Both temperature rules are raised by a freezing reading, with separate alert keys
+    engine.check('kitchen', 'temperature', -1)
+    assert engine.active_alarms()[:2] == [('kitchen', 'freezing'), ('kitchen', 'low_temp')]
+    assert sorted(key for (subject, key) in mail.sent[-2:]) == ['freezing:kitchen', 'low_temp:kitchen']
+
+    # A new rule without a metric names its section
+    conf.read_string('[alarm:broken]\ncondition = above\nthreshold = 1\n')
+    try:
+        load_rules(conf)
+        assert False
+    except ValueError as e:
+        assert 'alarm:broken' in str(e) and 'metric' in str(e)
+    try:
+        Rule('bad', 'temperature', 'between', 1)
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,243 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi with email alerts
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# E-mail alerts are sent by a background thread so that a slow or unreachable SMTP
+# server never holds up the MQTT message handler. Alerts are queued on a bounded queue
+# (alerts that do not fit are dropped and counted). The first alert with a given key is
+# sent at once; further alerts with the same key within the coalescing window are
+# collected and sent together as a single digest when the window closes, so a flapping
+# sensor sends at most one e-mail per window.
+
+import logging
+import queue
+import time
+from datetime import datetime
+from threading import Thread, Event
+from metrics import REGISTRY
+
+# Constants
+ALERT_WINDOW = 300          # seconds
+ALERT_QUEUE_SIZE = 100
+IDLE_TIMEOUT = 60           # close the SMTP session after this many seconds without alerts
+
+# Metrics
+ALERTS_DROPPED = REGISTRY.counter('pihome_alerts_dropped_total', 'E-mail alerts dropped because the alert queue was full')
+ALERTS_COALESCED = REGISTRY.counter('pihome_alerts_coalesced_total', 'E-mail alerts held for a digest')
+
+class Window:
+    ''' Alerts with the same key received since the last e-mail with that key
+    '''
+    __slots__ = ('deadline', 'alerts')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.alerts = []        # (datetime, subject, message)
+
+class AlertDispatcher(Thread):
+    ''' Sends e-mail alerts through a Mail object from a background thread,
+        coalescing alerts with the same key into digests
+    '''
+    def __init__(self, mail, window=ALERT_WINDOW, queue_size=ALERT_QUEUE_SIZE, idle_timeout=IDLE_TIMEOUT):
+        ''' Constructor
+        '''
+        Thread.__init__(self, name='AlertDispatcher', daemon=True)
+        self.mail = mail
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = Event()
+        self.windows = {}       # key -> Window (only used by the dispatcher thread)
+        self.last_sent = time.monotonic()
+
+        # Counters (read by other threads for display only)
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.digests = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    @property
+    def to_address(self):
+        return self.mail.to_address
+
+    @property
+    def server(self):
+        return self.mail.server
+
+    def send(self, subject, message, html=None, key=None):
+        ''' Queue an alert; never blocks the calling thread. Alerts with the same key
+            (default: the subject) are coalesced. Returns False if the alert was dropped.
+        '''
+        try:
+            self.queue.put_nowait((key or subject, datetime.now(), subject, message, html))
+        except queue.Full:
+            self.dropped += 1
+            ALERTS_DROPPED.inc()
+            logging.warning(f'Alert queue full, alert dropped: {subject} ({self.dropped} dropped in total)')
+            return False
+        self.queued += 1
+        return True
+
+    def run(self):
+        ''' Send queued alerts and digests until stopped
+        '''
+        while True:
+            try:
+                item = self.queue.get(timeout=self.next_timeout())
+            except queue.Empty:
+                item = None
+            if item is not None:
+                self.handle(*item)
+            if self.stop_event.is_set() and self.queue.empty():
+                break
+            self.close_windows(time.monotonic())
+            if time.monotonic() - self.last_sent >= self.idle_timeout:
+                self.mail.close()
+        # Send the alerts still waiting for their window to close
+        self.close_windows(None)
+        self.mail.close()
+        logging.info(f'Alert dispatcher stopped: {self.sent} sent, {self.digests} digests, {self.dropped} dropped')
+
+    def next_timeout(self):
+        ''' Return the time until the first window closes (or the idle SMTP session should be closed)
+        '''
+        now = time.monotonic()
+        deadlines = [window.deadline for window in self.windows.values()]
+        if self.mail.smtp is not None:
+            deadlines.append(self.last_sent + self.idle_timeout)
+        return max(min(deadlines) - now, 0) if deadlines else None
+
+    def handle(self, key, when, subject, message, html):
+        ''' Send an alert at once if no alert with its key was sent within the window, otherwise hold it for the digest
+        '''
+        window = self.windows.get(key)
+        if window is not None:
+            window.alerts.append((when, subject, message))
+            self.coalesced += 1
+            ALERTS_COALESCED.inc()
+            return
+        self.windows[key] = Window(time.monotonic() + self.window)
+        self.deliver(subject, message, html)
+
+    def close_windows(self, now):
+        ''' Send a digest for each expired window with held alerts and reopen it;
+            windows without held alerts are closed. All windows expire if now is None.
+        '''
+        for (key, window) in list(self.windows.items()):
+            if now is not None and window.deadline > now:
+                continue
+            if not window.alerts:
+                del self.windows[key]
+                continue
+            alerts = window.alerts
+            window.alerts = []
+            window.deadline = time.monotonic() + self.window
+            subject = alerts[-1][1] if len(alerts) == 1 else f'{alerts[-1][1]} ({len(alerts)} alerts)'
+            message = '\n\n'.join(f'{when.strftime("%m/%d/%Y, %H:%M:%S")}: {subject}\n{message}' for (when, subject, message) in alerts)
+            if self.deliver(subject, message):
+                self.digests += 1
+
+    def deliver(self, subject, message, html=None):
+        ''' Send an e-mail and update the counters
+        '''
+        self.last_sent = time.monotonic()
+        if self.mail.send(subject, message, html):
+            self.sent += 1
+            return True
+        self.failed += 1
+        return False
+
+    def stop(self, timeout=None):
+        ''' Stop the dispatcher thread after sending the queued alerts and digests
+        '''
+        self.stop_event.set()
+        try:
+            self.queue.put_nowait(None)     # wake the thread
+        except queue.Full:
+            pass
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        ''' Return a dictionary of the dispatcher counters
+        '''
+        return {'waiting': self.queue.qsize(), 'queued': self.queued, 'dropped': self.dropped, 'sent': self.sent,
+                'digests': self.digests, 'coalesced': self.coalesced, 'failed': self.failed, 'windows': len(self.windows)}
+
+# Self test code
+if __name__ == '__main__':
+    import socketserver
+    from threading import Thread
+    from sensors import Mail
+
+    class SMTPHandler(socketserver.StreamRequestHandler):
+        ''' Minimal local SMTP server standing in for a mail relay
+        '''
+        def reply(self, line):
+            self.wfile.write(line.encode() + b'\r\n')
+
+        def handle(self):
+            self.server.connections += 1
+            self.reply('220 localhost ESMTP')
+            while True:
+                line = self.rfile.readline().decode().strip()
+                command = line[:4].upper()
+                if not line or command == 'QUIT':
+                    self.reply('221 Bye')
+                    return
+                if command == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    lines = []
+                    while (data := self.rfile.readline()) not in (b'.\r\n', b''):
+                        lines.append(data.decode())
+                    self.server.messages.append(''.join(lines))
+                    self.reply('250 OK')
+                    if self.server.drop_after_message:
+                        return      # drop the session as an idle timeout would
+                else:
+                    self.reply('250 OK')
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+    server.daemon_threads = True
+    (server.connections, server.messages, server.drop_after_message) = (0, [], False)
+    Thread(target=server.serve_forever, daemon=True).start()
+    mail = Mail('pi@localhost', 'me@localhost', f'127.0.0.1:{server.server_address[1]}')
+
+    # The SMTP session is reused, and reopened if the server drops it
+    assert mail.send('one', 'first') and mail.send('two', 'second') and server.connections == 1
+    server.drop_after_message = True
+    assert mail.send('three', 'third') and mail.send('four', 'fourth') and server.connections == 2
+    assert len(server.messages) == 4
+    server.drop_after_message = False
+    mail.close()
+
+    # A flapping sensor sends one alert at once, then one digest per window
+    dispatcher = AlertDispatcher(mail, window=0.3)
+    dispatcher.start()
+    for i in range(10):
+        dispatcher.send(f'Water leak alarm for sensor{i % 2}', f'leak {i}', key='water_leak')
+    dispatcher.send('Home temperature warning!', 'cold')
+    time.sleep(0.1)
+    assert len(server.messages) == 6, server.messages
+    time.sleep(0.4)
+    assert len(server.messages) == 7 and 'leak 9' in server.messages[-1] and '(9 alerts)' in server.messages[-1]
+    stats = dispatcher.stats()
+    assert (stats['sent'], stats['digests'], stats['coalesced'], stats['dropped']) == (3, 1, 9, 0), stats
+
+    # Alerts held for a digest are sent when the dispatcher stops
+    dispatcher.send('Low battery', 'a')
+    dispatcher.send('Low battery', 'b')
+    dispatcher.stop(2)
+    assert not dispatcher.is_alive() and len(server.messages) == 9 and mail.smtp is None
+
+    # Alerts are dropped (and counted) when the queue is full
+    blocked = AlertDispatcher(mail, queue_size=2)
+    assert blocked.send('a', 'a') and blocked.send('b', 'b') and not blocked.send('c', 'c')
+    assert blocked.stats()['dropped'] == 1
+    server.shutdown()
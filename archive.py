@@ -0,0 +1,364 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Archive of old sensor readings. Once a calendar month is closed (it ended more than
+# archive_days ago) its readings are moved out of the SensorData table into one file
+# per sensor holding fixed-width columns: the timestamps (uint32) followed by each
+# metric (float32, NaN for a missing value), little-endian. A JSON manifest lists the
+# archived months and their files. Files are memory-mapped when read, so a range of
+# readings is found by a binary search on the timestamp column and only the pages
+# holding that range are read from disk. Readings before the end of the last archived
+# month are read from the archive, later readings from the database.
+
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import sys
+import time
+from array import array
+from datetime import datetime
+from operator import itemgetter
+from threading import Lock, Thread
+
+# Constants
+TABLE = 'SensorData'
+METRICS = ('temperature', 'humidity', 'pressure')
+MANIFEST = 'manifest.json'
+ARCHIVE_VERSION = 1
+ARCHIVE_DAYS = 90           # months that ended more than this many days ago are archived
+ARCHIVE_PERIOD = 86400
+ARCHIVE_CHUNK_SIZE = 5000
+ARCHIVE_PAUSE = 0.05
+CHUNK_SIZE = 2000
+
+NAN = float('nan')
+
+def month_start(ts):
+    ''' Return the start of the local calendar month containing epoch time ts
+    '''
+    return int(time.mktime(time.localtime(ts)[:2] + (1, 0, 0, 0, 0, 0, -1)))
+
+def next_month(start):
+    ''' Return the start of the month following the month starting at start
+    '''
+    (year, month) = time.localtime(start)[:2]
+    (year, month) = (year + 1, 1) if month == 12 else (year, month + 1)
+    return int(time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1)))
+
+def month_name(start):
+    return time.strftime('%Y-%m', time.localtime(start))
+
+def rounded(value):
+    ''' Return None for a missing (NaN) value, otherwise a float32 value without the digits
+        added by the conversion to float32 (e.g. 21.3 rather than 21.299999237060547)
+    '''
+    return None if value != value else float(f'{value:.7g}')
+
+class Archive:
+    ''' The archived months of readings: written by the Archiver job and read by the web server threads
+    '''
+    def __init__(self, directory):
+        ''' Constructor: loads the manifest of an existing archive
+        '''
+        self.directory = directory
+        self.months = {}        # month name -> {'start', 'end', 'sensors': {sensor: {'file', 'rows'}}}
+        self.columns = {}       # (month name, sensor) -> (times, {metric: values}) memory-mapped columns
+        self.lock = Lock()
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') != ARCHIVE_VERSION:
+                raise ValueError(f'Unsupported archive version in {path}: {manifest.get("version")}')
+            self.months = manifest['months']
+        self.end = max((month['end'] for month in self.months.values()), default=0)
+
+    def add(self, name, start, end, sensors):
+        ''' Add an archived month (whose files are written) and save the manifest.
+            Readings before end are read from the archive from now on.
+        '''
+        with self.lock:
+            months = dict(self.months)
+            months[name] = {'start': start, 'end': end, 'sensors': sensors}
+            path = os.path.join(self.directory, MANIFEST)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'version': ARCHIVE_VERSION, 'metrics': METRICS, 'months': months}, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            self.months = months
+            self.end = max(self.end, end)
+
+    def month_columns(self, name, sensor):
+        ''' Return the (times, {metric: values}) columns of a sensor in an archived month,
+            or None if the sensor has no readings in that month
+        '''
+        key = (name, sensor)
+        columns = self.columns.get(key)
+        if columns is not None:
+            return columns
+        entry = self.months[name]['sensors'].get(sensor)
+        if entry is None:
+            return None
+        rows = entry['rows']
+        with open(os.path.join(self.directory, entry['file']), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.byteorder == 'little':
+            view = memoryview(data)
+            times = view[:4*rows].cast('I')
+            values = {metric: view[4*rows*(i+1):4*rows*(i+2)].cast('f') for (i, metric) in enumerate(METRICS)}
+        else:
+            # Columns are little-endian: read them into arrays and swap the bytes
+            times = array('I', data[:4*rows])
+            values = {metric: array('f', data[4*rows*(i+1):4*rows*(i+2)]) for (i, metric) in enumerate(METRICS)}
+            for column in [times, *values.values()]:
+                column.byteswap()
+        with self.lock:
+            columns = self.columns.setdefault(key, (times, values))
+        return columns
+
+    def ranges(self, sensor, start, end):
+        ''' Generate (times, values, first, last) for each archived month holding readings
+            of a sensor in start < time <= end; times[first:last] are the readings in range
+        '''
+        for (name, month) in sorted(self.months.items()):
+            if month['end'] <= start or month['start'] > end:
+                continue
+            columns = self.month_columns(name, sensor)
+            if columns is None:
+                continue
+            (times, values) = columns
+            first = bisect.bisect_right(times, start)
+            last = bisect.bisect_right(times, end)
+            if first < last:
+                yield times, values, first, last
+
+    def series(self, sensor, metric, start, end):
+        ''' Return (times, values) arrays of a metric of a sensor for start < time <= end,
+            skipping missing values (like downsample.read_series); values are rounded as in rows()
+        '''
+        x = array('d')
+        y = array('d')
+        for (times, values, first, last) in self.ranges(sensor, start, end):
+            column = values[metric]
+            for i in range(first, last):
+                value = column[i]
+                if value == value:      # skip NaN
+                    x.append(times[i])
+                    y.append(rounded(value))
+        return x, y
+
+    def rows(self, sensor, start, end):
+        ''' Generate the (sensor, ts, temperature, humidity, pressure) rows of a sensor for start < time <= end
+        '''
+        for (times, values, first, last) in self.ranges(sensor, start, end):
+            columns = [values[metric] for metric in METRICS]
+            for i in range(first, last):
+                yield (sensor, times[i], *(rounded(column[i]) for column in columns))
+
+    def chunks(self, sensor, start, end, chunk_size=CHUNK_SIZE):
+        ''' Generate lists of rows for start < time <= end in time order, for one sensor or every
+            sensor (sensor None), in the same form as export.read_chunks
+        '''
+        if sensor is None:
+            sensors = sorted({name for month in list(self.months.values()) for name in month['sensors']})
+            rows = heapq.merge(*(self.rows(name, start, end) for name in sensors), key=itemgetter(1))
+        else:
+            rows = self.rows(sensor, start, end)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def stats(self):
+        ''' Return a dictionary describing the archive
+        '''
+        months = list(self.months.values())
+        files = [entry for month in months for entry in month['sensors'].values()]
+        return {'months': len(months), 'files': len(files), 'rows': sum(entry['rows'] for entry in files),
+                'bytes': sum(4 * (1 + len(METRICS)) * entry['rows'] for entry in files),
+                'end': self.end, 'mapped': len(self.columns)}
+
+class Archiver:
+    ''' Scheduled job which moves the readings of closed months from the database into the archive.
+        A month's files and manifest entry are written before its rows are deleted (in chunks,
+        like the retention job), so the readings are never missing from both. The job runs in
+        its own thread so that it never delays other scheduled jobs.
+    '''
+    def __init__(self, scheduler, database, archive, days=ARCHIVE_DAYS, period=ARCHIVE_PERIOD, chunk_size=ARCHIVE_CHUNK_SIZE):
+        ''' Constructor
+        '''
+        self.scheduler = scheduler
+        self.database = database
+        self.archive = archive
+        self.days = days
+        self.period = period
+        self.chunk_size = chunk_size
+        self.thread = None
+
+    def start(self, delay=120):
+        ''' Schedule the first archive event
+        '''
+        os.makedirs(self.archive.directory, exist_ok=True)
+        self.scheduler.enter(delay, 2, self.archive_event, name='archive')
+        logging.info(f'Archive job scheduled every {self.period} seconds, archiving months older than {self.days} days to {self.archive.directory}')
+
+    def archive_event(self):
+        ''' Scheduler handler to periodically archive closed months
+        '''
+        # set next archive event
+        self.scheduler.enter(self.period, 2, self.archive_event, name='archive')
+        if self.thread is not None and self.thread.is_alive():
+            logging.warning('Archive job still running; skipping this run')
+            return
+        self.thread = Thread(target=self.run, name='Archiver', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        ''' Archive closed months (in the archive thread)
+        '''
+        try:
+            self.archive_months()
+        except (sqlite3.Error, OSError) as e:
+            logging.error(f'Archive job failed: {e}')
+
+    def archive_months(self, now=None):
+        ''' Archive every closed month still in the database, oldest first, and return the number of rows moved
+        '''
+        if now is None:
+            now = int(time.time())
+        cutoff = now - self.days*86400
+        db = sqlite3.connect(self.database, timeout=30)
+        total = 0
+        try:
+            while True:
+                oldest = db.execute(f'SELECT MIN(ts) FROM {TABLE}').fetchone()[0]
+                if oldest is None:
+                    break
+                start = month_start(oldest)
+                end = next_month(start)
+                if end > cutoff:
+                    break
+                name = month_name(start)
+                if name not in self.archive.months:
+                    self.write_month(db, name, start, end)
+                total += self.delete(db, end)
+        finally:
+            db.close()
+        return total
+
+    def write_month(self, db, name, start, end):
+        ''' Write the column files of every sensor with readings in a month and add the month to the archive
+        '''
+        begin = time.monotonic()
+        os.makedirs(os.path.join(self.archive.directory, name), exist_ok=True)
+        sensors = {}
+        db.execute('BEGIN')     # read the month from a single snapshot
+        try:
+            names = [row[0] for row in db.execute(f'SELECT DISTINCT sensor FROM {TABLE} WHERE ts >= ? AND ts < ?', (start, end))]
+            for (i, sensor) in enumerate(sorted(names)):
+                rows = db.execute(f'SELECT COUNT(*) FROM {TABLE} WHERE sensor = ? AND ts >= ? AND ts < ?', (sensor, start, end)).fetchone()[0]
+                filename = f'{name}/{i}.col'
+                self.write_columns(db, os.path.join(self.archive.directory, filename), sensor, start, end, rows)
+                sensors[sensor] = {'file': filename, 'rows': rows}
+        finally:
+            db.rollback()
+        self.archive.add(name, start, end, sensors)
+        logging.info(f'Archived {sum(entry["rows"] for entry in sensors.values())} readings of {name} '
+                     f'({len(sensors)} sensors) in {time.monotonic()-begin:.2f} seconds')
+
+    def write_columns(self, db, path, sensor, start, end, rows):
+        ''' Write the readings of a sensor in a month to a column file, a chunk of rows at a time
+        '''
+        cursor = db.execute(f'SELECT ts, {", ".join(METRICS)} FROM {TABLE} WHERE sensor = ? AND ts >= ? AND ts < ? ORDER BY ts', (sensor, start, end))
+        written = 0
+        with open(path + '.tmp', 'wb') as f:
+            f.truncate(4 * (1 + len(METRICS)) * rows)
+            while True:
+                chunk = cursor.fetchmany(self.chunk_size)
+                if not chunk:
+                    break
+                columns = [array('I', (row[0] for row in chunk))]
+                columns += [array('f', (NAN if row[i] is None else row[i] for row in chunk)) for i in range(1, 1 + len(METRICS))]
+                for (i, column) in enumerate(columns):
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    f.seek(4 * (i*rows + written))
+                    column.tofile(f)
+                written += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if written != rows:
+            raise OSError(f'Expected {rows} readings of {sensor} for {path}, read {written}')
+        os.replace(path + '.tmp', path)
+
+    def delete(self, db, end):
+        ''' Delete the archived readings (before end) from the database in chunks and return the number of rows deleted
+        '''
+        total = 0
+        while True:
+            with db:
+                deleted = db.execute(f'DELETE FROM {TABLE} WHERE (sensor, ts) IN (SELECT sensor, ts FROM {TABLE} WHERE ts < ? LIMIT ?)',
+                                     (end, self.chunk_size)).rowcount
+            total += deleted
+            if deleted < self.chunk_size:
+                break
+            # Give the writer thread a chance to take the write lock between chunks
+            time.sleep(ARCHIVE_PAUSE)
+        logging.info(f'Archive job deleted {total} archived records before {datetime.fromtimestamp(end)}')
+        return total
+
+# Self test and benchmark code
+if __name__ == '__main__':
+    import tempfile
+    from database import create_schema
+
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'test.db')
+    db = sqlite3.connect(database)
+    create_schema(db)
+    now = int(time.mktime((2024, 4, 15, 12, 0, 0, 0, 0, -1)))
+    first = int(time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1)))
+    rows = [(sensor, ts, 20.37 + (ts // 600) % 10, None if (ts // 600) % 7 == 0 else 45.12, None)
+            for ts in range(first, now, 600) for sensor in ('s1', 's2')]
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)', rows)
+    db.commit()
+
+    # Months that ended more than 30 days before now (January and February) are moved to the archive
+    archive = Archive(os.path.join(directory, 'archive'))
+    archiver = Archiver(None, database, archive, days=30, chunk_size=1000)
+    os.makedirs(archive.directory)
+    march = int(time.mktime((2024, 3, 1, 0, 0, 0, 0, 0, -1)))
+    moved = archiver.archive_months(now)
+    assert moved == sum(1 for row in rows if row[1] < march) and sorted(archive.months) == ['2024-01', '2024-02']
+    assert db.execute(f'SELECT MIN(ts) FROM {TABLE}').fetchone()[0] == march and archive.end == march
+    assert archiver.archive_months(now) == 0
+
+    # The archive (also after reloading the manifest) returns the same series and rows as the database did
+    for reader in (archive, Archive(archive.directory)):
+        (t, y) = reader.series('s1', 'humidity', first + 86400, march - 1)
+        expected = [(ts, h) for (s, ts, _, h, _) in rows if s == 's1' and first + 86400 < ts < march and h is not None]
+        assert list(zip(t, y)) == expected
+        chunks = list(reader.chunks(None, 0, now, chunk_size=1000))
+        assert max(len(chunk) for chunk in chunks) == 1000
+        assert [row for chunk in chunks for row in chunk] == [row for row in rows if row[1] < march]
+    assert reader.stats()['rows'] == moved and reader.stats()['bytes'] == 16 * moved
+
+    n = 100
+    begin = time.perf_counter()
+    for _ in range(n):
+        archive.series('s1', 'temperature', first, march)
+    print(f'two month series from archive: {1e3*(time.perf_counter()-begin)/n:8.2f} ms ({len(t)} points)')
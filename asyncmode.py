@@ -0,0 +1,157 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Optional asyncio runtime (runtime = asyncio in pi-home.conf). MQTT messages are
+# received with aiomqtt and timer events run as loop.call_at callbacks on a single
+# event loop, which sleeps exactly until the next timer or network event instead of
+# waking up every second. If uvicorn and asgiref are installed the web interface is
+# served on the same loop, otherwise it keeps running in a waitress thread.
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import namedtuple
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None
+
+try:
+    import uvicorn
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    uvicorn = None
+
+from sensors import SUBSCRIPTION
+from scheduler import Scheduler
+
+# Constants
+RECONNECT_DELAY = 5
+
+# Minimal stand-in for a paho MQTTMessage passed to the message handler
+Message = namedtuple('Message', 'topic payload')
+
+def available():
+    ''' Return True if the asyncio runtime can be used (requires aiomqtt)
+    '''
+    return aiomqtt is not None
+
+class LoopScheduler(Scheduler):
+    ''' Scheduler whose jobs run on an asyncio event loop instead of a runner thread.
+        A single loop.call_at timer is armed for the earliest job, and re-armed
+        (from any thread) when an earlier job is inserted. Actions run on the event
+        loop, so a long running job (e.g. database maintenance) starts its own thread.
+    '''
+    def __init__(self, loop, timefunc=time.time):
+        ''' Constructor
+        '''
+        Scheduler.__init__(self, timefunc)
+        self.loop = loop
+        self.timer = None
+
+    def run(self):
+        ''' Jobs are run by the event loop; arm the timer for the first job
+        '''
+        self.loop.call_soon_threadsafe(self._arm)
+
+    def _wake(self):
+        self.loop.call_soon_threadsafe(self._arm)
+
+    def _arm(self):
+        ''' Run due jobs and set the loop timer for the next one (runs in the loop thread)
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        delay = self.run_pending()
+        if delay is not None and not self.stopped:
+            self.timer = self.loop.call_at(self.loop.time() + delay, self._arm)
+
+class Publisher:
+    ''' Stand-in for paho's client.publish in the asyncio runtime. Messages may be
+        published from any thread; they are queued and sent by the MQTT task while connected.
+    '''
+    def __init__(self, loop):
+        ''' Constructor
+        '''
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.mids = itertools.count(1)
+        self.on_publish = None      # called as in paho once a message has been published
+
+    def publish(self, topic, payload, qos=0):
+        ''' Queue a message and return (rc, mid) like paho
+        '''
+        mid = next(self.mids)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (mid, topic, payload, qos))
+        return (0, mid)
+
+    async def send(self, client):
+        ''' Send queued messages with a connected aiomqtt client (until cancelled)
+        '''
+        while True:
+            (mid, topic, payload, qos) = await self.queue.get()
+            await client.publish(topic, payload, qos=qos)
+            if self.on_publish is not None:
+                self.on_publish(self, None, mid)
+
+async def mqtt_loop(events, publisher, broker_ip, broker_port, keepalive, qos):
+    ''' Receive MQTT messages and pass them to the message handler, reconnecting if the connection is lost
+    '''
+    while True:
+        try:
+            async with aiomqtt.Client(broker_ip, broker_port, keepalive=keepalive) as client:
+                await client.subscribe(SUBSCRIPTION, qos=qos)
+                logging.info(f'MQTT client connected to {broker_ip} on port {broker_port}, subscribed to: {SUBSCRIPTION}')
+                sender = asyncio.create_task(publisher.send(client))
+                try:
+                    async for message in client.messages:
+                        events.mqtt_message_handler(client, None, Message(message.topic.value, message.payload))
+                finally:
+                    sender.cancel()
+        except aiomqtt.MqttError as e:
+            logging.error(f'MQTT connection error: {e}; reconnecting in {RECONNECT_DELAY} seconds')
+            await asyncio.sleep(RECONNECT_DELAY)
+
+async def serve_web(server):
+    ''' Serve the flask app of a FlaskThread on the event loop with uvicorn if installed,
+        otherwise start the FlaskThread (waitress) as in the threaded runtime
+    '''
+    if uvicorn is None:
+        server.start()
+        return
+    config = uvicorn.Config(WsgiToAsgi(server.app), host='0.0.0.0', port=server.port, log_level='warning')
+    await uvicorn.Server(config).serve()
+
+async def run(events, server, publisher, broker_ip, broker_port, keepalive, qos):
+    ''' Run the MQTT client and web interface until cancelled
+    '''
+    events.scheduler.run()
+    await asyncio.gather(mqtt_loop(events, publisher, broker_ip, broker_port, keepalive, qos), serve_web(server))
+
+# Self test code
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    scheduler = LoopScheduler(loop)
+    calls = []
+    scheduler.enter(0.2, 1, calls.append, ('second',))
+    first = scheduler.enter(0.1, 1, calls.append, ('first',))
+    scheduler.enter(0.05, 1, calls.append, ('cancelled',), name='job')
+    scheduler.cancel('job')
+    assert [job.argument for job in scheduler.queue] == [('first',), ('second',)]
+    scheduler.run()
+    loop.run_until_complete(asyncio.sleep(0.3))
+    assert calls == ['first', 'second'] and scheduler.empty()
+    try:
+        scheduler.cancel(first)
+        assert False
+    except ValueError:
+        pass
+    loop.close()
@@ -0,0 +1,118 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+# Constants
+CACHE_SIZE = 256
+
+class CachedResponse:
+    ''' A cached response body with its mimetype, extra headers and entity tag
+    '''
+    __slots__ = ('body', 'mimetype', 'headers', 'etag')
+
+    def __init__(self, body, mimetype, headers=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or {}
+        self.etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+
+class ResponseCache:
+    ''' In-process LRU cache of chart payloads keyed by request parameters.
+        Entries are grouped by sensor so that new readings written for a sensor
+        invalidate only the entries for that sensor. Each invalidation also advances
+        the sensor's generation, so a response computed from readings older than
+        the latest write is not stored.
+    '''
+    def __init__(self, size=CACHE_SIZE):
+        ''' Constructor
+        '''
+        self.size = size
+        self.entries = OrderedDict()
+        self.keys_by_sensor = {}
+        self.generations = {}
+        self.lock = Lock()
+
+        # Counters to monitor the effectiveness of the cache
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def get(self, key):
+        ''' Return the cached response for key or None
+        '''
+        with self.lock:
+            response = self.entries.get(key)
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return response
+
+    def generation(self, sensor):
+        ''' Return the sensor's generation; read it before querying the readings of a response
+        '''
+        with self.lock:
+            return self.generations.get(sensor, 0)
+
+    def put(self, key, sensor, generation, response):
+        ''' Store a response for a sensor, evicting the least recently used entry if full.
+            Keys are tuples whose first element is the sensor name. The response is not stored
+            if the sensor was invalidated since generation was read.
+        '''
+        with self.lock:
+            if self.generations.get(sensor, 0) != generation:
+                self.stale += 1
+                return
+            self.entries[key] = response
+            self.entries.move_to_end(key)
+            self.keys_by_sensor.setdefault(sensor, set()).add(key)
+            while len(self.entries) > self.size:
+                (old, _) = self.entries.popitem(last=False)
+                self.keys_by_sensor[old[0]].discard(old)
+                self.evictions += 1
+
+    def invalidate(self, sensors):
+        ''' Drop all entries for the given sensors (called after new readings are written)
+        '''
+        with self.lock:
+            for sensor in sensors:
+                self.generations[sensor] = self.generations.get(sensor, 0) + 1
+                for key in self.keys_by_sensor.pop(sensor, ()):
+                    if self.entries.pop(key, None) is not None:
+                        self.invalidations += 1
+
+    def stats(self):
+        ''' Return a dictionary of the cache counters
+        '''
+        return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations, 'stale': self.stale}
+
+# Self test code
+if __name__ == '__main__':
+    cache = ResponseCache(size=2)
+    assert cache.get(('s1', 'a')) is None
+    cache.put(('s1', 'a'), 's1', 0, CachedResponse(b'one', 'text/plain'))
+    cache.put(('s2', 'b'), 's2', 0, CachedResponse(b'two', 'text/plain'))
+    assert cache.get(('s1', 'a')).body == b'one'
+    cache.put(('s2', 'c'), 's2', cache.generation('s2'), CachedResponse(b'three', 'text/plain'))
+    assert cache.get(('s2', 'b')) is None and cache.evictions == 1
+    cache.invalidate(['s1'])
+    assert cache.get(('s1', 'a')) is None and cache.get(('s2', 'c')) is not None
+    # A response computed before an invalidation of its sensor is not stored
+    generation = cache.generation('s1')
+    cache.invalidate(['s1'])
+    cache.put(('s1', 'a'), 's1', generation, CachedResponse(b'old', 'text/plain'))
+    assert cache.get(('s1', 'a')) is None and cache.generation('s1') == generation + 1
+    assert cache.stats() == {'entries': 1, 'size': 2, 'hits': 2, 'misses': 4, 'evictions': 1, 'invalidations': 1, 'stale': 1}
+    assert CachedResponse(b'x', 'a').etag == CachedResponse(b'x', 'b').etag != CachedResponse(b'y', 'a').etag
@@ -0,0 +1,173 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Confirmation of device commands. Each command sent to zigbee2mqtt/<device>/set is
+# matched with the next state report the device publishes on zigbee2mqtt/<device>.
+# The round-trip time is recorded in a latency histogram per device; commands that are
+# not confirmed within a timeout are resent a limited number of times. The state last
+# reported by each device is kept so the web interface can show the real device state.
+
+import bisect
+import logging
+import time
+from threading import Lock
+
+# Constants
+COMMAND_TIMEOUT = 5.0
+COMMAND_RETRIES = 2
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)    # upper bounds in seconds
+
+class PendingCommand:
+    ''' A command sent to a device and waiting for a matching state report
+    '''
+    __slots__ = ('expected', 'resend', 'start', 'attempts')
+
+    def __init__(self, expected, resend, start):
+        self.expected = expected
+        self.resend = resend
+        self.start = start
+        self.attempts = 1
+
+class CommandTracker:
+    ''' Correlates commands sent to devices with their state reports, with latency
+        histograms per device and bounded retries of unconfirmed commands
+    '''
+    def __init__(self, scheduler, timeout=COMMAND_TIMEOUT, retries=COMMAND_RETRIES, buckets=LATENCY_BUCKETS):
+        ''' Constructor: timeouts are scheduled as named jobs on the scheduler
+        '''
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.retries = retries
+        self.buckets = buckets
+        self.lock = Lock()
+        self.pending = {}           # device -> PendingCommand
+        self.confirmed = {}         # device -> last state reported by the device
+        self.histograms = {}        # device -> counts for each bucket (the last one counts slower replies)
+        self.latency_sum = {}       # device -> total latency of confirmed commands (seconds)
+
+        # Counters of commands sent, confirmed, resent and given up on
+        self.sent_count = 0
+        self.confirmed_count = 0
+        self.retry_count = 0
+        self.timeout_count = 0
+
+    def sent(self, device, command, resend):
+        ''' Record a command (dictionary) sent to a device; resend() publishes it to the device again.
+            Only the state is matched if the command sets one (other settings may be reported rounded),
+            otherwise the settings sent; other fields of the report are ignored.
+        '''
+        expected = {'state': command['state']} if 'state' in command else dict(command)
+        with self.lock:
+            self.pending[device] = PendingCommand(expected, resend, time.monotonic())
+            self.sent_count += 1
+            self.scheduler.enter(self.timeout, 1, self.timeout_event, (device,), name=f'command:{device}')
+
+    def on_report(self, device, status):
+        ''' Handle a state report (dictionary) published by a device
+        '''
+        with self.lock:
+            self.confirmed.setdefault(device, {}).update(status)
+            command = self.pending.get(device)
+            if command is None or {key: status.get(key) for key in command.expected} != command.expected:
+                return
+            del self.pending[device]
+            # Remove the timeout while holding the lock, so it cannot resend a confirmed command
+            self.scheduler.discard(f'command:{device}')
+            latency = time.monotonic() - command.start
+            histogram = self.histograms.setdefault(device, [0] * (len(self.buckets) + 1))
+            histogram[bisect.bisect_left(self.buckets, latency)] += 1
+            self.latency_sum[device] = self.latency_sum.get(device, 0.0) + latency
+            self.confirmed_count += 1
+        logging.debug('%s confirmed %s in %.1f ms (attempt %d)', device, command.expected, 1000*latency, command.attempts)
+
+    def timeout_event(self, device):
+        ''' Scheduler handler: resend an unconfirmed command or give up after the retries
+        '''
+        with self.lock:
+            command = self.pending.get(device)
+            if command is None:
+                return      # confirmed while this timeout was due
+            give_up = command.attempts > self.retries
+            if give_up:
+                del self.pending[device]
+                self.timeout_count += 1
+            else:
+                command.attempts += 1
+                self.retry_count += 1
+                self.scheduler.enter(self.timeout, 1, self.timeout_event, (device,), name=f'command:{device}')
+        if give_up:
+            logging.warning(f'{device} did not confirm {command.expected} after {command.attempts} attempts')
+            return
+        logging.info(f'{device} did not confirm {command.expected}; resending (attempt {command.attempts})')
+        command.resend()
+
+    def device_state(self, device):
+        ''' Return True/False if a device last reported it is on/off, or None if unknown
+        '''
+        state = self.confirmed.get(device, {}).get('state')
+        return None if state is None else state == 'ON'
+
+    def group_state(self, devices):
+        ''' Return True/False if all devices last reported they are on/off, or None if unknown or mixed
+        '''
+        states = {self.device_state(device) for device in devices}
+        return states.pop() if len(states) == 1 else None
+
+    def is_pending(self, device):
+        return device in self.pending
+
+    def stats(self):
+        ''' Return a dictionary of the counters and the latency histogram of each device
+        '''
+        with self.lock:
+            devices = {device: {'histogram': dict(zip([str(b) for b in self.buckets] + ['inf'], histogram)),
+                                'mean_ms': 1000*self.latency_sum[device]/sum(histogram)}
+                       for (device, histogram) in self.histograms.items()}
+            return {'sent': self.sent_count, 'confirmed': self.confirmed_count, 'retries': self.retry_count,
+                    'timeouts': self.timeout_count, 'pending': len(self.pending), 'devices': devices}
+
+# Self test code
+if __name__ == '__main__':
+    from scheduler import Scheduler
+    scheduler = Scheduler()
+    tracker = CommandTracker(scheduler, timeout=0.05, retries=1)
+    resent = []
+
+    # A matching report confirms the command and removes its timeout
+    tracker.sent('bulb1', {'state': 'ON', 'brightness': 200}, lambda: resent.append('bulb1'))
+    tracker.on_report('bulb1', {'state': 'OFF', 'linkquality': 80})     # stale report: still pending
+    assert tracker.is_pending('bulb1') and tracker.device_state('bulb1') is False
+    tracker.on_report('bulb1', {'state': 'ON', 'brightness': 199})
+    assert not tracker.is_pending('bulb1') and scheduler.empty()
+    assert tracker.device_state('bulb1') is True and tracker.stats()['devices']['bulb1']['histogram']['0.05'] == 1
+
+    # Unconfirmed commands are resent, then given up
+    tracker.sent('bulb2', {'state': 'ON'}, lambda: resent.append('bulb2'))
+    scheduler.run_pending()
+    time.sleep(0.06)
+    scheduler.run_pending()
+    assert resent == ['bulb2'] and tracker.is_pending('bulb2')
+    time.sleep(0.06)
+    scheduler.run_pending()
+    assert not tracker.is_pending('bulb2') and scheduler.empty()
+    stats = tracker.stats()
+    assert (stats['sent'], stats['confirmed'], stats['retries'], stats['timeouts']) == (2, 1, 1, 1)
+    assert tracker.group_state(['bulb1', 'bulb2']) is None
+    tracker.on_report('bulb2', {'state': 'ON'})
+    assert tracker.group_state(['bulb1', 'bulb2']) is True
+
+    # Commands without a state match on the settings sent; other reported fields are ignored
+    tracker.sent('bulb3', {'brightness': 100}, lambda: resent.append('bulb3'))
+    tracker.on_report('bulb3', {'state': 'ON', 'brightness': 100, 'color_temp': 300, 'linkquality': 90})
+    assert not tracker.is_pending('bulb3') and scheduler.empty()
+
+    # A timeout that fires after the confirmation does nothing
+    tracker.sent('bulb4', {'state': 'OFF'}, lambda: resent.append('bulb4'))
+    tracker.on_report('bulb4', {'state': 'OFF'})
+    tracker.timeout_event('bulb4')
+    assert 'bulb4' not in resent and scheduler.empty()
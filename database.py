@@ -0,0 +1,576 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import logging
+import sqlite3
+import queue
+import time
+from threading import Thread, Event, Lock
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from datetime import datetime
+from metrics import REGISTRY
+
+# Constants
+TABLE = 'SensorData'
+STAGING_TABLE = 'Incoming'
+HOURLY_TABLE = 'SensorDataHourly'
+DAILY_TABLE = 'SensorDataDaily'
+METRICS = ('temperature', 'humidity', 'pressure')
+SCHEMA_VERSION = 3
+MIGRATION_CHUNK_SIZE = 50000
+FLUSH_SIZE = 500
+FLUSH_INTERVAL = 5.0
+QUEUE_SIZE = 10000
+RETENTION_DAYS = 365
+RETENTION_PERIOD = 3600
+RETENTION_CHUNK_SIZE = 5000
+RETENTION_PAUSE = 0.05
+VACUUM_PAGES = 1000
+READ_POOL_SIZE = 4
+LOCK_TIMEOUT = 30           # seconds a connection waits for another connection's write lock
+RETRY_DELAY = 1.0
+SHUTDOWN_RETRIES = 5
+
+# Default connection settings; see https://www.sqlite.org/pragma.html
+PRAGMAS = {'cache_size': -8000, 'mmap_size': 33554432, 'synchronous': 'NORMAL'}
+
+# Metrics of the database writer
+DB_INSERT_SECONDS = REGISTRY.histogram('pihome_db_insert_seconds', 'Time taken to insert a batch of readings and update the rollups')
+DB_COMMIT_SECONDS = REGISTRY.histogram('pihome_db_commit_seconds', 'Time taken to commit a batch of readings')
+
+def apply_pragmas(db, pragmas):
+    ''' Apply a dictionary of per-connection pragma settings
+    '''
+    for (name, value) in pragmas.items():
+        db.execute(f'PRAGMA {name} = {value}').fetchall()
+
+def create_schema(db):
+    ''' Create the current version of the database schema.
+        Readings are keyed by sensor and integer epoch timestamp (UTC seconds) and
+        stored in a WITHOUT ROWID table so that a range of readings for one sensor
+        is clustered together on disk. A separate index on ts serves retention.
+    '''
+    db.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} (sensor TEXT NOT NULL, ts INTEGER NOT NULL, '
+               'temperature REAL, humidity REAL, pressure REAL, PRIMARY KEY (sensor, ts)) WITHOUT ROWID')
+    db.execute(f'CREATE INDEX IF NOT EXISTS {TABLE}_ts ON {TABLE} (ts)')
+
+    # Rollup tables hold the min, max, sum and count of each metric per sensor per hour and per day
+    columns = ', '.join(f'{m}_min REAL, {m}_max REAL, {m}_sum REAL, {m}_count INTEGER NOT NULL DEFAULT 0' for m in METRICS)
+    for table in (HOURLY_TABLE, DAILY_TABLE):
+        db.execute(f'CREATE TABLE IF NOT EXISTS {table} (sensor TEXT NOT NULL, bucket INTEGER NOT NULL, '
+                   f'{columns}, PRIMARY KEY (sensor, bucket)) WITHOUT ROWID')
+
+def hour_bucket(ts):
+    ''' Return the start of the hour containing epoch time ts
+    '''
+    return ts - ts % 3600
+
+def day_bucket(ts):
+    ''' Return the start of the local calendar day containing epoch time ts
+    '''
+    return int(time.mktime(time.localtime(ts)[:3] + (0, 0, 0, 0, 0, -1)))
+
+# SQL expressions matching hour_bucket() and day_bucket()
+BUCKET_SQL = {HOURLY_TABLE: 'ts - ts % 3600',
+              DAILY_TABLE: "CAST(strftime('%s', date(ts, 'unixepoch', 'localtime'), 'utc') AS INTEGER)"}
+
+# Merge a partial rollup row into an existing one. SQLite's scalar min(), max() and +
+# return NULL if any argument is NULL, so fall back to whichever value is present.
+ROLLUP_UPSERT = '''INSERT INTO {table} VALUES (?,?,{placeholders}) ON CONFLICT (sensor, bucket) DO UPDATE SET ''' + \
+    ', '.join(f'{m}_min = coalesce(min({m}_min, excluded.{m}_min), {m}_min, excluded.{m}_min), '
+              f'{m}_max = coalesce(max({m}_max, excluded.{m}_max), {m}_max, excluded.{m}_max), '
+              f'{m}_sum = coalesce({m}_sum + excluded.{m}_sum, {m}_sum, excluded.{m}_sum), '
+              f'{m}_count = {m}_count + excluded.{m}_count' for m in METRICS)
+HOURLY_UPSERT = ROLLUP_UPSERT.format(table=HOURLY_TABLE, placeholders=','.join('?' * 4*len(METRICS)))
+DAILY_UPSERT = ROLLUP_UPSERT.format(table=DAILY_TABLE, placeholders=','.join('?' * 4*len(METRICS)))
+
+def rollup(batch, bucket):
+    ''' Aggregate a batch of (sensor, ts, temperature, humidity, pressure) rows into
+        rollup rows of (sensor, bucket, [min, max, sum, count] for each metric)
+    '''
+    buckets = {}
+    for row in batch:
+        key = (row[0], bucket(row[1]))
+        agg = buckets.get(key)
+        if agg is None:
+            agg = buckets[key] = [None, None, None, 0] * len(METRICS)
+        for i, value in enumerate(row[2:]):
+            if value is None:
+                continue
+            j = 4*i
+            if agg[j+3] == 0:
+                agg[j:j+4] = [value, value, value, 1]
+            else:
+                agg[j] = min(agg[j], value)
+                agg[j+1] = max(agg[j+1], value)
+                agg[j+2] += value
+                agg[j+3] += 1
+    return [key + tuple(agg) for key, agg in buckets.items()]
+
+def migrate(database, legacy_sensor):
+    ''' Bring the database schema up to SCHEMA_VERSION, migrating existing data in place.
+        Version 1 stored a TEXT local datetime and no sensor name; those rows are
+        copied in chunks into the version 2 table under the name legacy_sensor.
+        An interrupted migration resumes from the renamed version 1 table.
+        The database is also switched to WAL journal mode so readers never block the writer.
+    '''
+    db = sqlite3.connect(database)
+    try:
+        db.execute('PRAGMA journal_mode = WAL').fetchall()
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        if TABLE in tables and 'datetime' in [row[1] for row in db.execute(f'PRAGMA table_info({TABLE})')]:
+            db.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_v1')
+            db.commit()
+            tables.append(f'{TABLE}_v1')
+        with db:
+            create_schema(db)
+        if f'{TABLE}_v1' in tables:
+            migrate_v1(db, legacy_sensor)
+        if version < 3:
+            migrate_v2(db)
+        db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        logging.info(f'Database schema is now at version {SCHEMA_VERSION}')
+    finally:
+        db.close()
+
+def migrate_v1(db, legacy_sensor):
+    ''' Copy version 1 rows (local datetime text) into the version 2 table
+    '''
+    (first, last) = db.execute(f'SELECT MIN(rowid), MAX(rowid) FROM {TABLE}_v1').fetchone()
+    logging.info(f'Migrating {TABLE} from schema version 1 (rows {first} to {last}) for sensor {legacy_sensor}...')
+    if first is not None:
+        start = time.monotonic()
+        for low in range(first, last+1, MIGRATION_CHUNK_SIZE):
+            with db:
+                db.execute(f"INSERT OR REPLACE INTO {TABLE} SELECT ?, CAST(strftime('%s', datetime, 'utc') AS INTEGER), "
+                           f"temperature, humidity, pressure FROM {TABLE}_v1 WHERE rowid >= ? AND rowid < ?",
+                           (legacy_sensor, low, low+MIGRATION_CHUNK_SIZE))
+            done = min(low+MIGRATION_CHUNK_SIZE, last+1) - first
+            logging.info(f'Migrated {done} of {last-first+1} rows ({100*done/(last-first+1):.0f}%) in {time.monotonic()-start:.1f} seconds')
+    with db:
+        db.execute(f'DROP TABLE {TABLE}_v1')
+
+def migrate_v2(db):
+    ''' Populate the rollup tables (added in version 3) from existing readings
+    '''
+    aggregates = ', '.join(f'min({m}), max({m}), sum({m}), count({m})' for m in METRICS)
+    for table, bucket in BUCKET_SQL.items():
+        logging.info(f'Building rollup table {table} from {TABLE}...')
+        start = time.monotonic()
+        with db:
+            db.execute(f'DELETE FROM {table}')
+            count = db.execute(f'INSERT INTO {table} SELECT sensor, {bucket} AS b, {aggregates} FROM {TABLE} GROUP BY sensor, b').rowcount
+        logging.info(f'Built {count} rows in {table} in {time.monotonic()-start:.1f} seconds')
+
+class DatabaseWriter(Thread):
+    ''' Write-behind ingestion stage for sensor readings.
+        Handlers put readings on a bounded in-memory queue and this thread drains
+        the queue into SQLite, using a single transaction for each flush window.
+    '''
+    def __init__(self, database, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE, pragmas=PRAGMAS):
+        ''' Constructor
+        '''
+        Thread.__init__(self, name='DatabaseWriter', daemon=True)
+        self.database = database
+        self.pragmas = pragmas
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = Event()
+
+        # Functions called with the set of sensors written after each flush
+        self.listeners = []
+
+        # Backpressure counters (read by other threads for display only)
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.duplicates = 0
+        self.flushes = 0
+        self.retries = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def put(self, sensor, temperature, humidity, pressure, ts=None):
+        ''' Queue a reading taken at epoch time ts (default: now) to be written; never blocks
+            the calling thread. Returns False (and counts the drop) if the queue is full.
+        '''
+        row = (sensor, int(time.time()) if ts is None else ts, temperature, humidity, pressure)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f'Database write queue full, reading dropped ({self.dropped} dropped in total)')
+            return False
+        self.enqueued += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def run(self):
+        ''' Drain the queue into the database until stopped
+        '''
+        self.connect()
+        while not self.stop_event.is_set():
+            batch = self.collect()
+            if batch:
+                self.write(batch)
+        # Final flush of anything still queued at shutdown
+        batch = self.drain()
+        while batch:
+            self.write(batch)
+            batch = self.drain()
+        self.db.close()
+        logging.info(f'Database writer stopped: {self.written} rows written in {self.flushes} flushes, {self.dropped} dropped')
+
+    def connect(self, timeout=LOCK_TIMEOUT):
+        ''' Open the writer's connection; it waits as long as the maintenance jobs for a write lock.
+            New readings are staged in a temporary table before they are inserted.
+        '''
+        self.db = sqlite3.connect(self.database, timeout=timeout)
+        apply_pragmas(self.db, self.pragmas)
+        self.db.execute(f'CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} (sensor TEXT NOT NULL, ts INTEGER NOT NULL, '
+                        'temperature REAL, humidity REAL, pressure REAL, PRIMARY KEY (sensor, ts)) WITHOUT ROWID')
+
+    def write(self, batch):
+        ''' Flush a batch, retrying while the database is locked or busy. Once stopping,
+            the batch is given up after SHUTDOWN_RETRIES retries.
+        '''
+        attempts = 0
+        while not self.flush(batch):
+            attempts += 1
+            self.retries += 1
+            if self.stop_event.is_set() and attempts >= SHUTDOWN_RETRIES:
+                self.errors += 1
+                logging.error(f'Database flush of {len(batch)} rows abandoned at shutdown after {attempts} retries')
+                return
+            time.sleep(RETRY_DELAY)
+
+    def collect(self):
+        ''' Wait for the first reading, then gather more until the batch is full
+            or the flush interval has expired
+        '''
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size and not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def drain(self):
+        ''' Return up to a full batch of queued readings without waiting
+        '''
+        batch = []
+        while len(batch) < self.flush_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        ''' Write a batch of readings in a single transaction. A reading for a (sensor, ts)
+            that is already stored (e.g. written again after a restart) is skipped.
+            Returns False if the batch should be retried (e.g. the database is locked);
+            a batch that fails with any other error is dropped.
+        '''
+        start = time.perf_counter()
+        try:
+            # Stage the batch, drop readings already stored, then insert the rest
+            self.db.executemany(f'INSERT OR IGNORE INTO {STAGING_TABLE} VALUES (?,?,?,?,?)', batch)
+            self.db.execute(f'DELETE FROM {STAGING_TABLE} WHERE EXISTS (SELECT 1 FROM {TABLE} '
+                            f'WHERE {TABLE}.sensor = {STAGING_TABLE}.sensor AND {TABLE}.ts = {STAGING_TABLE}.ts)')
+            self.db.execute(f'INSERT INTO {TABLE} SELECT * FROM {STAGING_TABLE}')
+            rows = self.db.execute(f'SELECT * FROM {STAGING_TABLE}').fetchall()
+            self.db.execute(f'DELETE FROM {STAGING_TABLE}')
+            # Update the hourly and daily rollups incrementally from the rows inserted, so each reading is counted once
+            self.db.executemany(HOURLY_UPSERT, rollup(rows, hour_bucket))
+            self.db.executemany(DAILY_UPSERT, rollup(rows, day_bucket))
+            inserted = time.perf_counter()
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            self.db.rollback()
+            logging.warning(f'Database flush of {len(batch)} rows failed, will retry: {e}')
+            return False
+        except sqlite3.Error as e:
+            self.db.rollback()
+            self.errors += 1
+            logging.error(f'Database flush of {len(batch)} rows failed: {e}')
+            return True
+        DB_INSERT_SECONDS.observe(inserted - start)
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - inserted)
+        self.written += len(rows)
+        self.duplicates += len(batch) - len(rows)
+        self.flushes += 1
+        logging.debug('%d records inserted.', len(rows))
+        sensors = {row[0] for row in batch}
+        for listener in self.listeners:
+            listener(sensors)
+        return True
+
+    def add_listener(self, listener):
+        ''' Register a function to be called with the set of sensors written by each flush
+        '''
+        self.listeners.append(listener)
+
+    def stop(self, timeout=None):
+        ''' Stop the writer thread after a final flush of queued readings
+        '''
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        ''' Return a dictionary of the backpressure counters
+        '''
+        return {'queued': self.queue.qsize(), 'max_depth': self.max_depth, 'enqueued': self.enqueued,
+                'written': self.written, 'duplicates': self.duplicates, 'flushes': self.flushes, 'retries': self.retries, 'dropped': self.dropped, 'errors': self.errors}
+
+class ReadPool:
+    ''' Bounded pool of read-only connections shared by the web server threads.
+        Each request borrows a connection for its own exclusive use and returns it
+        afterwards, so connections are never used by two threads at once.
+    '''
+    def __init__(self, database, size=READ_POOL_SIZE, pragmas=PRAGMAS):
+        ''' Constructor
+        '''
+        self.uri = f'file:{pathname2url(database)}?mode=ro'
+        self.size = size
+        self.pragmas = pragmas
+        self.pool = queue.LifoQueue()
+        self.created = 0
+        self.lock = Lock()
+
+    @contextmanager
+    def connection(self):
+        ''' Context manager lending a read-only connection, waiting for one if all are in use
+        '''
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.pool.put(db)
+
+    def acquire(self):
+        ''' Take an idle connection, opening a new one if the pool is not yet full
+        '''
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.pool.get()
+        return self.open()
+
+    def open(self):
+        ''' Open a new read-only connection outside the pool (e.g. for a long running export);
+            the caller closes it
+        '''
+        db = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        apply_pragmas(db, self.pragmas)
+        db.execute('PRAGMA query_only = 1')
+        return db
+
+class Retention:
+    ''' Scheduled compaction job which prunes expired sensor readings.
+        Rows are deleted in bounded chunks, each in its own transaction, so the
+        write lock is only ever held briefly and the writer thread is not stalled.
+        Pruning runs in its own thread so the pauses between chunks never delay
+        other scheduled jobs.
+    '''
+    def __init__(self, scheduler, database, days=RETENTION_DAYS, period=RETENTION_PERIOD, chunk_size=RETENTION_CHUNK_SIZE, vacuum=False):
+        ''' Constructor
+        '''
+        self.scheduler = scheduler
+        self.database = database
+        self.days = days
+        self.period = period
+        self.chunk_size = chunk_size
+        self.vacuum = vacuum
+        self.thread = None
+
+    def start(self, delay=60):
+        ''' Schedule the first retention event
+        '''
+        self.scheduler.enter(delay, 2, self.retention_event, name='retention')
+        logging.info(f'Retention job scheduled every {self.period} seconds, keeping {self.days} days of readings')
+
+    def retention_event(self):
+        ''' Scheduler handler to periodically prune old readings
+        '''
+        # set next retention event
+        self.scheduler.enter(self.period, 2, self.retention_event, name='retention')
+        if self.thread is not None and self.thread.is_alive():
+            logging.warning('Retention job still running; skipping this run')
+            return
+        self.thread = Thread(target=self.run, name='Retention', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        ''' Prune old readings (in the retention thread)
+        '''
+        try:
+            self.prune()
+        except sqlite3.Error as e:
+            logging.error(f'Retention job failed: {e}')
+
+    def prune(self):
+        ''' Delete readings and rollups older than the retention period in chunks
+            and return the number of rows deleted
+        '''
+        cutoff = int(time.time()) - self.days*86400
+        db = sqlite3.connect(self.database, timeout=LOCK_TIMEOUT)
+        total = 0
+        start = time.monotonic()
+        try:
+            for (table, column) in ((TABLE, 'ts'), (HOURLY_TABLE, 'bucket'), (DAILY_TABLE, 'bucket')):
+                while True:
+                    with db:
+                        deleted = db.execute(f'DELETE FROM {table} WHERE (sensor, {column}) IN (SELECT sensor, {column} FROM {table} WHERE {column} < ? LIMIT ?)',
+                                             (cutoff, self.chunk_size)).rowcount
+                    total += deleted
+                    if deleted < self.chunk_size:
+                        break
+                    # Give the writer thread a chance to take the write lock between chunks
+                    time.sleep(RETENTION_PAUSE)
+            if self.vacuum:
+                self.incremental_vacuum(db)
+        finally:
+            db.close()
+        logging.info(f'Retention job deleted {total} records older than {datetime.fromtimestamp(cutoff)} in {time.monotonic()-start:.2f} seconds')
+        return total
+
+    def incremental_vacuum(self, db):
+        ''' Return a bounded number of free pages to the file system.
+            The first time this is used on an existing database, auto_vacuum
+            must be switched on which requires a one-off full VACUUM.
+        '''
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            logging.info('Enabling incremental auto_vacuum on database (one-off full VACUUM)...')
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute('VACUUM')
+        db.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+
+# Self test code
+if __name__ == '__main__':
+    import os, tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    # Version 1 rows are migrated into the version 2 schema
+    db = sqlite3.connect(path)
+    db.execute(f'CREATE TABLE {TABLE} (datetime TEXT NOT NULL, temperature double, humidity double, pressure double)')
+    db.executemany(f"INSERT INTO {TABLE} VALUES (datetime('now','localtime',?),?,?,?)", [(f'-{i} minutes', i, 50, None) for i in range(10)])
+    db.commit()
+    db.close()
+    migrate(path, 'test_sensor')
+    migrate(path, 'test_sensor')
+    db = sqlite3.connect(path)
+    assert db.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    rows = db.execute(f'SELECT sensor, ts, temperature FROM {TABLE} ORDER BY ts DESC').fetchall()
+    assert len(rows) == 10 and rows[0][0] == 'test_sensor' and rows[0][2] == 0
+    assert abs(rows[0][1] - time.time()) < 60
+    db.execute(f'DELETE FROM {TABLE}')
+    db.commit()
+    db.close()
+    writer = DatabaseWriter(path, flush_size=10, flush_interval=0.1, queue_size=50)
+    flushed = set()
+    writer.add_listener(flushed.update)
+    writer.start()
+    for i in range(25):
+        assert writer.put(f'sensor{i}', 20.0+i, 50.0, None)
+    writer.stop()
+    assert writer.written == 25
+    assert writer.flushes >= 3
+    assert writer.stats()['dropped'] == 0
+    assert flushed == {f'sensor{i}' for i in range(25)}
+    db = sqlite3.connect(path)
+    assert db.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0] == 25
+    assert db.execute(f'SELECT temperature_min, temperature_max, temperature_sum/temperature_count, pressure_count FROM {DAILY_TABLE} '
+                      "WHERE sensor = 'sensor3'").fetchone() == (23.0, 23.0, 23.0, 0)
+    # A reading written again for the same (sensor, ts) is skipped and not counted twice in the rollups
+    ts = db.execute(f"SELECT ts FROM {TABLE} WHERE sensor = 'sensor3'").fetchone()[0]
+    writer.connect()
+    assert writer.flush([('sensor3', ts, 99.0, None, None), ('sensor3', ts, 99.0, None, None)])
+    assert writer.duplicates == 2 and db.execute(f"SELECT temperature FROM {TABLE} WHERE sensor = 'sensor3'").fetchone()[0] == 23.0
+    assert db.execute(f'SELECT temperature_max, temperature_count FROM {DAILY_TABLE} '
+                      "WHERE sensor = 'sensor3'").fetchone() == (23.0, 1)
+    # A batch that finds the database locked is kept for a retry rather than dropped
+    writer.db.close()
+    writer.connect(timeout=0.1)
+    db.execute('BEGIN IMMEDIATE')
+    assert not writer.flush([('sensor3', ts + 1, 24.0, None, None)])
+    db.rollback()
+    assert writer.flush([('sensor3', ts + 1, 24.0, None, None)]) and writer.written == 26
+    writer.db.close()
+    # Read-only pooled connections see committed data but cannot write
+    pool = ReadPool(path, size=1)
+    with pool.connection() as reader:
+        assert reader.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0] == 26
+        try:
+            reader.execute(f'DELETE FROM {TABLE}')
+            assert False, 'read-only connection should not allow writes'
+        except sqlite3.OperationalError:
+            pass
+    with pool.connection() as again:
+        assert again is reader and pool.created == 1
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    db.close()
+    # Rollups built by the migration agree with rollups built incrementally
+    db = sqlite3.connect(':memory:')
+    create_schema(db)
+    now = int(time.time())
+    batch = [('s', now - 600*i, 20.0 + i % 7, None if i % 5 else 50.0, None) for i in range(500)]
+    db.executemany(HOURLY_UPSERT, rollup(batch[:250], hour_bucket))
+    db.executemany(HOURLY_UPSERT, rollup(batch[250:], hour_bucket))
+    db.executemany(DAILY_UPSERT, rollup(batch, day_bucket))
+    incremental = [db.execute(f'SELECT * FROM {t} ORDER BY bucket').fetchall() for t in (HOURLY_TABLE, DAILY_TABLE)]
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)', batch)
+    migrate_v2(db)
+    assert incremental == [db.execute(f'SELECT * FROM {t} ORDER BY bucket').fetchall() for t in (HOURLY_TABLE, DAILY_TABLE)]
+    db.close()
+    # A full queue drops readings rather than blocking
+    writer = DatabaseWriter(path, queue_size=2)
+    assert writer.put('a', 1, 2, 3) and writer.put('b', 1, 2, 3)
+    assert not writer.put('c', 1, 2, 3)
+    assert writer.dropped == 1
+    # Retention deletes expired rows in chunks and leaves recent rows alone
+    db = sqlite3.connect(path)
+    old = int(time.time()) - 400*86400
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)', [('old', old+i, 1, 2, 3) for i in range(25)])
+    db.commit()
+    retention = Retention(None, path, chunk_size=10, vacuum=True)
+    assert retention.prune() == 25
+    assert db.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0] == 26
+    assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    # The scheduled job prunes in its own thread without holding up the scheduler
+    from scheduler import Scheduler
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)', [('old', old+i, 1, 2, 3) for i in range(50)])
+    db.commit()
+    retention.scheduler = Scheduler()
+    begin = time.monotonic()
+    retention.retention_event()
+    assert time.monotonic() - begin < RETENTION_PAUSE and retention.scheduler.get('retention') is not None
+    retention.thread.join()
+    assert db.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0] == 26
+    db.close()
@@ -0,0 +1,444 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Device groups: any number of groups of Zigbee devices (bulbs, outlets, porch lights,
+# heaters, ...) that are switched together on a schedule. Each group is declared in a
+# [group:NAME] section of the configuration file, for example:
+#
+#   [group:porch]
+#   devices = porch1, porch2
+#   capabilities = state, brightness
+#   on_time = dusk
+#   off_time = 23:30
+#   brightness = 200
+#
+# All groups share one solar calendar and one scheduler; each group has a single
+# named scheduler job for its next on or off time.
+#
+# A command (state and settings combined in one JSON payload) is published once to
+# zigbee2mqtt/<zigbee_group>/set if the devices are also members of a zigbee2mqtt group
+# (set with zigbee_group = NAME), so that they switch together. Otherwise it is published
+# to each device without waiting for the previous publish to complete. The time until
+# all messages of a command have been sent (QoS 0) or acknowledged (QoS 1, 2) is logged.
+
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+# Constants
+FIXED = 0
+DUSK = 1
+DAWN = 2
+QOS = 0
+TOPIC_PREFIX = 'zigbee2mqtt/'
+SECTION_PREFIX = 'group:'
+
+# Messages registered as published before the command was tracked are forgotten beyond this number
+MAX_EARLY_ACKS = 1000
+
+# Settings that may be supported by the devices in a group and their valid range
+CAPABILITIES = {'state': None, 'brightness': (0, 254), 'color_temp': (150, 500)}
+
+def parse_time(spec):
+    ''' Parse a schedule time: "dusk", "dawn" or a fixed time "HH:MM".
+        Returns (mode, hour, minute); raises ValueError for an invalid time.
+    '''
+    spec = spec.strip().lower()
+    if spec == 'dusk':
+        return (DUSK, None, None)
+    if spec == 'dawn':
+        return (DAWN, None, None)
+    (hour, minute) = spec.split(':')
+    (hour, minute) = (int(hour), int(minute))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(spec)
+    return (FIXED, hour, minute)
+
+def format_time(schedule):
+    ''' Inverse of parse_time
+    '''
+    (mode, hour, minute) = schedule
+    if mode == DUSK:
+        return 'dusk'
+    if mode == DAWN:
+        return 'dawn'
+    return f'{hour:02}:{minute:02}'
+
+class PendingCommand:
+    ''' Message ids of a published command still waiting for completion
+    '''
+    __slots__ = ('description', 'start', 'remaining')
+
+    def __init__(self, description, start, remaining):
+        self.description = description
+        self.start = start
+        self.remaining = remaining
+
+class PublishTracker:
+    ''' Tracks the MQTT messages of each command by message id (using the client's
+        on_publish callback) and logs the time until all have been published
+    '''
+    def __init__(self):
+        ''' Constructor
+        '''
+        self.lock = Lock()
+        self.pending = {}       # message id -> PendingCommand
+        self.early = set()      # message ids published before the command was tracked
+        self.commands = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def track(self, description, start, mids):
+        ''' Track the message ids of a command whose first message was published at start (time.monotonic())
+        '''
+        with self.lock:
+            done = self.early.intersection(mids)
+            self.early -= done
+            command = PendingCommand(description, start, set(mids) - done)
+            if not command.remaining:
+                self.complete(command)
+            for mid in command.remaining:
+                self.pending[mid] = command
+
+    def on_publish(self, client, userdata, mid, *args):
+        ''' MQTT client on_publish callback: a message was sent (QoS 0) or acknowledged (QoS 1, 2)
+        '''
+        with self.lock:
+            command = self.pending.pop(mid, None)
+            if command is None:
+                # The callback can run before publish() has returned the message id
+                if len(self.early) >= MAX_EARLY_ACKS:
+                    self.early.clear()
+                self.early.add(mid)
+                return
+            command.remaining.discard(mid)
+            if not command.remaining:
+                self.complete(command)
+
+    def complete(self, command):
+        ''' Record and log the latency of a completed command (called with the lock held)
+        '''
+        latency = time.monotonic() - command.start
+        self.commands += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        logging.info('%s published in %.1f ms', command.description, 1000*latency)
+
+    def stats(self):
+        ''' Return a dictionary of the publish counters and latencies (in ms)
+        '''
+        return {'commands': self.commands, 'pending': len(self.pending),
+                'mean_ms': 1000*self.total_latency/self.commands if self.commands else None,
+                'max_ms': 1000*self.max_latency}
+
+class DeviceGroup:
+    ''' A named group of Zigbee devices that are switched on and off together,
+        either on request or by a timer at fixed times or at dusk/dawn
+    '''
+    def __init__(self, name, devices, capabilities, scheduler, client, calendar, on_time='dusk', off_time='dawn', timer=True, settings=None,
+                 zigbee_group=None, qos=QOS, tracker=None, commands=None):
+        ''' Constructor: capabilities is a subset of CAPABILITIES; settings holds initial
+            values for capabilities other than state (e.g. {'brightness': 254}).
+            Commands are published to the zigbee2mqtt group zigbee_group if set,
+            otherwise to each device, and tracked by a PublishTracker if one is given.
+            A CommandTracker (commands) confirms each command with the state reported by every device.
+        '''
+        unknown = set(capabilities) - set(CAPABILITIES)
+        if unknown:
+            raise ValueError(f'Unknown capabilities for group {name}: {", ".join(sorted(unknown))}')
+        self.name = name
+        self.devices = list(devices)
+        self.capabilities = set(capabilities) | {'state'}
+        self.scheduler = scheduler
+        self.client = client
+        self.calendar = calendar    # SolarCalendar shared by all groups
+        self.on_time = parse_time(on_time)
+        self.off_time = parse_time(off_time)
+        self.timer = timer
+        self.settings = {key: value for (key, value) in (settings or {}).items() if key in self.capabilities}
+        self.state = None       # unknown until the first command, so the first timer event always publishes
+        self.job_name = f'group:{name}'
+        self.qos = qos
+        self.tracker = tracker
+        self.commands = commands
+        self.zigbee_group = zigbee_group
+        if zigbee_group:
+            self.topics = [f'{TOPIC_PREFIX}{zigbee_group}/set']
+        else:
+            self.topics = [f'{TOPIC_PREFIX}{device}/set' for device in self.devices]
+
+        # Use a mutex so that the web interface and scheduler do not publish at the same time
+        self.lock = Lock()
+        logging.info(f'Group {name}: devices={", ".join(self.devices)} capabilities={", ".join(sorted(self.capabilities))}')
+
+    def start(self):
+        ''' Schedule the first timer event (if the timer is enabled)
+        '''
+        self.update_schedule()
+
+    def next_time(self, schedule, after=None):
+        ''' Return the next time after a datetime (default: now) for a (mode, hour, minute) schedule
+        '''
+        if after is None:
+            after = datetime.now()
+        (mode, hour, minute) = schedule
+        if mode == DUSK:
+            return self.calendar.next_dusk(after)
+        if mode == DAWN:
+            return self.calendar.next_dawn(after)
+        time = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        # If the time has already passed for today, return the time for tomorrow
+        if time <= after:
+            time += timedelta(days=1)
+        return time
+
+    def get_next_on_time(self):
+        return self.next_time(self.on_time)
+
+    def get_next_off_time(self):
+        return self.next_time(self.off_time)
+
+    def timer_event(self):
+        ''' Switch the group to the state it should now be in and schedule the next change.
+            The group should be on if its next scheduled change is to turn it off.
+        '''
+        now = datetime.now()
+        on_time = self.next_time(self.on_time, now)
+        off_time = self.next_time(self.off_time, now)
+        state = off_time < on_time
+        if state != self.state:
+            logging.info(f'*** Turning {self.name} {"ON" if state else "OFF"} at {now.strftime("%m/%d/%Y, %H:%M:%S")} ***')
+            self.set_state(state)
+        next_time = off_time if state else on_time
+        logging.info(f'Next event = {self.name} {"OFF" if state else "ON"} at: {next_time.strftime("%m/%d/%Y, %H:%M:%S")}')
+        self.scheduler.enterabs(next_time.timestamp(), 1, self.timer_event, name=self.job_name)
+
+    def update_schedule(self):
+        ''' Replace the timer event of this group after the timer or schedule changed
+        '''
+        self.scheduler.discard(self.job_name)
+        if self.timer:
+            self.timer_event()
+
+    def set_schedule(self, on_time=None, off_time=None):
+        ''' Change the on and/or off time ("dusk", "dawn" or "HH:MM") and reschedule
+        '''
+        if on_time is not None:
+            self.on_time = parse_time(on_time)
+        if off_time is not None:
+            self.off_time = parse_time(off_time)
+        logging.info(f'{self.name} schedule changed to: ON {format_time(self.on_time)}, OFF {format_time(self.off_time)}')
+        self.update_schedule()
+
+    def enable_timer(self):
+        ''' Enable timer control of the group and schedule the next timer event
+        '''
+        self.timer = True
+        self.update_schedule()
+        logging.info(f'Timer control of {self.name} ENABLED at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
+
+    def disable_timer(self):
+        ''' Disable timer control of the group and remove its timer event
+        '''
+        self.timer = False
+        self.update_schedule()
+        logging.info(f'Timer control of {self.name} DISABLED at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
+
+    def set_state(self, state):
+        ''' Turn the devices on (with the current settings) or off
+        '''
+        command = {'state': 'ON' if state else 'OFF'}
+        if state:
+            command.update(self.settings)
+        with self.lock:
+            self.publish(command)
+            self.state = state
+        logging.debug('%s turned %s', self.name, command['state'])
+
+    def set(self, capability, value):
+        ''' Change a setting such as brightness; applied now if the devices are on
+        '''
+        if capability not in self.capabilities or capability == 'state':
+            raise ValueError(f'{self.name} does not support {capability}')
+        (low, high) = CAPABILITIES[capability]
+        value = min(max(int(value), low), high)
+        with self.lock:
+            self.settings[capability] = value
+            if self.state:
+                self.publish({capability: value})
+        logging.info(f'{self.name} {capability} set to: {value}')
+
+    def publish(self, command):
+        ''' Send a command (dictionary of settings) to the zigbee2mqtt group or to every device.
+            Messages are queued by the MQTT client without waiting for each to be sent.
+        '''
+        payload = json.dumps(command)
+        start = time.monotonic()
+        mids = []
+        for topic in self.topics:
+            (rc, mid) = self.client.publish(topic, payload, qos=self.qos)
+            if rc != 0:
+                logging.error(f'MQTT publish return code: {rc}')
+            else:
+                mids.append(mid)
+        if self.tracker is not None:
+            self.tracker.track(f'{self.name} {payload} ({len(mids)} messages)', start, mids)
+        if self.commands is not None:
+            for device in self.devices:
+                # Unconfirmed commands are resent to the device itself, even if sent to a zigbee2mqtt group
+                topic = f'{TOPIC_PREFIX}{device}/set'
+                self.commands.sent(device, command, lambda topic=topic: self.client.publish(topic, payload, qos=self.qos))
+
+    def status(self):
+        ''' Return a dictionary describing the group for the web interface. The state is the last
+            state requested; confirmed and device_states are the states reported by the devices
+            (None if unknown, or if the devices of the group disagree).
+        '''
+        if self.commands is None:
+            (confirmed, device_states) = (None, {})
+        else:
+            confirmed = self.commands.group_state(self.devices)
+            device_states = {device: self.commands.device_state(device) for device in self.devices}
+        return {'name': self.name, 'devices': self.devices, 'capabilities': sorted(self.capabilities),
+                'state': self.state, 'confirmed': confirmed, 'device_states': device_states, 'timer': self.timer, 'settings': dict(self.settings),
+                'on_time': format_time(self.on_time), 'off_time': format_time(self.off_time),
+                'next_on': self.get_next_on_time(), 'next_off': self.get_next_off_time()}
+
+    def __str__(self):
+        return ', '.join(self.devices)
+
+def load_groups(conf, scheduler, client, calendar, tracker=None, commands=None):
+    ''' Create a DeviceGroup for every [group:NAME] section of a configuration.
+        If there are none, groups named "bulbs" and "outlets" are created from the
+        bulbs, brightness and outlets settings of the [pi-home] section.
+    '''
+    groups = {}
+    for section in conf.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):]
+        devices = [device.strip() for device in conf.get(section, 'devices', fallback='').split(',') if device.strip()]
+        capabilities = [c.strip() for c in conf.get(section, 'capabilities', fallback='state').split(',') if c.strip()]
+        settings = {c: conf.getint(section, c) for c in capabilities if c in CAPABILITIES and c != 'state' and conf.has_option(section, c)}
+        groups[name] = DeviceGroup(name, devices, capabilities, scheduler, client, calendar,
+                                   conf.get(section, 'on_time', fallback='dusk'), conf.get(section, 'off_time', fallback='dawn'),
+                                   conf.getboolean(section, 'timer', fallback=True), settings,
+                                   conf.get(section, 'zigbee_group', fallback=None), conf.getint(section, 'qos', fallback=QOS), tracker, commands)
+    if not groups:
+        # Settings from earlier versions: bulbs on at dusk and off at dawn, outlets on at dusk and off at 11PM
+        bulbs = [device.strip() for device in conf.get('pi-home', 'bulbs', fallback='').split(',') if device.strip()]
+        outlets = [device.strip() for device in conf.get('pi-home', 'outlets', fallback='').split(',') if device.strip()]
+        if bulbs:
+            groups['bulbs'] = DeviceGroup('bulbs', bulbs, ['state', 'brightness'], scheduler, client, calendar, 'dusk', 'dawn', True,
+                                          {'brightness': conf.getint('pi-home', 'brightness', fallback=254)}, tracker=tracker, commands=commands)
+        if outlets:
+            groups['outlets'] = DeviceGroup('outlets', outlets, ['state'], scheduler, client, calendar, 'dusk', '23:00', False, tracker=tracker, commands=commands)
+    return groups
+
+# Self test code
+if __name__ == '__main__':
+    import configparser
+    from scheduler import Scheduler
+
+    class Calendar:
+        def next_dusk(self, after):
+            dusk = after.replace(hour=18, minute=0, second=0, microsecond=0)
+            return dusk if dusk > after else dusk + timedelta(days=1)
+        def next_dawn(self, after):
+            dawn = after.replace(hour=7, minute=0, second=0, microsecond=0)
+            return dawn if dawn > after else dawn + timedelta(days=1)
+
+    class Client:
+        def __init__(self):
+            self.messages = []
+            self.on_publish = None
+        def publish(self, topic, payload, qos=0):
+            self.messages.append((topic, json.loads(payload)))
+            if qos == 0 and self.on_publish:
+                self.on_publish(self, None, len(self.messages))     # sent before publish returns
+            return (0, len(self.messages))
+
+    assert parse_time('Dusk') == (DUSK, None, None) and parse_time('23:05') == (FIXED, 23, 5)
+    assert format_time(parse_time('07:30')) == '07:30'
+    conf = configparser.ConfigParser()
+    conf.read_string('''
+[pi-home]
+bulbs = bulb1
+[group:porch]
+devices = porch1, porch2
+capabilities = state, brightness
+on_time = dusk
+off_time = 23:30
+brightness = 200
+[group:heater]
+devices = heater1
+on_time = 06:00
+off_time = 08:00
+timer = false
+''')
+    scheduler = Scheduler()
+    client = Client()
+    tracker = PublishTracker()
+    client.on_publish = tracker.on_publish
+    groups = load_groups(conf, scheduler, client, Calendar(), tracker)
+    assert sorted(groups) == ['heater', 'porch']
+    porch = groups['porch']
+    porch.start()
+    groups['heater'].start()
+    # The first timer event sends the scheduled state even if it is off (the devices may have been left on)
+    assert len(client.messages) == 2 and porch.state is not None and groups['heater'].state is None
+    # Only the porch timer is scheduled, as a single named job
+    assert [name for (_, name, _) in scheduler.snapshot()] == ['group:porch']
+    job_time = datetime.fromtimestamp(scheduler.get('group:porch').time)
+    assert job_time in (porch.get_next_on_time(), porch.get_next_off_time())
+
+    porch.set_state(True)
+    assert client.messages[-2:] == [('zigbee2mqtt/porch1/set', {'state': 'ON', 'brightness': 200}),
+                                    ('zigbee2mqtt/porch2/set', {'state': 'ON', 'brightness': 200})]
+    porch.set('brightness', 300)
+    assert porch.settings['brightness'] == 254 and client.messages[-1] == ('zigbee2mqtt/porch2/set', {'brightness': 254})
+    try:
+        groups['heater'].set('brightness', 10)
+        assert False
+    except ValueError:
+        pass
+    porch.set_schedule(off_time='dawn')
+    assert porch.status()['off_time'] == 'dawn' and len(scheduler.queue) == 1
+    porch.disable_timer()
+    assert scheduler.empty()
+
+    # A zigbee2mqtt group gets a single message; QoS 1 messages complete when acknowledged
+    conf['group:heater']['zigbee_group'] = 'heaters'
+    conf['group:heater']['qos'] = '1'
+    heater = load_groups(conf, scheduler, client, Calendar(), tracker)['heater']
+    commands = tracker.commands
+    heater.set_state(True)
+    assert client.messages[-1] == ('zigbee2mqtt/heaters/set', {'state': 'ON'})
+    assert tracker.commands == commands and tracker.stats()['pending'] == 1
+    tracker.on_publish(client, None, len(client.messages))
+    assert tracker.commands == commands + 1 and tracker.stats()['pending'] == 0 and not tracker.early
+
+    # Commands are confirmed by the state reported by each device and resent to devices that do not report
+    from commands import CommandTracker
+    commands = CommandTracker(scheduler, timeout=0.01, retries=1)
+    heater = load_groups(conf, scheduler, client, Calendar(), tracker, commands)['heater']
+    heater.set_state(False)
+    commands.on_report('heater1', {'state': 'ON'})
+    assert heater.status()['confirmed'] is True and commands.is_pending('heater1')
+    commands.on_report('heater1', {'state': 'OFF'})
+    assert heater.status()['device_states'] == {'heater1': False} and not commands.is_pending('heater1')
+    heater.set_state(True)
+    time.sleep(0.02)
+    scheduler.run_pending()
+    assert client.messages[-2:] == [('zigbee2mqtt/heaters/set', {'state': 'ON'}), ('zigbee2mqtt/heater1/set', {'state': 'ON'})]
+
+    # Groups from the settings of earlier versions
+    del conf['group:porch'], conf['group:heater']
+    assert list(load_groups(conf, scheduler, client, Calendar())) == ['bulbs']
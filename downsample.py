@@ -0,0 +1,210 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Downsampling of time series for plotting. Both methods keep a fixed number of
+# output points and, unlike taking every n-th row, preserve peaks and dips:
+#   lttb   - Largest-Triangle-Three-Buckets, keeps the visual shape of the series
+#   minmax - keeps the minimum and maximum of each bucket, so extremes are never lost
+# NumPy is used to vectorize the per-bucket work if it is installed.
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Constants
+CHUNK_SIZE = 5000
+
+def read_series(cursor, chunk_size=CHUNK_SIZE):
+    ''' Stream (x, y) rows from an executed cursor into compact arrays,
+        skipping rows with a missing value
+    '''
+    x = array('d')
+    y = array('d')
+    rows = cursor.fetchmany(chunk_size)
+    while rows:
+        for (t, v) in rows:
+            if v is not None:
+                x.append(t)
+                y.append(v)
+        rows = cursor.fetchmany(chunk_size)
+    return x, y
+
+def lttb(x, y, n):
+    ''' Downsample to n points using Largest-Triangle-Three-Buckets.
+        The first and last points are always kept.
+    '''
+    length = len(x)
+    if n >= length or n < 3:
+        return list(x), list(y)
+    if np is not None:
+        return _lttb_numpy(np.asarray(x, dtype=float), np.asarray(y, dtype=float), n)
+
+    out_x = [x[0]]
+    out_y = [y[0]]
+    every = (length - 2) / (n - 2)
+    a = 0
+    for i in range(n - 2):
+        # Average of the next bucket is the third point of the triangle
+        start = int((i + 1) * every) + 1
+        end = min(int((i + 2) * every) + 1, length)
+        count = end - start
+        avg_x = sum(x[start:end]) / count
+        avg_y = sum(y[start:end]) / count
+
+        # Pick the point in this bucket forming the largest triangle
+        ax = x[a]
+        ay = y[a]
+        max_area = -1.0
+        for j in range(int(i * every) + 1, start):
+            area = abs((ax - avg_x) * (y[j] - ay) - (ax - x[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                a_next = j
+        a = a_next
+        out_x.append(x[a])
+        out_y.append(y[a])
+    out_x.append(x[-1])
+    out_y.append(y[-1])
+    return out_x, out_y
+
+def _lttb_numpy(x, y, n):
+    ''' Vectorized LTTB: the triangle areas of a whole bucket are computed at once
+    '''
+    length = len(x)
+    every = (length - 2) / (n - 2)
+    edges = (np.arange(n - 1) * every).astype(int) + 1
+    edges[-1] = length - 1
+    selected = np.empty(n, dtype=int)
+    selected[0] = 0
+    selected[-1] = length - 1
+    a = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < n - 1 else length
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return x[selected].tolist(), y[selected].tolist()
+
+def minmax(x, y, n):
+    ''' Downsample to at most n points by keeping the minimum and maximum
+        of each of n/2 equal-count buckets (in time order)
+    '''
+    length = len(x)
+    buckets = n // 2
+    if n >= length or buckets < 1:
+        return list(x), list(y)
+    if np is not None:
+        return _minmax_numpy(np.asarray(x, dtype=float), np.asarray(y, dtype=float), buckets)
+
+    out_x = []
+    out_y = []
+    width = -(-length // buckets)
+    for start in range(0, length, width):
+        end = min(start + width, length)
+        lo = hi = start
+        for j in range(start + 1, end):
+            if y[j] < y[lo]:
+                lo = j
+            elif y[j] > y[hi]:
+                hi = j
+        for j in sorted({lo, hi}):
+            out_x.append(x[j])
+            out_y.append(y[j])
+    return out_x, out_y
+
+def _minmax_numpy(x, y, buckets):
+    ''' Vectorized min/max: pad the series to a whole number of buckets and
+        find the extremes of every bucket with one argmin/argmax call
+    '''
+    length = len(y)
+    width = -(-length // buckets)
+    padded = np.full(buckets * width, np.nan)
+    padded[:length] = y
+    padded = padded.reshape(buckets, width)
+    valid = ~np.isnan(padded).all(axis=1)
+    offsets = np.arange(buckets)[valid] * width
+    lo = offsets + np.nanargmin(padded[valid], axis=1)
+    hi = offsets + np.nanargmax(padded[valid], axis=1)
+    selected = np.unique(np.concatenate((lo, hi)))
+    return x[selected].tolist(), y[selected].tolist()
+
+# Downsampling methods selectable for each chart
+METHODS = {'lttb': lttb, 'minmax': minmax}
+
+def downsample(x, y, n, method):
+    ''' Reduce a series to at most n points with the named method ('raw' keeps every point)
+    '''
+    if method == 'raw':
+        return list(x), list(y)
+    return METHODS[method](x, y, n)
+
+# Self test and benchmark code
+if __name__ == '__main__':
+    import math, random, sqlite3, time
+    from database import TABLE, create_schema
+
+    # LTTB and min/max preserve the first, last and extreme points
+    x = list(range(1000))
+    y = [math.sin(i / 50) for i in x]
+    y[501] = -10.0
+    for fn in (lttb, minmax):
+        (sx, sy) = fn(x, y, 100)
+        assert len(sx) <= 100 and min(sy) == -10.0
+        assert sx == sorted(sx)
+    assert lttb(x, y, 100)[0][0] == 0 and lttb(x, y, 100)[0][-1] == 999
+    assert downsample(x, y, 10, 'raw') == (x, y)
+
+    # The pure Python and NumPy implementations pick the same points
+    if np is not None:
+        fast = (lttb(x, y, 100), minmax(x, y, 101), minmax(x, y, 77))
+        saved, np = np, None
+        assert fast == (lttb(x, y, 100), minmax(x, y, 101), minmax(x, y, 77))
+        np = saved
+
+    # Benchmark on a synthetic year of readings every 5 minutes, with a few short freezing events
+    random.seed(1)
+    db = sqlite3.connect(':memory:')
+    create_schema(db)
+    start = int(time.time()) - 365*86400
+    rows = []
+    for i in range(365*288):
+        t = start + 300*i
+        value = 15 + 8*math.sin(2*math.pi*i/(365*288)) + 3*math.sin(2*math.pi*i/288) + random.gauss(0, 0.3)
+        if i % 20000 == 7:
+            value = -2.0
+        rows.append(('bench', t, value, None, None))
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)', rows)
+    true_min = min(r[2] for r in rows)
+    points = 1000
+    skip = math.ceil(len(rows) / points)
+    print(f'{len(rows)} readings, {points} output points, true minimum {true_min:.2f}, numpy={"yes" if np is not None else "no"}')
+
+    def bench(name, fn):
+        begin = time.perf_counter()
+        (sx, sy) = fn()
+        print(f'{name:<22} {1000*(time.perf_counter()-begin):8.1f} ms  {len(sx):5} points  minimum {min(sy):6.2f}')
+
+    query = f'SELECT ts, temperature FROM {TABLE} WHERE sensor = ? AND ts > ? ORDER BY ts'
+    bench('SQL modulo', lambda: read_series(db.execute(
+        f'SELECT ts, temperature FROM (SELECT ts, temperature, row_number() OVER (ORDER BY ts) AS n FROM {TABLE} '
+        'WHERE sensor = ? AND ts > ?) WHERE n % ? = 0', ('bench', 0, skip))))
+    bench('SQL read only', lambda: read_series(db.execute(query, ('bench', 0))))
+    (sx, sy) = read_series(db.execute(query, ('bench', 0)))
+    for name in METHODS:
+        bench(f'{name} (reduce only)', lambda: downsample(sx, sy, points, name))
+    if np is not None:
+        saved, np = np, None
+        for name in METHODS:
+            bench(f'{name} (pure Python)', lambda: downsample(sx, sy, points, name))
+        np = saved
@@ -0,0 +1,144 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Streaming export of sensor readings as CSV or NDJSON (one JSON object per line).
+# Rows are read from a SQLite cursor in chunks with fetchmany and each chunk is
+# formatted (and optionally gzip compressed) as it is sent, so an export of any
+# length runs in constant memory. The web server sends the generated blocks with
+# chunked transfer encoding as they are produced.
+
+import csv
+import io
+import json
+import zlib
+from metrics import REGISTRY
+
+# Constants
+TABLE = 'SensorData'
+COLUMNS = ('sensor', 'ts', 'temperature', 'humidity', 'pressure')
+CHUNK_SIZE = 2000           # rows fetched (and sent) at a time
+GZIP_LEVEL = 6
+
+# Export formats: name -> (MIME type, file extension)
+FORMATS = {'csv': ('text/csv', 'csv'), 'ndjson': ('application/x-ndjson', 'ndjson')}
+
+# Metrics
+EXPORT_ROWS = REGISTRY.counter('pihome_export_rows_total', 'Rows sent by the export endpoint', ('format',))
+
+def read_chunks(pool, sensor, start, end, chunk_size=CHUNK_SIZE, archive=None):
+    ''' Generate lists of (sensor, ts, temperature, humidity, pressure) rows for start < ts <= end
+        in time order, for one sensor or every sensor (sensor None). Readings of archived months
+        are read from the archive (archive.Archive) if given. The rows are read on a dedicated
+        read-only connection, opened from the read pool's settings and closed when the generator
+        is exhausted or closed, so a slow download never holds one of the pooled connections.
+    '''
+    if archive is not None and start < archive.end - 1:
+        yield from archive.chunks(sensor, start, min(end, archive.end - 1), chunk_size)
+        start = max(start, archive.end - 1)
+        if start >= end:
+            return
+    if sensor is None:
+        query = f'SELECT {", ".join(COLUMNS)} FROM {TABLE} WHERE ts > ? AND ts <= ? ORDER BY ts'
+        params = (start, end)
+    else:
+        query = f'SELECT {", ".join(COLUMNS)} FROM {TABLE} WHERE sensor = ? AND ts > ? AND ts <= ? ORDER BY ts'
+        params = (sensor, start, end)
+    db = pool.open()
+    try:
+        cursor = db.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        db.close()
+
+def format_csv(chunks):
+    ''' Generate the encoded CSV blocks (a header, then one block per chunk of rows)
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue().encode()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        EXPORT_ROWS.inc(len(rows), ('csv',))
+        yield buffer.getvalue().encode()
+
+def format_ndjson(chunks):
+    ''' Generate the encoded NDJSON blocks (one block per chunk of rows)
+    '''
+    for rows in chunks:
+        EXPORT_ROWS.inc(len(rows), ('ndjson',))
+        yield ''.join(json.dumps(dict(zip(COLUMNS, row)), separators=(',', ':')) + '\n' for row in rows).encode()
+
+def gzip_blocks(blocks, level=GZIP_LEVEL):
+    ''' Compress a stream of blocks into a single gzip stream as the blocks are generated
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export(chunks, output, compress=False):
+    ''' Generate the blocks of an export of chunks of rows in the given format (a key of FORMATS)
+    '''
+    blocks = format_csv(chunks) if output == 'csv' else format_ndjson(chunks)
+    return gzip_blocks(blocks) if compress else blocks
+
+# Self test code
+if __name__ == '__main__':
+    import gzip
+    import os
+    import sqlite3
+    import tempfile
+    import tracemalloc
+    from database import create_schema, ReadPool
+
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'test.db')
+    db = sqlite3.connect(database)
+    create_schema(db)
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)',
+                   ((f's{i % 2}', 1000 + i, 20.5, None if i % 3 else 50.0, None) for i in range(100000)))
+    db.commit()
+    db.close()
+    pool = ReadPool(database, size=1)
+
+    # CSV and NDJSON of one sensor in a time range
+    text = b''.join(export(read_chunks(pool, 's1', 1000, 1010), 'csv')).decode()
+    assert text == 'sensor,ts,temperature,humidity,pressure\ns1,1001,20.5,,\ns1,1003,20.5,50.0,\ns1,1005,20.5,,\ns1,1007,20.5,,\ns1,1009,20.5,50.0,\n', text
+    lines = b''.join(export(read_chunks(pool, None, 1000, 1003), 'ndjson')).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{'sensor': 's1', 'ts': 1001, 'temperature': 20.5, 'humidity': None, 'pressure': None},
+                                                    {'sensor': 's0', 'ts': 1002, 'temperature': 20.5, 'humidity': None, 'pressure': None},
+                                                    {'sensor': 's1', 'ts': 1003, 'temperature': 20.5, 'humidity': 50.0, 'pressure': None}]
+
+    # A gzip export decompresses to the same CSV; memory use does not grow with the number of rows
+    tracemalloc.start()
+    size = 0
+    for block in export(read_chunks(pool, None, 0, 200000), 'csv', compress=True):
+        size += len(block)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < 2000000, peak
+    data = gzip.decompress(b''.join(export(read_chunks(pool, None, 0, 200000), 'csv', compress=True)))
+    assert data == b''.join(export(read_chunks(pool, None, 0, 200000), 'csv')) and data.count(b'\n') == 100001
+    print(f'exported 100000 rows: {size} bytes compressed, peak memory {peak} bytes')
+
+    # An export in progress does not hold a pooled connection
+    blocks = export(read_chunks(pool, None, 0, 200000), 'ndjson')
+    next(blocks)
+    with pool.connection() as db:
+        assert db.execute(f'SELECT COUNT(*) FROM {TABLE}').fetchone()[0] == 100000
+    blocks.close()
+    assert pool.created == 1
@@ -7,39 +7,78 @@
 # GNU General Public License for more details.
 
 from threading import Thread
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request, abort, g
 from waitress import serve
 from datetime import datetime
-import sqlite3
-import math
+from downsample import read_series, downsample
+from cache import CachedResponse
+import logtail
+import export
+from metrics import REGISTRY, CONTENT_TYPE
+import time
+import json
 import logging
+from array import array
 
 # Constants
-FIXED = 0
-DUSK = 1
-DAWN = 2
 TABLE = 'SensorData'
+HOURLY_TABLE = 'SensorDataHourly'
+DAILY_TABLE = 'SensorDataDaily'
 NUMBER_OF_PLOT_POINTS = 1000
+MIN_PLOT_POINTS = 3         # lttb and minmax return every point below this
+MAX_PLOT_POINTS = 20000
+LOG_LINES = 200
+MAX_LOG_LINES = 5000
+LOG_FOLLOW_TIMEOUT = 25
+
+METRICS = ('temperature', 'humidity', 'pressure')
+
+# Metrics of the web interface, labelled by route (endpoint)
+WEB_REQUEST_SECONDS = REGISTRY.histogram('pihome_web_request_seconds', 'Time taken to handle a web request', ('endpoint',))
+WEB_RESPONSES = REGISTRY.counter('pihome_web_responses_total', 'Web responses sent', ('endpoint', 'status'))
+
+# Time span (in seconds) covered by each chart on the sensors page
+CHART_SPANS = {'day': 86400, 'month': 30*86400, 'year': 365*86400}
+
+# Default reduction method for each chart: 'raw', 'lttb' or 'minmax' read raw readings
+# and 'rollup' reads the hourly (up to 30 days) or daily rollup tables
+CHART_METHODS = {'day': 'lttb', 'month': 'rollup', 'year': 'rollup'}
 
 class FlaskThread(Thread):
     ''' Class definition to run flask to provide web pages to display sensor data
     '''
-    def __init__(self, port, sensors, events, database, logfile, version):
+    def __init__(self, port, sensors, events, pool, cache, logfile, version, chart_methods=CHART_METHODS, groups=None, commands=None, buffers=None, archive=None):
         self.port = port
         self.sensors = sensors
         self.events = events
-        self.database = database
+        self.pool = pool
+        self.cache = cache
         self.logfile = logfile
         self.version = version
+        self.chart_methods = chart_methods
+        self.groups = groups or {}
+        self.commands = commands
+        self.buffers = buffers
+        self.archive = archive
         Thread.__init__(self)
 
         # Create a flask object and initialize web pages
         self.app = Flask(__name__)
         self.app.debug = True        
         self.app.add_url_rule('/', 'index', self.index)
+        self.app.add_url_rule('/devices', 'devices', self.devices_page, methods=['GET', 'POST'])
         self.app.add_url_rule('/sensors', 'sensors', self.sensors_page, methods=['GET', 'POST'])
+        self.app.add_url_rule('/api/series', 'series', self.api_series)
+        self.app.add_url_rule('/api/stats', 'stats', self.api_stats)
+        self.app.add_url_rule('/export', 'export', self.export_data)
         self.app.add_url_rule('/log', 'log', self.log)
+        self.app.add_url_rule('/api/log', 'api_log', self.api_log)
         self.app.add_url_rule('/about', 'about', self.about)
+        self.app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+        # Time every request
+        self.app.before_request(self.start_timer)
+        self.app.after_request(self.record_request)
 
     def run(self):
         # Start the waitress WSGI server on the specified port
@@ -49,169 +88,49 @@ class FlaskThread(Thread):
     def index(self):
         ''' Returns index.html webpage to show system status
         '''
-        # Get bulbs on and off times
-        device_list = self.sensors.sensor_list 
+        # Get the latest readings of each sensor and the state and on/off times of each device group
+        readings = self.sensors.snapshot()
+        groups = [group.status() for group in self.groups.values()]
         
         # Create a list of scheduled timer events to display
         schedule = []
-        for event in self.events.scheduler.queue:
-            schedule.append(f'time={datetime.fromtimestamp(event.time).strftime("%H:%M")}, action={event.action.__name__} ({(datetime.fromtimestamp(event.time)-datetime.now()).total_seconds()/60:.1f} minutes from now)')
+        for (event_time, name, action) in self.events.scheduler.snapshot():
+            schedule.append(f'time={datetime.fromtimestamp(event_time).strftime("%H:%M")}, action={action} ({(datetime.fromtimestamp(event_time)-datetime.now()).total_seconds()/60:.1f} minutes from now)')
 
         # pass the output state to index.html to display current state on webpage
-        return render_template('index.html', device_list=device_list, temperature=self.sensors.get_temperature(), humidity=self.sensors.get_humidity(), low_battery=self.sensors.battery, schedule=schedule)
-
-    # Methods for each flask webpage route
-    def bulbs_page(self):
-        ''' Returns bulbs.html webpage, methods=['GET', 'POST']
-        '''
-        # Get bulbs on and off times
-        on_time=self.bulbs.get_next_on_time().strftime("%H:%M")
-        off_time=self.bulbs.get_next_off_time().strftime("%H:%M")
-        timer_msg = ''
-
-        # Process POST actions if requested
-        if request.method == 'POST':
-            # Get form post as a dictionary
-            form_dict = request.form
-            if form_dict.get('bulb_state', None) == 'on':
-                # turn bulbs on
-                self.bulbs.turn_on_bulbs()
-                logging.info(f'Bulb(s) turned on via web interface at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
-            elif form_dict.get('bulb_state', None) == 'off':
-                # turn bulbs off
-                self.bulbs.turn_off_bulbs()
-                logging.info(f'Bulb(s) turned off via web interface at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
-            elif form_dict.get('bulb_timer', None) == 'on':
-                # Enable timer control of bulbs
-                self.bulbs.enable_timer()
-            elif form_dict.get('bulb_timer', None) == 'off':
-                # Disable timer control of bulbs
-                self.bulbs.disable_timer()
-            elif form_dict.get('brightness', None) != None:
-                self.bulbs.set_brightness(int(form_dict.get('brightness')))
-            elif form_dict.get('on_time_mode', None) != None:
-                if form_dict.get('on_time_mode') == 'dusk':
-                    self.bulbs.on_time_mode = DUSK
-                    logging.info('Bulbs set to come on at dusk')
-                    timer_msg = 'Time update successful!'
-                else:
-                    self.bulbs.on_time_mode = FIXED
-                    time = request.form['on_time']
-                    if time == '':
-                        logging.error('Invalid bulbs off time requested.')
-                        timer_msg = 'Invalid time!'
-                    else:
-                        t = time.split(':')
-                        self.bulbs.set_on_time(int(t[0]),int(t[1]))
-                        # Update bulbs on and off times
-                        timer_msg = 'Time update successful!'
-                        logging.info('Bulbs set to turn on at a fixed time')
-                self.bulbs.update_scheduler_queue()
-                # Update on time displayed on web page
-                on_time=self.bulbs.get_next_on_time().strftime("%H:%M")
-
-            elif form_dict.get('off_time_mode', None) != None:
-                if form_dict.get('off_time_mode') == 'dawn':
-                    self.bulbs.off_time_mode = DAWN
-                    logging.info('Bulbs set to turn off at dawn')
-                    timer_msg = 'Time update successful!'
-                else:
-                    self.bulbs.off_time_mode = FIXED
-                    time = request.form['off_time']
-                    if time == '':
-                        logging.error('Invalid bulbs off time requested.')
-                        timer_msg = 'Invalid time!'
-                    else:
-                        t = time.split(':')
-                        self.bulbs.set_off_time(int(t[0]),int(t[1]))
-                        # Update bulbs on and off times
-                        timer_msg = 'Time update successful!'
-                        logging.info('Bulbs off updated to a fixed time')
-                self.bulbs.update_scheduler_queue()
-                # update off time displayed on web page
-                off_time=self.bulbs.get_next_off_time().strftime("%H:%M")
-
-            # Return success (201) and stay on the same page
-            return render_template('bulbs.html', timer_msg=timer_msg, on_time_mode=self.bulbs.on_time_mode, off_time_mode=self.bulbs.off_time_mode, on_time=on_time, off_time=off_time, bulbs=str(self.bulbs), state=self.bulbs.state, timer=self.bulbs.timer, brightness=str(self.bulbs.brightness)), 200
+        alarms = self.events.alarms.active_alarms()
+        return render_template('index.html', readings=readings, groups=groups, schedule=schedule, alarms=alarms)
 
-        elif request.method == 'GET':
-            # pass the output state to bulbs.html to display current state on webpage
-            return render_template('bulbs.html', timer_msg=timer_msg, on_time_mode=self.bulbs.on_time_mode, off_time_mode=self.bulbs.off_time_mode, on_time=on_time, off_time=off_time, bulbs=str(self.bulbs), state=self.bulbs.state, timer=self.bulbs.timer, brightness=str(self.bulbs.brightness))
-
-    def outlets_page(self):
-        ''' Returns outlets.html webpage, methods=['GET', 'POST']
+    def devices_page(self):
+        ''' Returns devices.html webpage to show and control device groups, methods=['GET', 'POST']
         '''
-        # Get outlets on and off times
-        on_time=self.outlets.get_next_on_time().strftime("%H:%M")
-        off_time=self.outlets.get_next_off_time().strftime("%H:%M")
-        timer_msg = ''
-
+        message = ''
         # Process POST actions if requested
         if request.method == 'POST':
-            # Get form post as a dictionary
             form_dict = request.form
-            if form_dict.get('outlet_state', None) == 'on':
-                # Turn outlet on
-                self.outlets.turn_on_outlets()
-                logging.info(f'Outlet(s) turned on via web interface at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
-            elif form_dict.get('outlet_state', None) == 'off':
-                # Turn outlet off
-                self.outlets.turn_off_outlets()
-                logging.info(f'Outlet(s) turned off via web interface at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
-            elif form_dict.get('outlet_timer', None) == 'on':
-                # Enable timer control of outlets
-                self.outlets.enable_timer()
-            elif form_dict.get('outlet_timer', None) == 'off':
-                # Disable timer control of outlets
-                self.outlets.disable_timer()
-            elif form_dict.get('on_time_mode', None) != None:
-                if form_dict.get('on_time_mode') == 'dusk':
-                    self.outlets.on_time_mode = DUSK
-                    logging.info('Outlets set to come on at dusk')
-                    timer_msg = 'Outlets time update successful!'
+            group = self.groups.get(form_dict.get('group'))
+            if group is None:
+                abort(400)
+            try:
+                if form_dict.get('state') in ('on', 'off'):
+                    group.set_state(form_dict['state'] == 'on')
+                    logging.info(f'{group.name} turned {form_dict["state"]} via web interface at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
+                elif form_dict.get('timer') == 'on':
+                    group.enable_timer()
+                elif form_dict.get('timer') == 'off':
+                    group.disable_timer()
+                elif 'on_time' in form_dict or 'off_time' in form_dict:
+                    group.set_schedule(form_dict.get('on_time') or None, form_dict.get('off_time') or None)
+                    message = f'{group.name} time update successful!'
                 else:
-                    self.outlets.on_time_mode = FIXED
-                    time = request.form['on_time']
-                    if time == '':
-                        logging.error('Invalid outlets off time requested.')
-                        timer_msg = 'Invalid time!'
-                    else:
-                        t = time.split(':')
-                        self.outlets.set_on_time(int(t[0]),int(t[1]))
-                        # Update bulbs on and off times
-                        timer_msg = 'Outlets time update successful!'
-                        logging.info(f'Outlets set to turn on at a fixed time at {time}')
-                self.outlets.update_scheduler_queue()
-                # Update on time displayed on web page
-                on_time=self.outlets.get_next_on_time().strftime("%H:%M")
-
-            elif form_dict.get('off_time_mode', None) != None:
-                if form_dict.get('off_time_mode') == 'dawn':
-                    self.outlets.off_time_mode = DAWN
-                    logging.info('Outlets set to turn off at dawn')
-                    timer_msg = 'Outlets time update successful!'
-                else:
-                    self.outlets.off_time_mode = FIXED
-                    time = request.form['off_time']
-                    if time == '':
-                        logging.error('Invalid outlets off time requested.')
-                        timer_msg = 'Invalid time!'
-                    else:
-                        t = time.split(':')
-                        self.outlets.set_off_time(int(t[0]),int(t[1]))
-                        # Update outlets on and off times
-                        timer_msg = 'Outlets time update successful!'
-                        logging.info(f'Outlets off updated to a fixed time at {time}')
-                self.outlets.update_scheduler_queue()
-                # update off time displayed on web page
-                off_time=self.outlets.get_next_off_time().strftime("%H:%M")
-
-            # Return success (201) and stay on the same page
-            return render_template('outlets.html', timer_msg=timer_msg, on_time_mode=self.outlets.on_time_mode, off_time_mode=self.outlets.off_time_mode, on_time=on_time, off_time=off_time, outlets=str(self.outlets), state=self.outlets.state, timer=self.outlets.timer), 200
-
-        elif request.method == 'GET':
-            # pass the output state to display current state on webpage
-            return render_template('outlets.html', timer_msg=timer_msg, on_time_mode=self.outlets.on_time_mode, off_time_mode=self.outlets.off_time_mode, on_time=on_time, off_time=off_time, outlets=str(self.outlets), state=self.outlets.state, timer=self.outlets.timer)
+                    for capability in group.capabilities - {'state'}:
+                        if form_dict.get(capability):
+                            group.set(capability, form_dict[capability])
+            except ValueError:
+                logging.error(f'Invalid request for {group.name} via web interface: {dict(form_dict)}')
+                message = 'Invalid setting!'
+        groups = [group.status() for group in self.groups.values()]
+        return render_template('devices.html', groups=groups, message=message)
 
     def sensors_page(self):
         ''' Returns chart.html webpage
@@ -221,19 +140,13 @@ class FlaskThread(Thread):
 
         logging.info(f'Web request to display charts of sensor data at {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
 
-        self.db = sqlite3.connect(self.database)
-        self.cursor = self.db.cursor()
-        day_data = self.cursor.execute(f"SELECT datetime,temperature,humidity,pressure FROM {TABLE} where datetime > datetime('now','localtime','-1 day')").fetchall()
-
-        count = self.cursor.execute(f"SELECT COUNT(*) FROM {TABLE} where datetime > datetime('now','localtime','-30 day')").fetchone()[0]
-        skip = math.ceil(count/NUMBER_OF_PLOT_POINTS)  # Number of rows to skip over for each point to ensure number of plot points stays reasonable
-        month_data = self.cursor.execute(f"SELECT datetime,temperature,humidity,pressure FROM {TABLE} where datetime > datetime('now','localtime','-30 day') AND ROWID % {skip} = 0").fetchall()
-
-        count = self.cursor.execute(f"SELECT COUNT(*) FROM {TABLE} where datetime > datetime('now','localtime','-365 day')").fetchone()[0]
-        skip = math.ceil(count/NUMBER_OF_PLOT_POINTS)  # Number of rows to skip over for each point to ensure number of plot points stays reasonable
-        year_data = self.cursor.execute(f"SELECT datetime,temperature,humidity,pressure FROM {TABLE} where datetime > datetime('now','localtime','-365 day') AND ROWID % {skip} = 0").fetchall()
-
-        self.db.close()
+        # Show the requested sensor (default to the first configured sensor); the charts
+        # are loaded separately by the page from /api/series
+        sensor = request.args.get('sensor') or next(iter(self.sensors.sensor_list), None)
+        record = self.sensors.get(sensor)
+        if record is None:
+            abort(404)
+        latest = record.snapshot()
 
         email = f'{self.events.mail.to_address} sent via {self.events.mail.server}'
 
@@ -242,18 +155,188 @@ class FlaskThread(Thread):
             if form_dict.get('test_email', None) == 'test':
                 self.events.mail.send('Pi-Home test email','This is a test email sent from your pi-home server.')
                 logging.info(f'Test email sent {datetime.now().strftime("%m/%d/%Y, %H:%M:%S")}')
-            return render_template('sensors.html', sensors=str(self.sensors), water_leak=self.sensors.water_leak, low_battery=self.sensors.low_battery, day_data=day_data, month_data=month_data, year_data=year_data, email=email), 200
+            return render_template('sensors.html', sensors=str(self.sensors), sensor_list=self.sensors.sensor_list, sensor=sensor, latest=latest, email=email), 200
         elif request.method == 'GET':
-            return render_template('sensors.html', sensors=str(self.sensors), water_leak=self.sensors.water_leak, low_battery=self.sensors.low_battery, day_data=day_data, month_data=month_data, year_data=year_data, email=email)
+            return render_template('sensors.html', sensors=str(self.sensors), sensor_list=self.sensors.sensor_list, sensor=sensor, latest=latest, email=email)
+
+    def api_series(self):
+        ''' Returns /api/series: one metric of one sensor over a time range, reduced to at most
+            max_points points, as columnar JSON ({"t": [...], "y": [...]}) or as binary
+            (format=f32: little-endian uint32 times followed by float32 values for each field).
+            The range is either a chart name (range=day|month|year) or start/end epoch seconds.
+        '''
+        args = request.args
+        sensor = args.get('sensor') or next(iter(self.sensors.sensor_list), None)
+        if sensor not in self.sensors.sensor_list:
+            abort(404)
+        metric = args.get('metric', 'temperature')
+        output = args.get('format', 'json')
+        if metric not in METRICS or output not in ('json', 'f32'):
+            abort(400)
+        try:
+            max_points = max(MIN_PLOT_POINTS, min(int(args.get('max_points', NUMBER_OF_PLOT_POINTS)), MAX_PLOT_POINTS))
+            if args.get('range') in CHART_SPANS:
+                end = int(time.time())
+                start = end - CHART_SPANS[args['range']]
+                method = args.get('method', self.chart_methods[args['range']])
+                # A named range slides with the clock: key it on the current plot point so the
+                # cached window moves on at least once per point even if no readings arrive
+                span = (args['range'], end // (CHART_SPANS[args['range']] // max_points))
+            else:
+                end = int(args.get('end', time.time()))
+                start = int(args.get('start', end - CHART_SPANS['day']))
+                method = args.get('method', 'lttb')
+                span = (start, end)
+        except ValueError:
+            abort(400)
+        if method not in ('raw', 'lttb', 'minmax', 'rollup'):
+            abort(400)
+
+        # Serve from the cache if possible; entries are dropped when new readings are written
+        key = (sensor, metric, span, method, max_points, output)
+        cached = self.cache.get(key)
+        if cached is None:
+            generation = self.cache.generation(sensor)
+            if method != 'rollup' and self.buffers is not None and self.buffers.covers(sensor, start):
+                # Recent readings (e.g. the day chart) are read from the in-memory ring buffers
+                (t, y) = downsample(*self.buffers.series(sensor, metric, start, end), max_points, method)
+                series = {'t': [int(x) for x in t], 'y': y}
+            else:
+                with self.pool.connection() as db:
+                    series = self.series(db.cursor(), sensor, metric, start, end, method, max_points)
+            if output == 'f32':
+                body = array('I', series.pop('t')).tobytes() + b''.join(array('f', values).tobytes() for values in series.values())
+                cached = CachedResponse(body, 'application/octet-stream', {'X-Series-Fields': ','.join(['t'] + list(series))})
+            else:
+                cached = CachedResponse(json.dumps(series, separators=(',', ':')).encode(), 'application/json')
+            self.cache.put(key, sensor, generation, cached)
+
+        # Let the browser skip the download if it already has this version
+        if cached.etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{cached.etag}"'})
+        return Response(cached.body, mimetype=cached.mimetype, headers=dict(cached.headers, ETag=f'"{cached.etag}"'))
+
+    def export_data(self):
+        ''' Returns /export: the readings of a sensor (or of every sensor if none is given) for
+            start < time <= end (epoch seconds, default: all readings) as CSV or NDJSON
+            (format=csv|ndjson), optionally gzip compressed (gzip=1). Rows are streamed from
+            the database in chunks as they are sent, so memory use does not depend on the range.
+        '''
+        args = request.args
+        sensor = args.get('sensor') or None
+        output = args.get('format', 'csv')
+        if output not in export.FORMATS:
+            abort(400)
+        if sensor is not None and sensor not in self.sensors.sensor_list:
+            abort(404)
+        try:
+            end = int(args.get('end', time.time()))
+            start = int(args.get('start', 0))
+        except ValueError:
+            abort(400)
+        compress = args.get('gzip', '0') not in ('', '0', 'false')
+        (mimetype, extension) = export.FORMATS[output]
+        filename = f'{sensor or "sensors"}-{start}-{end}.{extension}'
+        if compress:
+            (mimetype, filename) = ('application/gzip', filename + '.gz')
+        blocks = export.export(export.read_chunks(self.pool, sensor, start, end, archive=self.archive), output, compress)
+        return Response(blocks, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+    def api_stats(self):
+        ''' Returns /api/stats: JSON counters for the response cache, the database writer, the MQTT payload decoder,
+            the e-mail alert dispatcher, the confirmation of device commands, the ring buffers and the archive
+        '''
+        stats = {'cache': self.cache.stats(), 'writer': self.events.writer.stats(), 'mqtt': self.events.decoder.stats(),
+                 'alerts': self.events.mail.stats()}
+        if self.commands is not None:
+            stats['commands'] = self.commands.stats()
+        if self.buffers is not None:
+            stats['buffers'] = self.buffers.stats()
+        if self.archive is not None:
+            stats['archive'] = self.archive.stats()
+        return stats
+
+    def metrics(self):
+        ''' Returns /metrics: counters and latency histograms in the Prometheus text format
+        '''
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    def start_timer(self):
+        g.start = time.perf_counter()
+
+    def record_request(self, response):
+        ''' Record the time taken by a request and its status code
+        '''
+        endpoint = request.endpoint or 'unknown'
+        if 'start' in g:
+            WEB_REQUEST_SECONDS.observe(time.perf_counter() - g.start, (endpoint,))
+        WEB_RESPONSES.inc(labels=(endpoint, str(response.status_code)))
+        return response
+
+    def series(self, cursor, sensor, metric, start, end, method, max_points):
+        ''' Returns a dictionary of columns with the times (epoch seconds) and values of one
+            metric of a sensor in a time range, reduced to at most max_points points.
+            Series read from the rollup tables also include the min and max of each point.
+            Raw readings of archived months are read from the archive.
+        '''
+        if method == 'rollup':
+            table = HOURLY_TABLE if end - start <= 30*86400 else DAILY_TABLE
+            rows = cursor.execute(f'SELECT bucket, {metric}_sum/{metric}_count, {metric}_min, {metric}_max FROM {table} '
+                                  f'WHERE sensor = ? AND bucket > ? AND bucket <= ? AND {metric}_count > 0 ORDER BY bucket', (sensor, start, end)).fetchall()
+            return {'t': [row[0] for row in rows], 'y': [row[1] for row in rows], 'min': [row[2] for row in rows], 'max': [row[3] for row in rows]}
+        (x, y) = (array('d'), array('d'))
+        if self.archive is not None and start < self.archive.end - 1:
+            (x, y) = self.archive.series(sensor, metric, start, min(end, self.archive.end - 1))
+            start = max(start, self.archive.end - 1)
+        if start < end:
+            cursor.execute(f'SELECT ts, {metric} FROM {TABLE} WHERE sensor = ? AND ts > ? AND ts <= ? ORDER BY ts', (sensor, start, end))
+            (recent_x, recent_y) = read_series(cursor)
+            x += recent_x
+            y += recent_y
+        (t, y) = downsample(x, y, max_points, method)
+        return {'t': [int(x) for x in t], 'y': y}
 
     def log(self):
-        ''' Returns webpage /log
+        ''' Returns webpage /log showing the last lines of the log file
+        '''
+        (lines, start, end, level, sensor) = self.read_log()
+        return render_template('log.html', lines=lines, start=start, end=end, level=level, sensor=sensor, levels=logtail.LEVELS)
+
+    def api_log(self):
+        ''' Returns /api/log: JSON with log lines and the byte offsets they span.
+            With after=<offset> it waits (long-polls) for lines written after that offset,
+            otherwise it returns the last lines ending at before=<offset> (default: end of file).
+        '''
+        if 'after' in request.args:
+            try:
+                offset = int(request.args['after'])
+            except ValueError:
+                abort(400)
+            (lines, end) = logtail.follow(self.logfile, offset, LOG_FOLLOW_TIMEOUT, *self.log_filters())
+            return {'lines': lines, 'end': end}
+        (lines, start, end, level, sensor) = self.read_log()
+        return {'lines': lines, 'start': start, 'end': end}
+
+    def log_filters(self):
+        ''' Returns the (level, sensor) log filters requested, or None for each one not set
+        '''
+        level = request.args.get('level') or None
+        if level is not None and level not in logtail.LEVELS:
+            abort(400)
+        return level, request.args.get('sensor') or None
+
+    def read_log(self):
+        ''' Returns (lines, start, end, level, sensor) for the last lines of the log file
+            requested with the lines, before, level and sensor parameters
         '''
-        f = open(self.logfile, 'r')
-        log = f.read()
-        f.close()
-        log = log.replace('\n', '<br>\n')
-        return render_template('log.html', log=log)
+        try:
+            count = min(int(request.args.get('lines', LOG_LINES)), MAX_LOG_LINES)
+            before = int(request.args['before']) if request.args.get('before') else None
+        except ValueError:
+            abort(400)
+        (level, sensor) = self.log_filters()
+        (lines, start, end) = logtail.tail(self.logfile, count, before, level, sensor)
+        return lines, start, end, level, sensor
 
     def about(self):
         ''' Returns webpage /about
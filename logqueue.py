@@ -0,0 +1,86 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Asynchronous logging: the MQTT, scheduler and web threads only put log records
+# on a queue; a listener thread formats them and writes them to a log file that is
+# rotated by size (or time) with the rotated files compressed using gzip.
+
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+# Constants
+LOG_FORMAT = '%(levelname)s:%(name)s:%(asctime)s %(message)s'
+MAX_BYTES = 1048576
+BACKUP_COUNT = 5
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    ''' Queue handler that defers all formatting to the listener thread.
+        The queue never leaves this process, so the record does not need to be
+        made picklable (which would format the message on the logging thread).
+    '''
+    def prepare(self, record):
+        return record
+
+def gzip_namer(name):
+    ''' Name rotated log files with a .gz extension
+    '''
+    return name + '.gz'
+
+def gzip_rotator(source, dest):
+    ''' Compress a rotated log file (runs on the listener thread)
+    '''
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def start_logging(filename, level=logging.INFO, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, when=None):
+    ''' Route all logging through a queue to a rotating file handler on a listener thread.
+        Files are rotated when they reach max_bytes or, if when is set (e.g. "midnight"),
+        at that time interval. Returns the listener, which must be stopped at exit
+        to write out any queued records.
+    '''
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(filename, when=when, backupCount=backup_count)
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(LogQueueHandler(records))
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+# Self test code
+if __name__ == '__main__':
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'test.log')
+    listener = start_logging(path, logging.INFO, max_bytes=2000, backup_count=2)
+    logging.debug('not written %s', 'at info level')
+    for i in range(100):
+        logging.info('message %d', i)
+    listener.stop()
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[-1].startswith('INFO:root:') and lines[-1].endswith(' message 99')
+    assert sorted(os.listdir(os.path.dirname(path))) == ['test.log', 'test.log.1.gz', 'test.log.2.gz']
+    with gzip.open(path + '.1.gz', 'rt') as f:
+        assert 'message' in f.read()
+    with open(path) as f:
+        assert 'not written' not in f.read()
@@ -0,0 +1,122 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Functions to read the end of a (possibly very large) log file without loading
+# all of it into memory. Positions in the file are byte offsets so a client can
+# page backwards through older lines or follow new lines as they are written.
+
+import os
+import time
+
+# Constants
+BLOCK_SIZE = 8192
+MAX_READ = 65536
+POLL_INTERVAL = 0.5
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+def matches(line, level=None, sensor=None):
+    ''' Return True if a log line is at or above a minimum level and mentions a sensor.
+        Lines are expected in the default logging format, e.g. "INFO:root:message".
+    '''
+    if level is not None:
+        prefix = line.split(':', 1)[0]
+        if prefix in LEVELS and LEVELS.index(prefix) < LEVELS.index(level):
+            return False
+    return sensor is None or sensor in line
+
+def tail(path, lines, before=None, level=None, sensor=None):
+    ''' Return up to the last n matching lines ending at byte offset before
+        (default: end of file), reading backwards one block at a time.
+        Returns (lines, start, end) where start is the offset of the first
+        line returned, to be passed as before to fetch the preceding lines.
+    '''
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size if before is None else min(before, size)
+        position = end
+        found = []
+        remainder = b''
+        while position > 0 and len(found) < lines:
+            step = min(BLOCK_SIZE, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + remainder
+            parts = block.split(b'\n')
+            # The first part may be the end of a line that starts in an earlier block
+            remainder = parts.pop(0) if position > 0 else b''
+            start = position + len(remainder) + (1 if position > 0 else 0)
+            chunk = []
+            for part in parts:
+                text = part.decode('utf-8', errors='replace')
+                if part and matches(text, level, sensor):
+                    chunk.append((start, text))
+                start += len(part) + 1
+            found[:0] = chunk
+        found = found[-lines:]
+    start = found[0][0] if found else position
+    return [text for (_, text) in found], start, end
+
+def read_from(path, offset, level=None, sensor=None, max_bytes=MAX_READ):
+    ''' Return (lines, offset) with the complete lines written since a byte offset.
+        If the file is now shorter than the offset (it was truncated or rotated),
+        reading starts again from the beginning of the file.
+    '''
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(size - offset, max_bytes))
+    # Only return complete lines; a partial last line is returned by the next call
+    complete = data.rfind(b'\n') + 1
+    lines = [line for line in data[:complete].decode('utf-8', errors='replace').splitlines() if line and matches(line, level, sensor)]
+    return lines, offset + complete
+
+def follow(path, offset, timeout, level=None, sensor=None):
+    ''' Long-poll for new lines after a byte offset, waiting up to timeout seconds.
+        Returns as soon as the file has grown (or shrunk) past the offset.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        size = os.path.getsize(path)
+        if size != offset or time.monotonic() >= deadline:
+            (lines, new_offset) = read_from(path, offset, level, sensor)
+            if lines or new_offset != offset or time.monotonic() >= deadline:
+                return lines, new_offset
+            offset = new_offset
+        time.sleep(POLL_INTERVAL)
+
+# Self test code
+if __name__ == '__main__':
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'test.log')
+    with open(path, 'w') as f:
+        for i in range(5000):
+            f.write(f'{LEVELS[i % 3]}:root:message {i} from sensor{i % 7}\n')
+    (lines, start, end) = tail(path, 10)
+    assert lines[-1] == 'INFO:root:message 4999 from sensor1' and len(lines) == 10
+    assert end == os.path.getsize(path)
+    # Page backwards from the start of the previous page
+    (older, start2, _) = tail(path, 10, before=start)
+    assert older[-1] == 'DEBUG:root:message 4989 from sensor5' and start2 < start
+    # Filters select by minimum level and sensor name
+    (lines, _, _) = tail(path, 3, level='WARNING', sensor='sensor3')
+    assert all(line.startswith('WARNING') and 'sensor3' in line for line in lines) and len(lines) == 3
+    (lines, _, _) = tail(path, 100000)
+    assert len(lines) == 5000 and lines[0] == 'DEBUG:root:message 0 from sensor0'
+    # Follow only returns complete lines written since the offset
+    with open(path, 'a') as f:
+        f.write('ERROR:root:new line\nINFO:root:partial')
+    (lines, offset) = read_from(path, end)
+    assert lines == ['ERROR:root:new line'] and offset == end + len('ERROR:root:new line\n')
+    (lines, offset) = follow(path, offset, 0.1)
+    assert lines == []
+    # A rotated (shorter) file is read from the start
+    with open(path, 'w') as f:
+        f.write('INFO:root:after rotation\n')
+    assert read_from(path, offset) == (['INFO:root:after rotation'], 25)
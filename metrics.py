@@ -0,0 +1,223 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Process metrics in the Prometheus text exposition format, served on /metrics.
+# Counters and histograms are updated on hot paths such as the MQTT message handler,
+# so each thread updates its own shard (a dictionary only that thread writes to) without
+# taking a lock; the shards are only added together when the metrics are scraped.
+
+import bisect
+import time
+from threading import Lock, local
+
+# Constants
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape(value):
+    ''' Escape a label value (backslash, double quote and newline)
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    ''' Return the {name="value",...} label set of a sample (empty if there are no labels)
+    '''
+    pairs = [f'{name}="{escape(value)}"' for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    ''' Base class of a named metric with optional labels and one shard per thread
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        ''' Constructor
+        '''
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.shards = []
+        self.local = local()
+        self.lock = Lock()     # only taken when a thread creates its shard
+
+    def shard(self):
+        ''' Return the shard of the calling thread: label values -> value(s)
+        '''
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def collect(self):
+        ''' Return a list of (name suffix, formatted labels, value) samples of the metric
+        '''
+        raise NotImplementedError
+
+    def render(self):
+        ''' Return the metric in the text exposition format
+        '''
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for (suffix, labels, value) in self.collect():
+            lines.append(f'{self.name}{suffix}{labels} {format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    ''' A monotonically increasing count, e.g. of messages received
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        with self.lock:
+            shards = list(self.shards)
+        return sum(shard.get(labels, 0) for shard in shards)
+
+    def collect(self):
+        totals = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for (labels, value) in shard.copy().items():
+                totals[labels] = totals.get(labels, 0) + value
+        return [('', format_labels(self.labels, labels), value) for (labels, value) in sorted(totals.items())]
+
+class Histogram(Metric):
+    ''' Counts of observations (e.g. latencies in seconds) in buckets, with their sum
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        ''' Record an observation: one count per bucket (the last counts values above every bucket), then the sum
+        '''
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self):
+        totals = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for (labels, counts) in shard.copy().items():
+                total = totals.setdefault(labels, [0] * len(counts))
+                for (i, count) in enumerate(list(counts)):
+                    total[i] += count
+        samples = []
+        for (labels, counts) in sorted(totals.items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', format_labels(self.labels, labels, f'le="{format_value(bound)}"'), cumulative))
+            samples.append(('_sum', format_labels(self.labels, labels), counts[-1]))
+            samples.append(('_count', format_labels(self.labels, labels), cumulative))
+        return samples
+
+class Gauge(Metric):
+    ''' A value read when the metrics are scraped, e.g. a queue length. The function
+        returns a number, or a dictionary of label values -> number for a labelled gauge.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def collect(self):
+        value = self.function()
+        if isinstance(value, dict):
+            return [('', format_labels(self.labels, labels), v) for (labels, v) in sorted(value.items())]
+        return [('', '', value)]
+
+class Registry:
+    ''' The set of metrics served by the web interface
+    '''
+    def __init__(self):
+        ''' Constructor
+        '''
+        self.metrics = {}
+        self.lock = Lock()
+
+    def register(self, metric):
+        ''' Add a metric, replacing a metric with the same name
+        '''
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, function, labels=()):
+        return self.register(Gauge(name, help, function, labels))
+
+    def render(self):
+        ''' Return all metrics in the text exposition format
+        '''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# Registry shared by the modules of the program
+REGISTRY = Registry()
+
+# Self test and benchmark code
+if __name__ == '__main__':
+    from threading import Thread
+    registry = Registry()
+    messages = registry.counter('test_messages_total', 'Messages received', ('topic',))
+    latency = registry.histogram('test_latency_seconds', 'Handler latency', buckets=(0.1, 1.0))
+    registry.gauge('test_queue_length', 'Queue length', lambda: 3)
+
+    def work():
+        for i in range(10000):
+            messages.inc(labels=('a"b' if i % 2 else 'c',))
+            latency.observe(0.5)
+    threads = [Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    text = registry.render()
+    assert 'test_messages_total{topic="a\\"b"} 20000' in text and 'test_messages_total{topic="c"} 20000' in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 0' in text and 'test_latency_seconds_bucket{le="+Inf"} 40000' in text
+    assert 'test_latency_seconds_sum 20000.0' in text and 'test_latency_seconds_count 40000' in text
+    assert 'test_queue_length 3' in text and '# TYPE test_latency_seconds histogram' in text
+    assert messages.value(('c',)) == 20000
+
+    n = 1000000
+    begin = time.perf_counter()
+    for _ in range(n):
+        messages.inc(labels=('c',))
+    print(f'counter increment: {1e9*(time.perf_counter()-begin)/n:6.0f} ns')
+    begin = time.perf_counter()
+    for _ in range(n):
+        latency.observe(0.01)
+    print(f'histogram observe: {1e9*(time.perf_counter()-begin)/n:6.0f} ns')
@@ -9,21 +9,28 @@
 from datetime import datetime
 import configparser
 import signal
-import sched, time
+import asyncio
 import sys
 import os
 import logging
-from telnetlib import SE
 import paho.mqtt.client as mqtt
-from astral.sun import sun
-from astral.geocoder import lookup, database
-from waitress import serve
 
 # Custom classes
-from sensors import Sensors, Events, Mail
+from sensors import Sensors, Events, Mail, SUBSCRIPTION, DEFAULT_DEVICE_TYPE, TIMER_PERIOD
+from database import DatabaseWriter, ReadPool, Retention, migrate
+from cache import ResponseCache
+from logqueue import start_logging
+from scheduler import Scheduler
+from solar import SolarCalendar
+import asyncmode
 from flaskthread import FlaskThread
-from bulbs import Bulbs
-from outlets import Outlets
+from devices import load_groups, PublishTracker
+from commands import CommandTracker
+from metrics import REGISTRY
+from alerts import AlertDispatcher
+from ringbuffer import RingBuffers
+from alarms import load_rules
+from archive import Archive, Archiver
 
 # CONSTANTS
 VERSION = 0.61
@@ -36,6 +43,15 @@ def sigint_handler(signum, frame):
     ''' SIGINT handler - exit gracefully
     '''
     logging.info(f'Program recevied SIGINT at: {datetime.now()}')
+    # Flush any sensor readings still waiting to be written to the database
+    if 'writer' in globals():
+        writer.stop()
+    # Send any alerts still waiting to be sent
+    if 'alerts' in globals():
+        alerts.stop(10)
+    # Write out any log records still waiting in the logging queue
+    if 'log_listener' in globals():
+        log_listener.stop()
     logging.shutdown()
     sys.exit(0)
 
@@ -51,25 +67,58 @@ if SENSORS != []:
     SENSORS = SENSORS.split(',')
     for i in range(len(SENSORS)):
         SENSORS[i] = SENSORS[i].strip()
+# Optional device types, e.g. "leak1: water_leak, button1: button"; other sensors handle every field
+SENSOR_TYPES = dict.fromkeys(SENSORS, DEFAULT_DEVICE_TYPE)
+for entry in conf.get('pi-home', 'sensor_types', fallback='').split(','):
+    if ':' in entry:
+        (name, device_type) = entry.split(':', 1)
+        SENSOR_TYPES[name.strip()] = device_type.strip()
 DATABASE = conf.get('pi-home', 'database', fallback='/home/pi/sensor_data.db')
 WEB_SERVER_PORT = conf.getint('pi-home', 'web_server_port', fallback=8080)
 WEB_INTERFACE = conf.getboolean('pi-home', 'web_interface',fallback=False)
 LOG_FILE = conf.get('pi-home', 'logfile', fallback='/tmp/pi-home.log')
-LOW_TEMP_THRESHOLD = conf.getfloat('pi-home', 'low_temp_threshold', fallback=10.0)
-HIGH_HUMIDITY_THRESHOLD = conf.getfloat('pi-home', 'high_humidity_threshold', fallback=85.0)
+CITY = conf.get('pi-home', 'city', fallback='Detroit')
 SAMPLE_PERIOD = conf.getint('pi-home', 'sample_period', fallback=180)
 SENDER_EMAIL = conf.get('pi-home', 'sender_email', fallback='')
 RECIPIENT_EMAIL = conf.get('pi-home', 'recipient_email', fallback='')
 SMTP_SERVER = conf.get('pi-home', 'smtp_server', fallback='')
+ALERT_WINDOW = conf.getint('pi-home', 'alert_window', fallback=300)
+ALERT_QUEUE_SIZE = conf.getint('pi-home', 'alert_queue_size', fallback=100)
 LOG_LEVEL = conf.get('pi-home', 'loglevel', fallback='info')
+RUNTIME = conf.get('pi-home', 'runtime', fallback='threads')
+COMMAND_TIMEOUT = conf.getfloat('pi-home', 'command_timeout', fallback=5.0)
+COMMAND_RETRIES = conf.getint('pi-home', 'command_retries', fallback=2)
+LOG_MAX_BYTES = conf.getint('pi-home', 'log_max_bytes', fallback=1048576)
+LOG_BACKUP_COUNT = conf.getint('pi-home', 'log_backup_count', fallback=5)
+LOG_ROTATE_WHEN = conf.get('pi-home', 'log_rotate_when', fallback='')
+DB_FLUSH_SIZE = conf.getint('pi-home', 'db_flush_size', fallback=500)
+DB_FLUSH_INTERVAL = conf.getfloat('pi-home', 'db_flush_interval', fallback=5.0)
+DB_QUEUE_SIZE = conf.getint('pi-home', 'db_queue_size', fallback=10000)
+DB_READ_POOL_SIZE = conf.getint('pi-home', 'db_read_pool_size', fallback=4)
+WEB_CACHE_SIZE = conf.getint('pi-home', 'web_cache_size', fallback=256)
+DB_PRAGMAS = {'cache_size': conf.getint('pi-home', 'db_cache_size', fallback=-8000),
+              'mmap_size': conf.getint('pi-home', 'db_mmap_size', fallback=33554432),
+              'synchronous': conf.get('pi-home', 'db_synchronous', fallback='NORMAL')}
+RETENTION_DAYS = conf.getint('pi-home', 'retention_days', fallback=365)
+RETENTION_PERIOD = conf.getint('pi-home', 'retention_period', fallback=3600)
+RETENTION_CHUNK_SIZE = conf.getint('pi-home', 'retention_chunk_size', fallback=5000)
+INCREMENTAL_VACUUM = conf.getboolean('pi-home', 'incremental_vacuum', fallback=False)
+ARCHIVE_DAYS = conf.getint('pi-home', 'archive_days', fallback=0)
+ARCHIVE_DIRECTORY = conf.get('pi-home', 'archive_directory', fallback=os.path.splitext(DATABASE)[0] + '-archive')
+ARCHIVE_PERIOD = conf.getint('pi-home', 'archive_period', fallback=86400)
+CHART_METHODS = {'day': conf.get('pi-home', 'day_chart', fallback='lttb'),
+                 'month': conf.get('pi-home', 'month_chart', fallback='rollup'),
+                 'year': conf.get('pi-home', 'year_chart', fallback='rollup')}
 
 # Start logging and set logging level; default to INFO level
+# Records are queued and written to a rotating, compressed log file by a listener thread
 if LOG_LEVEL == 'error':
-    logging.basicConfig(filename=LOG_FILE, level=logging.ERROR, filemode='w')
+    level = logging.ERROR
 elif LOG_LEVEL == 'debug':
-    logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, filemode='w')
+    level = logging.DEBUG
 else:
-    logging.basicConfig(filename=LOG_FILE, level=logging.INFO, filemode='w')
+    level = logging.INFO
+log_listener = start_logging(LOG_FILE, level, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN)
 
 # Start log file
 logging.info(f'Starting at {datetime.now()} with version {VERSION} loglevel={LOG_LEVEL}')
@@ -77,44 +126,113 @@ logging.info(f'Starting at {datetime.now()} with version {VERSION} loglevel={LOG
 # setup a sigint handler to exit gracefully on signal
 signal.signal(signal.SIGINT, sigint_handler)
 
-# Instantiate a sensor object to track state of sensor values
-sensors = Sensors(SENSORS, LOW_TEMP_THRESHOLD, HIGH_HUMIDITY_THRESHOLD)
+# Instantiate a registry of the sensors to track the latest state reported by each sensor
+sensors = Sensors(SENSORS)
+
+# The asyncio runtime requires the optional aiomqtt package
+if RUNTIME == 'asyncio' and not asyncmode.available():
+    logging.error('runtime = asyncio requires the aiomqtt package; using the threads runtime')
+    RUNTIME = 'threads'
 
 # Create scheduler to control lights and periodically sample sensors
-# Set delayfunc to run with (at most) 1 second sleep so that it can periodically wake up to adjust 
-# to any changes to the scheduler queue (which can occur in the flask thread)
-scheduler = sched.scheduler(time.time, delayfunc=lambda time_to_sleep: time.sleep(min(1, time_to_sleep)))
+if RUNTIME == 'asyncio':
+    # Timer events run on the asyncio event loop, which sleeps until the next event is due
+    loop = asyncio.new_event_loop()
+    scheduler = asyncmode.LoopScheduler(loop)
+else:
+    # The scheduler thread sleeps until the next event is due; events inserted
+    # from other threads (such as the flask thread) wake it up immediately
+    scheduler = Scheduler()
 
-# Create an event handling object with e-mail alerts
-mail = Mail(SENDER_EMAIL, RECIPIENT_EMAIL, SMTP_SERVER)
-events = Events(scheduler, sensors, DATABASE, mail)
+# Resolve the city once and precompute dawn and dusk times shared by all timer-controlled devices
+calendar = SolarCalendar(CITY)
 
-# set up periodic timer event for logging sensor data
-scheduler.enter(10, 1, events.timer_event)
+# Create or upgrade the database schema (readings from older versions are assigned to the first sensor)
+migrate(DATABASE, SENSORS[0] if SENSORS else 'sensor')
 
-# Connect to MQTT broker provided by zigbee2mqtt
-client = mqtt.Client()
-ret = client.connect(BROKER_IP, BROKER_PORT, MQTT_KEEPALIVE)
-if ret != 0:
-    logging.error(f'MQTT connect return code: {ret}')
-client.on_message = events.mqtt_message_handler
-logging.info(f'MQTT client connected to {BROKER_IP} on port {BROKER_PORT}')
+# Keep the last day of readings of each sensor in memory to serve the day charts
+pool = ReadPool(DATABASE, DB_READ_POOL_SIZE, DB_PRAGMAS)
+buffers = RingBuffers(period=TIMER_PERIOD)
+with pool.connection() as db:
+    buffers.seed(db, SENSOR_TYPES)
 
-# Subscribe to all zigbee sensors
-for sensor in SENSORS:
-    client.subscribe(f'zigbee2mqtt/{sensor}', qos=QOS)
-    logging.info(f'Subscribed to: {sensor}')
+# Start a database writer thread to batch sensor readings into the database
+writer = DatabaseWriter(DATABASE, DB_FLUSH_SIZE, DB_FLUSH_INTERVAL, DB_QUEUE_SIZE, DB_PRAGMAS)
+writer.start()
 
+# Create an event handling object with e-mail alerts; alerts are sent by a dispatcher thread
+mail = Mail(SENDER_EMAIL, RECIPIENT_EMAIL, SMTP_SERVER)
+alerts = AlertDispatcher(mail, ALERT_WINDOW, ALERT_QUEUE_SIZE)
+alerts.start()
+events = Events(scheduler, sensors, writer, alerts, SENSOR_TYPES, buffers, load_rules(conf))
+
+# set up periodic timer event for logging sensor data
+scheduler.enter(10, 1, events.timer_event, name='timer_event')
+
+# set up periodic retention job to prune old sensor data
+retention = Retention(scheduler, DATABASE, RETENTION_DAYS, RETENTION_PERIOD, RETENTION_CHUNK_SIZE, INCREMENTAL_VACUUM)
+retention.start()
+
+# set up periodic archive job to move closed months of sensor data out of the database
+archive = Archive(ARCHIVE_DIRECTORY)
+if ARCHIVE_DAYS > 0:
+    archiver = Archiver(scheduler, DATABASE, archive, ARCHIVE_DAYS, ARCHIVE_PERIOD, RETENTION_CHUNK_SIZE)
+    archiver.start()
+
+if RUNTIME == 'threads':
+    # Connect to MQTT broker provided by zigbee2mqtt
+    client = mqtt.Client()
+    ret = client.connect(BROKER_IP, BROKER_PORT, MQTT_KEEPALIVE)
+    if ret != 0:
+        logging.error(f'MQTT connect return code: {ret}')
+    client.on_message = events.mqtt_message_handler
+    logging.info(f'MQTT client connected to {BROKER_IP} on port {BROKER_PORT}')
+
+    # Subscribe to all zigbee devices with a single wildcard; messages from devices
+    # other than the configured sensors are dropped by the message handler
+    client.subscribe(SUBSCRIPTION, qos=QOS)
+else:
+    # Messages published by device groups are sent by the asyncio MQTT task
+    client = asyncmode.Publisher(loop)
+logging.info(f'Subscribing to: {SUBSCRIPTION} for sensors: {", ".join(SENSOR_TYPES)}')
+
+
+# Create the device groups defined in the configuration file; they share the scheduler and solar calendar
+publishes = PublishTracker()
+client.on_publish = publishes.on_publish    # log the time taken to publish each command
+commands = CommandTracker(scheduler, COMMAND_TIMEOUT, COMMAND_RETRIES)
+groups = load_groups(conf, scheduler, client, calendar, publishes, commands)
+for group in groups.values():
+    # State reports of the devices confirm the commands sent to them
+    for device in group.devices:
+        events.add_report_handler(device, commands.on_report)
+    group.start()
 
 # Start a flask web server in a separate thread
 logging.info('Starting web interface...')
-server = FlaskThread(WEB_SERVER_PORT, sensors, events, DATABASE, LOG_FILE, VERSION)
-server.start()
+cache = ResponseCache(WEB_CACHE_SIZE)
+writer.add_listener(cache.invalidate)   # Drop cached charts of sensors with new readings
+server = FlaskThread(WEB_SERVER_PORT, sensors, events, pool, cache, LOG_FILE, VERSION, CHART_METHODS, groups, commands, buffers, archive)
+
+# Gauges read when /metrics is requested
+REGISTRY.gauge('pihome_scheduler_jobs', 'Jobs queued in the scheduler', lambda: len(scheduler.jobs))
+REGISTRY.gauge('pihome_db_queue_length', 'Readings waiting for the database writer', writer.queue.qsize)
+REGISTRY.gauge('pihome_ring_buffer_bytes', 'Memory used by the in-memory ring buffers of recent readings', buffers.memory)
+REGISTRY.gauge('pihome_alerts_waiting', 'E-mail alerts waiting to be sent', alerts.queue.qsize)
+REGISTRY.gauge('pihome_commands_pending', 'Device commands waiting for confirmation', lambda: len(commands.pending))
 
 # Loop forever waiting for events
 try:
-    client.loop_start()
-    scheduler.run()
+    if RUNTIME == 'asyncio':
+        logging.info('Running with the asyncio runtime')
+        loop.run_until_complete(asyncmode.run(events, server, client, BROKER_IP, BROKER_PORT, MQTT_KEEPALIVE, QOS))
+    else:
+        server.start()
+        client.loop_start()
+        scheduler.run()
 except KeyboardInterrupt:
-    client.disconnect()
+    if RUNTIME == 'threads':
+        client.disconnect()
+    writer.stop()
     logging.info('Terminating due to KeyboardInterrupt.')
+    log_listener.stop()
@@ -0,0 +1,188 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# In-memory ring buffers of the most recent sensor readings. Each sensor has a fixed
+# number of slots holding a timestamp and one value per metric in array('d') columns
+# (NaN for a missing value), so memory use is bounded and known in advance. The buffers
+# are seeded from the database at startup and appended to by the sampling timer, and
+# serve the day chart without querying SQLite.
+
+import bisect
+import logging
+import math
+import time
+from array import array
+from threading import Lock
+
+# Constants
+TABLE = 'SensorData'
+METRICS = ('temperature', 'humidity', 'pressure')
+SPAN = 86400            # seconds of readings kept for each sensor
+PERIOD = 180            # expected time between readings of a sensor
+MARGIN = 1.25           # extra slots for readings taken more often than expected
+
+NAN = float('nan')
+
+class SensorBuffer:
+    ''' Ring buffer of readings of one sensor. since is the time after which the
+        buffer holds every reading (raised when old readings are overwritten).
+    '''
+    __slots__ = ('times', 'values', 'head', 'count', 'since')
+
+    def __init__(self, capacity, metrics, since):
+        self.times = array('d', [NAN]) * capacity
+        self.values = {metric: array('d', [NAN]) * capacity for metric in metrics}
+        self.head = 0           # slot of the next reading
+        self.count = 0
+        self.since = since
+
+    def append(self, ts, readings):
+        ''' Store a reading (readings: metric -> value or None), overwriting the oldest if full
+        '''
+        capacity = len(self.times)
+        i = self.head
+        if self.count == capacity:
+            self.since = max(self.since, self.times[i])
+        else:
+            self.count += 1
+        self.times[i] = ts
+        for (metric, column) in self.values.items():
+            value = readings.get(metric)
+            column[i] = NAN if value is None else value
+        self.head = (i + 1) % capacity
+
+    def ordered(self, column):
+        ''' Return a copy of a column (array) from the oldest to the newest reading
+        '''
+        capacity = len(column)
+        first = (self.head - self.count) % capacity
+        if first + self.count <= capacity:
+            return column[first:first + self.count]
+        return column[first:] + column[:self.head]
+
+class RingBuffers:
+    ''' Ring buffers of the recent readings of every sensor
+    '''
+    def __init__(self, span=SPAN, period=PERIOD, metrics=METRICS):
+        ''' Constructor: each buffer has room for span seconds of readings taken every period seconds
+        '''
+        self.span = span
+        self.metrics = tuple(metrics)
+        self.capacity = int(math.ceil(span / period * MARGIN)) + 1
+        self.buffers = {}
+        self.lock = Lock()
+
+    def buffer(self, sensor, since):
+        ''' Return the buffer of a sensor, creating it if needed (called with the lock held)
+        '''
+        buffer = self.buffers.get(sensor)
+        if buffer is None:
+            buffer = self.buffers[sensor] = SensorBuffer(self.capacity, self.metrics, since)
+        return buffer
+
+    def append(self, sensor, ts, temperature, humidity, pressure):
+        ''' Store a reading of a sensor (readings must be appended in time order)
+        '''
+        readings = {'temperature': temperature, 'humidity': humidity, 'pressure': pressure}
+        with self.lock:
+            # A new sensor only holds every reading from its first reading on
+            self.buffer(sensor, ts - 1).append(ts, readings)
+
+    def seed(self, db, sensors, now=None):
+        ''' Fill the buffers of the given sensors with the last span of readings from the database
+        '''
+        if now is None:
+            now = int(time.time())
+        since = now - self.span
+        start = time.monotonic()
+        rows = 0
+        for sensor in sensors:
+            cursor = db.execute(f'SELECT ts, {", ".join(self.metrics)} FROM {TABLE} WHERE sensor = ? AND ts > ? ORDER BY ts', (sensor, since))
+            with self.lock:
+                buffer = self.buffers[sensor] = SensorBuffer(self.capacity, self.metrics, since)
+                for row in cursor:
+                    buffer.append(row[0], dict(zip(self.metrics, row[1:])))
+                    rows += 1
+        logging.info(f'Seeded ring buffers with {rows} readings in {time.monotonic()-start:.2f} seconds ({self.memory()} bytes)')
+
+    def covers(self, sensor, start):
+        ''' Return True if the buffer of a sensor holds every reading after start
+        '''
+        buffer = self.buffers.get(sensor)
+        return buffer is not None and start >= buffer.since
+
+    def series(self, sensor, metric, start, end):
+        ''' Return (times, values) arrays of a metric of a sensor for start < time <= end,
+            skipping missing values (like downsample.read_series)
+        '''
+        with self.lock:
+            buffer = self.buffers.get(sensor)
+            if buffer is None:
+                return (array('d'), array('d'))
+            times = buffer.ordered(buffer.times)
+            values = buffer.ordered(buffer.values[metric])
+        first = bisect.bisect_right(times, start)
+        last = bisect.bisect_right(times, end)
+        x = array('d')
+        y = array('d')
+        for i in range(first, last):
+            if values[i] == values[i]:      # skip NaN
+                x.append(times[i])
+                y.append(values[i])
+        return (x, y)
+
+    def memory(self):
+        ''' Return the number of bytes used by the buffers (the arrays' storage)
+        '''
+        with self.lock:
+            buffers = list(self.buffers.values())
+        return sum(column.buffer_info()[1] * column.itemsize for buffer in buffers for column in [buffer.times, *buffer.values.values()])
+
+    def stats(self):
+        ''' Return a dictionary describing the buffers
+        '''
+        return {'sensors': len(self.buffers), 'capacity': self.capacity, 'span': self.span, 'bytes': self.memory()}
+
+# Self test and benchmark code
+if __name__ == '__main__':
+    import sqlite3
+    from database import create_schema
+
+    db = sqlite3.connect(':memory:')
+    create_schema(db)
+    now = 1700000000
+    db.executemany(f'INSERT INTO {TABLE} VALUES (?,?,?,?,?)', [('s1', now - 300*i, 20 + i % 7, None if i % 5 == 0 else 50.0, None) for i in range(600)])
+    buffers = RingBuffers(span=86400, period=300)
+    buffers.seed(db, ['s1', 's2'], now)
+
+    # The buffer holds the readings of the last day (288 readings 5 minutes apart)
+    (t, y) = buffers.series('s1', 'temperature', now - 86400, now)
+    rows = db.execute(f'SELECT ts, temperature FROM {TABLE} WHERE sensor = ? AND ts > ? AND ts <= ? ORDER BY ts', ('s1', now - 86400, now)).fetchall()
+    assert list(zip(t, y)) == [(float(ts), float(v)) for (ts, v) in rows] and len(rows) == 288
+    assert len(buffers.series('s1', 'humidity', now - 86400, now)[0]) == 230     # missing values are skipped
+    assert len(buffers.series('s1', 'pressure', now - 86400, now)[0]) == 0
+    assert buffers.covers('s1', now - 86400) and not buffers.covers('s1', now - 90000) and buffers.covers('s2', now - 3600)
+    assert not buffers.covers('s3', now - 3600)
+
+    # Appending past the capacity overwrites the oldest readings and raises the covered time
+    for i in range(1, buffers.capacity + 1):
+        buffers.append('s1', now + 300*i, i, None, 1000.0)
+    (t, y) = buffers.series('s1', 'temperature', 0, now + 300*buffers.capacity)
+    assert len(t) == buffers.capacity and t[0] == now + 300 and y[-1] == buffers.capacity
+    assert not buffers.covers('s1', now - 1) and buffers.covers('s1', now)
+    assert buffers.stats()['bytes'] == 2 * 4 * 8 * buffers.capacity
+
+    # A sensor first seen after startup is only covered from its first reading
+    buffers.append('s3', now, 1.0, 2.0, 3.0)
+    assert buffers.covers('s3', now - 1) and not buffers.covers('s3', now - 3600)
+
+    n = 1000
+    begin = time.perf_counter()
+    for _ in range(n):
+        buffers.series('s1', 'temperature', now - 86400, now + 86400*2)
+    print(f'day series from ring buffer: {1e6*(time.perf_counter()-begin)/n:8.1f} us ({buffers.capacity} slots)')
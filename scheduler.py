@@ -0,0 +1,249 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Event-driven job scheduler used in place of sched.scheduler. Jobs are kept in a
+# heap and may be given a name, so that a job can be found, cancelled or rescheduled
+# by name without scanning (and copying) the whole queue. The runner sleeps on a
+# condition variable until the next job is due, and is woken immediately when another
+# thread inserts an earlier job, instead of polling every second.
+
+import heapq
+import itertools
+import time
+from threading import Condition
+from metrics import REGISTRY
+
+# Constants
+COMPACT_RATIO = 2      # rebuild the heap when it holds this many times more entries than live jobs
+
+# Time between when a job was due and when it started (across all schedulers)
+LATENESS_SECONDS = REGISTRY.histogram('pihome_scheduler_lateness_seconds', 'Delay between when a job was due and when it ran')
+
+class Job:
+    ''' A scheduled call of action(*argument, **kwargs) at an absolute time.
+        Jobs are ordered by (time, priority, sequence) like sched.Event.
+    '''
+    __slots__ = ('time', 'priority', 'sequence', 'action', 'argument', 'kwargs', 'name', 'cancelled')
+
+    def __init__(self, time, priority, sequence, action, argument, kwargs, name):
+        self.time = time
+        self.priority = priority
+        self.sequence = sequence
+        self.action = action
+        self.argument = argument
+        self.kwargs = kwargs
+        self.name = name
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.time, self.priority, self.sequence) < (other.time, other.priority, other.sequence)
+
+    def __repr__(self):
+        return f'Job(name={self.name!r}, time={self.time}, action={getattr(self.action, "__name__", self.action)})'
+
+class Scheduler:
+    ''' Thread-safe scheduler with named jobs. The enter/enterabs/cancel/run methods
+        are compatible with sched.scheduler; entering a job with the name of a queued
+        job replaces that job. Cancelled jobs are marked and skipped when they reach
+        the top of the heap, so cancel is O(1) and reschedule is O(log n).
+    '''
+    def __init__(self, timefunc=time.time):
+        ''' Constructor
+        '''
+        self.timefunc = timefunc
+        self.heap = []
+        self.jobs = {}          # live jobs by sequence number
+        self.names = {}         # live jobs by name
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.stopped = False
+
+    def enterabs(self, time, priority, action, argument=(), kwargs=None, name=None):
+        ''' Schedule an action at an absolute time and return the job.
+            A queued job with the same name is cancelled first.
+        '''
+        job = Job(time, priority, next(self.sequence), action, argument, kwargs or {}, name)
+        with self.condition:
+            if name is not None and name in self.names:
+                self._remove(self.names[name])
+            heapq.heappush(self.heap, job)
+            self.jobs[job.sequence] = job
+            if name is not None:
+                self.names[name] = job
+            if self.heap[0] is job:
+                self._wake()
+        return job
+
+    def enter(self, delay, priority, action, argument=(), kwargs=None, name=None):
+        ''' Schedule an action after a delay (in seconds) and return the job
+        '''
+        return self.enterabs(self.timefunc() + delay, priority, action, argument, kwargs, name)
+
+    def reschedule(self, name, time):
+        ''' Move a named job to a new absolute time and return the new job
+        '''
+        with self.condition:
+            job = self.names.get(name)
+            if job is None:
+                raise ValueError(name)
+            return self.enterabs(time, job.priority, job.action, job.argument, job.kwargs, name)
+
+    def cancel(self, job):
+        ''' Remove a job (or the job with a given name) from the queue.
+            Raises ValueError if it is not queued, like sched.scheduler.cancel.
+        '''
+        with self.condition:
+            if isinstance(job, str):
+                job = self.names.get(job)
+            if job is None or job.sequence not in self.jobs:
+                raise ValueError(job)
+            self._remove(job)
+
+    def discard(self, name):
+        ''' Remove the job with a given name if one is queued
+        '''
+        with self.condition:
+            job = self.names.get(name)
+            if job is not None:
+                self._remove(job)
+
+    def get(self, name):
+        ''' Return the queued job with a given name, or None
+        '''
+        return self.names.get(name)
+
+    def empty(self):
+        ''' Return True if no jobs are queued
+        '''
+        return not self.jobs
+
+    def snapshot(self):
+        ''' Return a sorted list of (time, name, action name) for the queued jobs,
+            safe to call from any thread (e.g. to show the schedule on a web page)
+        '''
+        with self.condition:
+            jobs = sorted(self.jobs.values())
+        return [(job.time, job.name, getattr(job.action, '__name__', str(job.action))) for job in jobs]
+
+    @property
+    def queue(self):
+        ''' Return a sorted list of the queued jobs (as sched.scheduler.queue)
+        '''
+        with self.condition:
+            return sorted(self.jobs.values())
+
+    def run_pending(self):
+        ''' Run all jobs that are due and return the delay until the next job (None if none are queued)
+        '''
+        while True:
+            with self.condition:
+                job = self._peek()
+                if job is None:
+                    return None
+                delay = job.time - self.timefunc()
+                if delay > 0:
+                    return delay
+                heapq.heappop(self.heap)
+                self._forget(job)
+            LATENESS_SECONDS.observe(-delay)
+            # Run the action without holding the lock so that it can schedule further jobs
+            self._call(job)
+
+    def run(self):
+        ''' Run jobs as they become due until stop() is called
+        '''
+        while not self.stopped:
+            self.run_pending()
+            with self.condition:
+                if self.stopped:
+                    break
+                # Sleep until the next job is due, or until an earlier job is inserted
+                job = self._peek()
+                if job is None:
+                    self.condition.wait()
+                elif job.time > self.timefunc():
+                    self.condition.wait(job.time - self.timefunc())
+
+    def stop(self):
+        ''' Stop the runner
+        '''
+        with self.condition:
+            self.stopped = True
+            self._wake()
+
+    def _call(self, job):
+        ''' Run the action of a due job
+        '''
+        job.action(*job.argument, **job.kwargs)
+
+    def _wake(self):
+        ''' Wake the runner because the earliest job changed (called with the lock held)
+        '''
+        self.condition.notify_all()
+
+    def _peek(self):
+        ''' Return the earliest live job, dropping cancelled jobs from the top of the heap
+        '''
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    def _forget(self, job):
+        del self.jobs[job.sequence]
+        if job.name is not None and self.names.get(job.name) is job:
+            del self.names[job.name]
+
+    def _remove(self, job):
+        ''' Mark a job cancelled; compact the heap if it is mostly cancelled jobs
+        '''
+        job.cancelled = True
+        self._forget(job)
+        if len(self.heap) > COMPACT_RATIO * len(self.jobs) + 16:
+            self.heap = [job for job in self.heap if not job.cancelled]
+            heapq.heapify(self.heap)
+
+# Self test code
+if __name__ == '__main__':
+    from threading import Thread
+    scheduler = Scheduler()
+    calls = []
+    scheduler.enter(0.2, 1, calls.append, ('late',))
+    first = scheduler.enter(0.1, 1, calls.append, ('first',), name='job')
+    scheduler.enter(0.05, 1, calls.append, ('replaced',), name='job2')
+    scheduler.enter(0.15, 1, calls.append, ('second',), name='job2')   # replaces the job of the same name
+    assert [name for (_, name, _) in scheduler.snapshot()] == ['job', 'job2', None]
+    scheduler.cancel('job')
+    try:
+        scheduler.cancel(first)
+        assert False
+    except ValueError:
+        pass
+    scheduler.discard('missing')
+    scheduler.enter(0.12, 1, calls.append, ('first',), name='job')
+    runner = Thread(target=scheduler.run)
+    runner.start()
+
+    # An earlier job inserted from another thread wakes the runner immediately
+    begin = time.monotonic()
+    scheduler.enter(0.01, 0, calls.append, ('woken',))
+    time.sleep(0.05)
+    assert calls == ['woken'], calls
+    time.sleep(0.3)
+    assert calls == ['woken', 'first', 'second', 'late'] and scheduler.empty()
+    scheduler.stop()
+    runner.join(1)
+    assert not runner.is_alive()
+
+    # Cancelling many jobs keeps the heap compact
+    for i in range(1000):
+        scheduler.enter(100, 1, calls.append, (i,), name=f'job{i}')
+    scheduler.reschedule('job5', scheduler.timefunc() + 50)
+    assert scheduler.get('job5').time < scheduler.get('job6').time
+    for i in range(1000):
+        scheduler.discard(f'job{i}')
+    assert scheduler.empty() and len(scheduler.heap) < 50
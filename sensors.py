@@ -6,14 +6,15 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-import logging
-import sqlite3
-from datetime import datetime
-import paho.mqtt.client as mqtt
-import json
 import logging
 from datetime import datetime
+from payload import PayloadDecoder
+from alarms import AlarmEngine, load_rules
+from metrics import REGISTRY
+import time
+import configparser
 import smtplib
+from threading import Lock
 from email.utils import make_msgid
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -22,225 +23,251 @@ from email.mime.multipart import MIMEMultipart
 TABLE = 'SensorData'
 TIMER_PERIOD = 180
 
-# Alarm codes
-LOW_TEMPERATURE_ALARM = 1
-FREEZING_ALARM = 2
-HUMIDITY_ALARM = 3
+# MQTT topics of zigbee2mqtt devices (subscribed to with a single wildcard)
+TOPIC_PREFIX = 'zigbee2mqtt/'
+SUBSCRIPTION = TOPIC_PREFIX + '+'
 
-# Constants
-TEMPERATURE_HYSTERESIS = 1.0
-HUMIDITY_HYSTERESIS = 2.0
+# Fields handled for each type of device; "sensor" handles every field for devices of unknown type
+DEVICE_TYPES = {
+    'climate': ('temperature', 'humidity', 'pressure', 'battery_low'),
+    'water_leak': ('water_leak', 'battery_low'),
+    'button': ('action', 'battery_low'),
+    'sensor': ('water_leak', 'battery_low', 'temperature', 'humidity', 'pressure', 'action'),
+}
+DEFAULT_DEVICE_TYPE = 'sensor'
 
-# Sensor class definitions
+# Fields reporting events rather than state; a repeated payload with one of these is not skipped
+EVENT_FIELDS = ('action',)
 
-class SNZB02:
-    ''' class to manage device state for Sonoff SNZB02 '''
+# Fields recorded for every type of device
+STATUS_FIELDS = ('battery', 'linkquality')
 
-    def __init__(self, sensor_list):
-        ''' Constructor: connect to MQTT broker and initialize state variables
-            control bulbs, outlets, and store and retrieve sensor states
-        '''
-        self.sensor_list = sensor_list
+# Metrics
+MQTT_MESSAGES = REGISTRY.counter('pihome_mqtt_messages_total', 'MQTT messages received', ('topic',))
+MQTT_HANDLER_SECONDS = REGISTRY.histogram('pihome_mqtt_handler_seconds', 'Time taken to handle an MQTT message')
+MAIL_SEND_SECONDS = REGISTRY.histogram('pihome_mail_send_seconds', 'Time taken to send an e-mail alert')
+MAIL_FAILURES = REGISTRY.counter('pihome_mail_failures_total', 'E-mail alerts that failed to send')
 
+# Constants
+SMTP_TIMEOUT = 30
+SMTP_ATTEMPTS = 2       # a dropped connection is reopened once before a message fails
 
-        # Initialize states to None
+# Sensor class definitions
+
+class SensorRecord:
+    ''' Latest state reported by one sensor. Records are only written by the MQTT handler;
+        the version is odd while a message is being applied, so that readers in other
+        threads can take a consistent snapshot without a lock (a sequence lock).
+    '''
+    __slots__ = ('name', 'temperature', 'humidity', 'pressure', 'battery', 'linkquality',
+                 'battery_low', 'water_leak', 'last_seen', 'version')
+
+    def __init__(self, name):
+        self.name = name
         self.temperature = None
         self.humidity = None
+        self.pressure = None
         self.battery = None
-        self.linkquality = False
-     
-    def set_temperature(self, temp):
-        self.temperature = temp
+        self.linkquality = None
+        self.battery_low = False
+        self.water_leak = False
+        self.last_seen = None
+        self.version = 0
+
+    def begin(self):
+        ''' Start applying a message (called by the MQTT handler only)
+        '''
+        self.version += 1
 
-    def set_humidity(self, humidity):
-        self.humidity = humidity
+    def end(self):
+        self.version += 1
 
-    def get_temperature(self):
-        return self.temperature
+    def snapshot(self):
+        ''' Return a dictionary of the fields as they were between two messages
+        '''
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                snapshot = {field: getattr(self, field) for field in RECORD_FIELDS}
+                if self.version == version:
+                    return snapshot
+            time.sleep(0)       # a message is being applied: let the handler thread finish it
+
+# Fields of a record included in snapshots
+RECORD_FIELDS = tuple(field for field in SensorRecord.__slots__ if field != 'version')
+
+class Sensors:
+    ''' Registry of the configured sensors with one SensorRecord per sensor (by friendly name)
+    '''
+    def __init__(self, sensor_list):
+        ''' Constructor
+        '''
+        self.sensor_list = list(sensor_list)
+        self.records = {name: SensorRecord(name) for name in self.sensor_list}
 
-    def get_humidity(self):
-        return self.humidity
+    def add(self, name):
+        ''' Return the record of a sensor, adding the sensor if it is not registered
+        '''
+        record = self.records.get(name)
+        if record is None:
+            record = self.records[name] = SensorRecord(name)
+            self.sensor_list.append(name)
+        return record
+
+    def get(self, name):
+        ''' Return the record of a sensor, or None if it is not registered
+        '''
+        return self.records.get(name)
 
-    def get_battery(self):
-        return self.battery
+    def snapshot(self):
+        ''' Return a dictionary of the snapshot of every sensor (safe to call from any thread)
+        '''
+        return {name: record.snapshot() for (name, record) in list(self.records.items())}
 
-    def get_linkquality(self):
-        return self.linkquality
+    @property
+    def water_leak(self):
+        return any(record.water_leak for record in list(self.records.values()))
 
-    def is_low_temp(self):
-        if self.temperature == None:
-            return False
-        else:
-            return self.temperature < self.low_temp_threshold
+    @property
+    def low_battery(self):
+        return any(record.battery_low for record in list(self.records.values()))
 
     def __str__(self):
-        sensor_str = self.sensor_list[0]
-        for i in range(1,len(self.sensor_list)):
-            sensor_str += f', {self.sensor_list[i]}'
-        return sensor_str
-    
+        return ', '.join(self.sensor_list)
 
 class Events:
     ''' Event class used to handle periodic sensor sampling and MQTT messages from sensors
     '''
-    def __init__(self, scheduler, sensors, database, mail):
-        ''' Constructor 
+    def __init__(self, scheduler, sensors, writer, mail, devices, buffers=None, rules=None):
+        ''' Constructor: devices maps the friendly name of each device to its type in DEVICE_TYPES.
+            Readings are also appended to the in-memory ring buffers (RingBuffers) if given.
+            Alarms are raised by the given rules (default: the rules of alarms.DEFAULT_RULES).
         '''
         self.scheduler = scheduler
         self.sensors = sensors
+        self.writer = writer
         self.mail = mail
-
-        # Initialize a list to store alarms that may occur
-        self.alarms = []
-
-        # Connect to the sqlite database and create new table if not found
-        self.db = sqlite3.connect(database)
-        self.db.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} (datetime TEXT NOT NULL, temperature double, humidity double, pressure double)')
-        self.cursor = self.db.cursor()
-
-    def timer_handler(self, signum, frame):
-        ''' Timer schedule handler- fires every second and manages sensor readings
+        self.buffers = buffers
+
+        # Alarm engine that checks each field of a message against the rules for that field
+        if rules is None:
+            rules = load_rules(configparser.ConfigParser())
+        self.alarms = AlarmEngine(rules, mail)
+
+        # Precompiled dispatch table: MQTT topic -> (sensor record, {field: handler} for the fields of the device type)
+        handlers = {'water_leak': self.water_leak_handler, 'battery_low': self.battery_low_handler,
+                    'temperature': self.temperature_handler, 'humidity': self.humidity_handler,
+                    'pressure': self.pressure_handler, 'action': self.action_handler,
+                    'battery': self.battery_handler, 'linkquality': self.linkquality_handler}
+        field_tables = {name: {field: handlers[field] for field in fields + STATUS_FIELDS} for (name, fields) in DEVICE_TYPES.items()}
+        self.dispatch = {f'{TOPIC_PREFIX}{device}': (sensors.add(device), field_tables[device_type]) for (device, device_type) in devices.items()}
+
+        # Decoder that skips payloads repeating the last state reported on a topic
+        self.decoder = PayloadDecoder(f'"{field}"'.encode() for field in EVENT_FIELDS)
+
+        # MQTT topic -> handler(device, status) for state reports of controlled devices (e.g. bulbs)
+        self.reports = {}
+
+    def add_report_handler(self, device, handler):
+        ''' Pass every state report of a device (as a dictionary) to handler(device, status).
+            Repeated reports are not skipped, since a report may confirm a command that did not change the state.
         '''
-        # first capture sensor readings
-        temperature = self.sensors.get_temperature()
-        humidity = self.sensors.get_humidity()
-        pressure = self.sensors.get_pressure()
-
-        # If there is no useful data, return rather than storing NULL data
-        if temperature==None and humidity==None and pressure==None:
-            logging.debug(f'{datetime.now()}: no valid data to store in table...')
-            return
-
-        # Insert temperature/humidity into database periodically
-        logging.debug(f'{datetime.now()}: inserting data into to table: {temperature},{humidity},{pressure}')
-
-        # Insert temp and humidity data into table
-        sqlcmd = f"INSERT INTO {TABLE} VALUES (datetime('now','localtime'),{temperature},{humidity},{pressure})"
-        sqlcmd = sqlcmd.replace('None','NULL')
-        self.cursor.execute(sqlcmd)
-        logging.debug("{} record inserted.".format(self.cursor.rowcount))
-
-        # Keep just the last year of readings
-        sqlcmd = f"DELETE FROM {TABLE} WHERE datetime < datetime('now','localtime','-365 days')"
-        self.cursor.execute(sqlcmd)
-        logging.debug("{} records deleted.".format(self.cursor.rowcount))
-        self.db.commit()
+        self.reports[f'{TOPIC_PREFIX}{device}'] = handler
 
     def timer_event(self):
         ''' Scheduler handler to periodically store sensor readings
         '''
         # set next timer event
-        self.scheduler.enter(TIMER_PERIOD, 1, self.timer_event)
-
-        # first capture sensor readings
-        temperature = self.sensors.get_temperature()
-        humidity = self.sensors.get_humidity()
-        pressure = self.sensors.get_pressure()
-
-        # If there is no useful data, return rather than storing NULL data
-        if temperature==None and humidity==None and pressure==None:
-            logging.debug(f'{datetime.now()}: no valid data to store in table...')
-            return
-
-        # Insert temperature/humidity into database periodically
-        logging.debug(f'{datetime.now()}: inserting data into to table: {temperature},{humidity},{pressure}')
-
-        # Insert temp and humidity data into table
-        sqlcmd = f"INSERT INTO {TABLE} VALUES (datetime('now','localtime'),{temperature},{humidity},{pressure})"
-        sqlcmd = sqlcmd.replace('None','NULL')
-        self.cursor.execute(sqlcmd)
-        logging.debug("{} record inserted.".format(self.cursor.rowcount))
-
-        # Keep just the last year of readings
-        sqlcmd = f"DELETE FROM {TABLE} WHERE datetime < datetime('now','localtime','-365 days')"
-        self.cursor.execute(sqlcmd)
-        logging.debug("{} records deleted.".format(self.cursor.rowcount))
-        self.db.commit()
+        self.scheduler.enter(TIMER_PERIOD, 1, self.timer_event, name='timer_event')
+
+        # Timestamp shared by the database rows and the ring buffers, so both hold the same readings
+        now = int(time.time())
+        for (sensor, reading) in self.sensors.snapshot().items():
+            (temperature, humidity, pressure) = (reading['temperature'], reading['humidity'], reading['pressure'])
+            # If there is no useful data, skip rather than storing NULL data
+            if temperature==None and humidity==None and pressure==None:
+                logging.debug('no valid data from %s to store in table...', sensor)
+                continue
+
+            # Queue temperature/humidity for the database writer thread
+            logging.debug('queueing data for table: %s,%s,%s,%s', sensor, temperature, humidity, pressure)
+            self.writer.put(sensor, temperature, humidity, pressure, now)
+            if self.buffers is not None:
+                self.buffers.append(sensor, now, temperature, humidity, pressure)
 
     def mqtt_message_handler(self, client, data, msg):
-        ''' MQTT message handler for messages from sensors
-            Send e-mail alert when water leak or low battery detected
+        ''' MQTT message handler for messages on zigbee2mqtt/+: counts and times each message
+        '''
+        start = time.perf_counter()
+        MQTT_MESSAGES.inc(labels=(msg.topic,))
+        self.handle_message(msg)
+        MQTT_HANDLER_SECONDS.observe(time.perf_counter() - start)
+
+    def handle_message(self, msg):
+        ''' Handle a message on zigbee2mqtt/+
+            Messages from devices without a handler are dropped before parsing, then each
+            field reported by a device is passed to the handler for that field (if any).
+            State reports of controlled devices are passed whole to their report handler.
+        '''
+        entry = self.dispatch.get(msg.topic)
+        if entry is None:
+            handler = self.reports.get(msg.topic)
+            if handler is not None:
+                status = self.decoder.decode(msg.topic, msg.payload, skip_duplicates=False)
+                if status is not None:
+                    handler(msg.topic[len(TOPIC_PREFIX):], status)
+            return
+        (record, fields) = entry
+        logging.debug('MQTT Message received from %s: %s', record.name, msg.payload)
+        status = self.decoder.decode(msg.topic, msg.payload)   # Parse JSON payload into a dictionary
+        # Apply all fields of the message before other threads see the record again;
+        # an unchanged state still shows that the device is alive
+        record.begin()
+        try:
+            record.last_seen = datetime.now()
+            for (field, value) in (status or {}).items():
+                handler = fields.get(field)
+                if handler is not None:
+                    handler(record, value, msg.payload)
+        finally:
+            record.end()
+        if status is None:
+            return      # unchanged state or invalid payload
+        # Evaluate the alarm rules for the fields handled for this device
+        for (field, value) in status.items():
+            if field in fields:
+                self.alarms.check(record.name, field, value, msg.payload)
+
+    def water_leak_handler(self, record, value, payload):
+        record.water_leak = bool(value)
+
+    def battery_low_handler(self, record, value, payload):
+        record.battery_low = bool(value)
+
+    def battery_handler(self, record, value, payload):
+        record.battery = value
+
+    def linkquality_handler(self, record, value, payload):
+        record.linkquality = value
+
+    def temperature_handler(self, record, value, payload):
+        logging.debug('Temperature = %s degrees C', value)
+        record.temperature = float(value)
+
+    def humidity_handler(self, record, value, payload):
+        logging.debug('Humidity = %s', value)
+        record.humidity = float(value)
+
+    def pressure_handler(self, record, value, payload):
+        logging.debug('Air pressure = %s hPa', value)
+        record.pressure = float(value)
+
+    def action_handler(self, record, value, payload):
+        ''' Action messages are used to send miscellaneous info and alerts
         '''
-        message = str(msg.payload.decode("utf-8"))
-        sensor = msg.topic.split('/')[1]   # Extract sensor "friendly name" from MQTT topic
-        logging.debug(f'{datetime.now()} MQTT Message received from {sensor}: {message}')
-        status = json.loads(message) # Parse JSON message from sensor into a dictionary
-
-        # check MQTT dictionary keys for various variables exposed by sensors
-        # Water leak status
-        if "water_leak" in status:
-            if status['water_leak'] and sensor not in self.alarms:
-                logging.info(f'Water leak alarm detected for {sensor}!')
-                self.mail.send(f'Water leak alarm detected for {sensor}!',message)
-                self.alarms.append(sensor)
-                self.sensors.water_leak = True
-            elif not status['water_leak'] and sensor in self.alarms:
-                logging.info(f'Water leak alarm stopped for {sensor}!')
-                self.mail.send(f'Water leak alarm stopped for {sensor}',message)
-                self.alarms.remove(sensor)
-                self.sensors.water_leak = False
-
-        # Low battery status
-        if 'battery_low' in status and status['battery_low']:
-            logging.info(f'Low battery detected for {sensor}!')
-            self.mail.send(f'Low battery detected for {sensor}!', message)
-
-        # temperature reading
-        if 'temperature' in status:
-            logging.debug(f'Temperature = {status["temperature"]} degrees C')
-            self.sensors.temperature = float(status['temperature'])
-            # Next, check temperature value; send an alert if it falls below a preset threshold
-            if self.sensors.is_low_temp() and LOW_TEMPERATURE_ALARM not in self.alarms:
-                message = f'The house temperature has fallen to: {status["temperature"]} degrees C!'
-                logging.info(f'{datetime.now()}: {message}')
-                self.mail.send('Home temperature warning!', message)
-                self.alarms.append(LOW_TEMPERATURE_ALARM)
-            # otherwise check if temperature returns back above threshold
-            elif self.sensors.is_temp_normal() and LOW_TEMPERATURE_ALARM in self.alarms:
-                message = f'The house temperature is now risen to {status["temperature"]} degrees C.'
-                logging.info(f'{datetime.now()}: {message}')
-                self.mail.send('Home temperature update', message)
-                self.alarms.remove(LOW_TEMPERATURE_ALARM)
-            # check explicitly for freezing temperatures
-            elif self.sensors.is_freezing() and FREEZING_ALARM not in self.alarms:
-                message = f'The house temperature is freezing! Temperature={status["temperature"]} degrees C!'
-                logging.info(f'{datetime.now()}: {message}')
-                self.mail.send('Home temperature FREEZING!', message)
-                self.alarms.append(FREEZING_ALARM)
-            # otherwise check if things are no longer freezing
-            elif self.sensors.is_above_freezing() and FREEZING_ALARM in self.alarms:
-                message = f'The house temperature is now risen above freezing. Temperature={status["temperature"]} degrees C.'
-                logging.info(f'{datetime.now()}: {message}')
-                self.mail.send('Home temperature update', message)
-                self.alarms.remove(FREEZING_ALARM)
-        
-        # Humidity reading
-        if 'humidity' in status:
-            logging.debug(f'Humidity = {status["humidity"]}')
-            self.sensors.humidity = float(status['humidity'])
-            # check humidity value; send an alert if it rises above a preset threshold
-            if self.sensors.is_high_humidity() and HUMIDITY_ALARM not in self.alarms:
-                message = f'The house humidity has risen to: {status["humidity"]}!'
-                logging.info(f'{datetime.now()}: {message}')
-                self.mail.send('Home humidity warning!', message)
-                self.alarms.append(HUMIDITY_ALARM)
-            # otherwise check if things are back to normal
-            elif self.sensors.is_humidity_normal() and HUMIDITY_ALARM in self.alarms:
-                message = f'The house humidity has now fallen to: {status["humidity"]}.'
-                logging.info(f'{datetime.now()}: {message}')
-                self.mail.send('Home humidity update', message)
-                self.alarms.remove(HUMIDITY_ALARM)
-
-        # Air pressure
-        if 'pressure' in status:
-            logging.debug(f'Air pressure = {status["pressure"]} hPa')
-            self.sensors.pressure = float(status['pressure'])
-
-        # Action messages are used to send miscellaneous info and alerts
-        if 'action' in status:
-            message = f'{sensor} reporting: {status["action"]}!'
-            logging.info(f'{datetime.now()}: {message}')
-            self.mail.send(f'{status["action"]} notification', message)
+        message = f'{record.name} reporting: {value}!'
+        logging.info(f'{datetime.now()}: {message}')
+        self.mail.send(f'{value} notification', message, key=f'action:{record.name}')
 
 class Mail:
     ''' Class to encapsulate methods to send an alert email if sensor reading goes beyond 
@@ -253,16 +280,38 @@ class Mail:
         self.from_address = from_address
         self.server = server
 
-    def send(self, subject, message, html=None):
+        # The SMTP session is kept open and reused for the following messages
+        self.smtp = None
+        self.lock = Lock()
+
+    def send(self, subject, message, html=None, key=None):
         ''' Function to send an email - requires SMTP server to forward mail
-            Includes optional support for html messages
+            Includes optional support for html messages. The key (used by
+            AlertDispatcher to coalesce alerts) is ignored: every message is sent.
+            Returns True if the message was sent.
         '''
         # if no to-address or server set then just return
         if self.to_address == '' or self.server == '':
             logging.debug('recipient address or SMTP server not set - no email sent')
-            return
-        
-        # message to be sent
+            return False
+        msg = self.message(subject, message, html)
+
+        # send the mail over the open SMTP session
+        start = time.perf_counter()
+        try:
+            self.deliver(msg)
+            logging.info(f'{datetime.now()}: Email alert sent to {self.to_address}')
+        except (smtplib.SMTPException, OSError) as e:
+            MAIL_FAILURES.inc()
+            logging.info(f'{datetime.now()}: Email alert failed to send! ({e})')
+            return False
+        finally:
+            MAIL_SEND_SECONDS.observe(time.perf_counter() - start)
+        return True
+
+    def message(self, subject, message, html=None):
+        ''' Return a MIME message with a plain text and optional html part
+        '''
         if html == None:
             msg = MIMEText(message)
         else:
@@ -277,45 +326,81 @@ class Mail:
         if html != None:
             msg.attach(MIMEText(message, 'plain'))
             msg.attach(MIMEText(html, 'html'))
+        return msg
 
-        # send the mail and terminate the session
-        try:
-            # creates SMTP session and sends mail
-            s = smtplib.SMTP(self.server)
-            s.sendmail(self.from_address, self.to_address, msg.as_string())
-            logging.info(f'{datetime.now()}: Email alert sent to {self.to_address}')
-            s.quit()
-        except:
-            logging.info(f'{datetime.now()}: Email alert failed to send!')
+    def deliver(self, msg):
+        ''' Send a message, opening an SMTP session if none is open. If the server has
+            dropped the session (e.g. after being idle) a new session is opened and the
+            message is sent again. Raises smtplib.SMTPException or OSError on failure.
+        '''
+        with self.lock:
+            for attempt in range(1, SMTP_ATTEMPTS + 1):
+                try:
+                    if self.smtp is None:
+                        self.smtp = smtplib.SMTP(self.server, timeout=SMTP_TIMEOUT)
+                    self.smtp.sendmail(self.from_address, self.to_address, msg.as_string())
+                    return
+                except smtplib.SMTPResponseException:
+                    raise       # message refused by the server: the session is still usable
+                except (smtplib.SMTPException, OSError):
+                    self.disconnect()
+                    if attempt == SMTP_ATTEMPTS:
+                        raise
+                    logging.info('SMTP session to %s lost; reconnecting', self.server)
+
+    def close(self):
+        ''' End the SMTP session (if one is open)
+        '''
+        with self.lock:
+            self.disconnect()
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
 
 # Self test code
 if __name__ == '__main__':
-    sensors = Sensors(['test_sensor'],10, 80)
-    sensors.set_temperature(10)
-    assert (sensors.get_temperature() == 10)
-    sensors.set_humidity(10)
-    assert (sensors.get_humidity() == 10)
-    sensors.set_pressure(1000)
-    assert (sensors.get_pressure() == 1000)
-    sensors.set_temperature(1+TEMPERATURE_HYSTERESIS)
-    assert (sensors.is_above_freezing() == True)
-    sensors.set_temperature(-1)
-    assert (sensors.is_above_freezing() == False)
-    sensors.set_temperature(8)
-    assert (sensors.is_temp_normal() == False)
-    sensors.set_temperature(11+TEMPERATURE_HYSTERESIS)
-    assert (sensors.is_temp_normal() == True)
-    sensors.set_humidity(80)
-    assert (sensors.is_high_humidity() == False)
-    sensors.set_humidity(81)
-    assert (sensors.is_high_humidity() == True)
-    sensors.set_humidity(79-HUMIDITY_HYSTERESIS)
-    assert (sensors.is_humidity_normal() == True)
+    from types import SimpleNamespace
+    from threading import Thread
     # Test mail with no settings
     mail = Mail('','','server')
-    try:
-        mail.send('subject','message')
-        assert False, 'Test failed: mail send method should throw an exception'
-    except:
-        assert True
-    
\ No newline at end of file
+    assert mail.send('subject','message') == False
+
+    # Each sensor keeps its own readings; messages are applied to the record of their topic
+    class Writer:
+        def __init__(self):
+            self.rows = []
+        def put(self, *row):
+            self.rows.append(row)
+    class Scheduler:
+        def enter(self, *args, **kwargs):
+            pass
+    sensors = Sensors(['kitchen', 'basement'])
+    events = Events(Scheduler(), sensors, Writer(), mail, {'kitchen': 'climate', 'basement': 'sensor', 'leak1': 'water_leak'})
+    def message(device, payload):
+        events.mqtt_message_handler(None, None, SimpleNamespace(topic=f'{TOPIC_PREFIX}{device}', payload=payload))
+    message('kitchen', b'{"temperature":21.5,"humidity":40,"battery":90,"linkquality":120}')
+    message('basement', b'{"temperature":5.0,"humidity":70,"battery_low":true}')
+    message('leak1', b'{"water_leak":true,"battery":100}')
+    snapshot = sensors.snapshot()
+    assert snapshot['kitchen']['temperature'] == 21.5 and snapshot['basement']['temperature'] == 5.0
+    assert snapshot['kitchen']['battery'] == 90 and snapshot['kitchen']['linkquality'] == 120
+    assert snapshot['leak1']['water_leak'] and sensors.water_leak and sensors.low_battery and 'leak1' in sensors.sensor_list
+    assert events.alarms.active_alarms() == [('basement', 'battery_low'), ('basement', 'low_temp'), ('leak1', 'water_leak')]
+    events.timer_event()
+    assert sorted(row[0] for row in events.writer.rows) == ['basement', 'kitchen'] and len({row[-1] for row in events.writer.rows}) == 1
+
+    # Snapshots taken while messages are applied never mix two messages
+    def ingest():
+        for i in range(20000):
+            message('kitchen', f'{{"temperature":{i},"humidity":{i}}}'.encode())
+    thread = Thread(target=ingest)
+    thread.start()
+    while thread.is_alive():
+        reading = sensors.get('kitchen').snapshot()
+        assert reading['temperature'] == reading['humidity'], reading
+    thread.join()
@@ -0,0 +1,120 @@
+# Part of the Pi-Home program for use with Zigbee devices and a Raspberry Pi
+# (C) 2020 Derek Schuurman
+# License: GNU General Public License (GPL) v3
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Solar calendar shared by all timer-controlled devices. The city is looked up in
+# astral's database once, and the dawn and dusk times for a window of days are
+# computed in advance, so "next dusk (or dawn) after a time" is a binary search
+# rather than a city database lookup and sun() computation on every call.
+
+import bisect
+import logging
+from datetime import date, datetime, timedelta
+from threading import Lock
+from astral.sun import sun
+from astral.geocoder import lookup, database
+
+# Constants
+WINDOW_DAYS = 400
+DEFAULT_HOUR = 17       # dawn/dusk time used if the city is not recognized (5PM)
+
+class SolarCalendar:
+    ''' Precomputed dawn and dusk times (naive local datetimes) for a city.
+        A new window is computed when a time outside the current window is requested.
+    '''
+    def __init__(self, city, days=WINDOW_DAYS):
+        ''' Constructor: resolve the city once and compute the first window of days
+        '''
+        self.days = days
+        self.lock = Lock()
+        self.times = {'dawn': [], 'dusk': []}
+        try:
+            self.city = lookup(city, database())
+        except KeyError:         # Log error and use 5PM by default if city not found
+            logging.error(f'Unrecognized city {city}, using default dusk and dawn time of 5PM.')
+            self.city = None
+        self.fill(date.today() - timedelta(days=1))
+
+    def fill(self, start):
+        ''' Compute dawn and dusk for the window of days beginning at start
+        '''
+        times = {'dawn': [], 'dusk': []}
+        for i in range(self.days):
+            day = start + timedelta(days=i)
+            if self.city is None:
+                default = datetime(day.year, day.month, day.day, DEFAULT_HOUR)
+                times['dawn'].append(default)
+                times['dusk'].append(default)
+                continue
+            # The sun may not reach the dawn/dusk depression angle on some days at high latitudes
+            try:
+                s = sun(self.city.observer, tzinfo=self.city.timezone, date=day)
+            except ValueError:
+                continue
+            for event in times:
+                times[event].append(s[event].replace(tzinfo=None))  # remove timezone to be compatible with datetime
+        with self.lock:
+            self.times = times
+            self.start = datetime.combine(start, datetime.min.time())
+
+    def next_event(self, event, after=None):
+        ''' Return the first dawn or dusk (event) after a naive local datetime (default: now)
+        '''
+        if after is None:
+            after = datetime.now()
+        times = self.times[event]
+        i = bisect.bisect_right(times, after)
+        if i == len(times) or after < self.start:
+            # Outside the window: compute a new window starting just before the requested time
+            self.fill(after.date() - timedelta(days=1))
+            times = self.times[event]
+            i = bisect.bisect_right(times, after)
+        return times[i]
+
+    def next_dusk(self, after=None):
+        ''' Return the next dusk time after a datetime (default: now)
+        '''
+        return self.next_event('dusk', after)
+
+    def next_dawn(self, after=None):
+        ''' Return the next dawn time after a datetime (default: now)
+        '''
+        return self.next_event('dawn', after)
+
+# Self test and benchmark code
+if __name__ == '__main__':
+    import time
+    calendar = SolarCalendar('Detroit')
+    now = datetime.now()
+    dusk = calendar.next_dusk()
+    assert now < dusk < now + timedelta(days=1, hours=1)
+    assert calendar.next_dusk(dusk) > dusk + timedelta(hours=23)
+    assert now < calendar.next_dawn() < now + timedelta(days=1, hours=1)
+    # A new window is computed for times past the end of the window
+    later = now + timedelta(days=500)
+    assert later < calendar.next_dusk(later) < later + timedelta(days=1, hours=1)
+    # Unknown cities fall back to 5PM
+    assert SolarCalendar('Atlantis', days=3).next_dusk(datetime(2024, 1, 1, 18)) == datetime(2024, 1, 2, 17)
+
+    # Compare with the previous path: city lookup and sun() on every call (twice after dusk)
+    def per_call():
+        city = lookup('Detroit', database())
+        s = sun(city.observer, tzinfo=city.timezone)
+        dusk = s['dusk'].replace(tzinfo=None)
+        if dusk < datetime.now():
+            s = sun(city.observer, tzinfo=city.timezone, date=date.today()+timedelta(days=1))
+            dusk = s['dusk'].replace(tzinfo=None)
+        return dusk
+
+    for (name, fn, n) in (('lookup + sun() per call', per_call, 200), ('SolarCalendar', calendar.next_dusk, 100000)):
+        begin = time.perf_counter()
+        for _ in range(n):
+            fn()
+        print(f'{name:<24} {1e6*(time.perf_counter()-begin)/n:10.1f} us per next dusk')
+    begin = time.perf_counter()
+    SolarCalendar('Detroit')
+    print(f'{"startup (400 days)":<24} {1e3*(time.perf_counter()-begin):10.1f} ms')